@@ -10,9 +10,10 @@ from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 import logging
 from datetime import datetime, timedelta
+from typing import Optional
 
 # Imports locales
-from models.user_models import UserRepository
+from models.user_models import UserRepository, UserClaimsRecord
 from utils.password import PasswordManager
 from utils.validators import validate_user_data
 
@@ -23,15 +24,23 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from shared.models import (
     SuccessResponse, ErrorResponse, HealthResponse,
-    LoginRequest, RegisterRequest, Token, UserResponse
+    LoginRequest, LogoutRequest, RegisterRequest, Token, UserResponse
+)
+from shared.auth_middleware import auth_middleware, get_current_user, validate_token
+from shared.database import (
+    init_database, close_database, get_database_manager, get_database_metrics, loader_scope,
+    get_write_behind_buffer
 )
-from shared.auth_middleware import auth_middleware, get_current_user
-from shared.database import init_database, close_database, get_database_manager
 from shared.exceptions import (
     UserAlreadyExistsException, InvalidCredentialsException,
-    UserNotFoundException, handle_service_exception
+    UserNotFoundException, InvalidTokenException, ExpiredTokenException,
+    handle_service_exception
 )
 from shared.config import get_settings
+from shared.redis_client import get_redis_cache, init_redis_cache, close_redis_cache
+from shared.tiered_cache import get_tiered_cache
+from shared.token_revocation import get_revocation_list, REVOKED_LOCALLY
+from shared.token_claims import build_claims
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
@@ -53,11 +62,20 @@ async def lifespan(app: FastAPI):
         logger.error(f"❌ Database connection failed: {e}")
         raise
     
+    await init_redis_cache()
+    get_tiered_cache().start()
+    get_revocation_list().start()
+    # `last_login` se escribe diferido: invalidar el perfil cacheado al confirmarlo
+    get_write_behind_buffer().add_flush_listener(user_repo.on_deferred_flush)
+    
     yield
     
     # Shutdown
     logger.info("🔄 Shutting down Auth Service...")
+    await get_tiered_cache().stop()
+    await get_revocation_list().stop()
     await close_database()
+    await close_redis_cache()
     logger.info("✅ Auth Service stopped")
 
 
@@ -78,6 +96,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Alcance de deduplicación de lecturas por ID para cada request
+@app.middleware("http")
+async def database_loader_scope(request, call_next):
+    with loader_scope():
+        return await call_next(request)
+
+
 # Repositorios
 user_repo = UserRepository()
 password_manager = PasswordManager()
@@ -88,7 +113,7 @@ password_manager = PasswordManager()
 async def global_exception_handler(request, exc):
     """Handler global para excepciones"""
     if isinstance(exc, (UserAlreadyExistsException, InvalidCredentialsException, 
-                       UserNotFoundException)):
+                       UserNotFoundException, InvalidTokenException, ExpiredTokenException)):
         http_exc = handle_service_exception(exc)
         return JSONResponse(
             status_code=http_exc.status_code,
@@ -118,11 +143,23 @@ async def health_check():
         version="1.0.0",
         checks={
             "database": db_health,
+            "redis": await get_redis_cache().health_check(),
+            "cache": get_tiered_cache().get_stats(),
+            "token_revocation": get_revocation_list().get_stats(),
             "jwt_configured": bool(settings.JWT_SECRET_KEY)
         }
     )
 
 
+@app.get("/metrics", response_model=SuccessResponse)
+async def database_metrics():
+    """Latencias p50/p95/p99 por repositorio y comando, y consultas lentas"""
+    return SuccessResponse(
+        message="Metrics retrieved successfully",
+        data=get_database_metrics()
+    )
+
+
 # Endpoints de autenticación
 @app.post("/register", response_model=SuccessResponse)
 async def register_user(user_data: RegisterRequest):
@@ -143,7 +180,7 @@ async def register_user(user_data: RegisterRequest):
     validate_user_data(user_data.name, user_data.email, user_data.password)
     
     # Verificar si el usuario ya existe
-    existing_user = await user_repo.get_by_email(user_data.email)
+    existing_user = await user_repo.get_by_email(user_data.email, projection="exists")
     if existing_user:
         raise UserAlreadyExistsException("User with this email already exists")
     
@@ -173,7 +210,7 @@ async def login_user(login_data: LoginRequest):
     logger.info(f"Login attempt for email: {login_data.email}")
     
     # Buscar usuario
-    user = await user_repo.get_by_email(login_data.email)
+    user = await user_repo.get_by_email(login_data.email, projection="login")
     if not user:
         raise InvalidCredentialsException("Invalid email or password")
     
@@ -195,13 +232,9 @@ async def login_user(login_data: LoginRequest):
     await user_repo.update_last_login(user["id"])
     
     # Crear tokens
-    token_data = {
-        "sub": user["id"],
-        "email": user["email"],
-        "name": user["name"],
-        "role": user.get("subscription_status", "free"),
-        "permissions": _get_user_permissions(user.get("subscription_status", "free"))
-    }
+    token_data = _token_claims(
+        user["id"], user.get("subscription_status", "free"), user["email"], user["name"]
+    )
     
     access_token = auth_middleware.create_access_token(token_data)
     refresh_token = auth_middleware.create_refresh_token(token_data)
@@ -230,18 +263,14 @@ async def refresh_token(current_user: dict = Depends(get_current_user)):
     logger.info(f"Token refresh for user: {current_user['user_id']}")
     
     # Verificar que el usuario aún existe y está activo
-    user = await user_repo.get_by_id(current_user["user_id"])
-    if not user or not user.get("is_active", False):
+    user = await user_repo.get_by_id(
+        current_user["user_id"], projection="claims", as_type=UserClaimsRecord
+    )
+    if not user or not user.is_active:
         raise UserNotFoundException("User not found or inactive")
     
     # Crear nuevo token
-    token_data = {
-        "sub": user["id"],
-        "email": user["email"],
-        "name": user["name"],
-        "role": user.get("subscription_status", "free"),
-        "permissions": _get_user_permissions(user.get("subscription_status", "free"))
-    }
+    token_data = _token_claims(user.id, user.get("subscription_status", "free"), user.email, user.name)
     
     new_access_token = auth_middleware.create_access_token(token_data)
     
@@ -258,7 +287,7 @@ async def refresh_token(current_user: dict = Depends(get_current_user)):
 @app.get("/me", response_model=SuccessResponse)
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Obtener información del usuario actual"""
-    user = await user_repo.get_by_id(current_user["user_id"])
+    user = await user_repo.get_cached(current_user["user_id"], projection="profile")
     if not user:
         raise UserNotFoundException("User not found")
     
@@ -308,40 +337,65 @@ async def update_profile(
 
 
 @app.post("/logout", response_model=SuccessResponse)
-async def logout_user(current_user: dict = Depends(get_current_user)):
-    """Cerrar sesión (principalmente para logs)"""
-    logger.info(f"User logged out: {current_user['user_id']}")
+async def logout_user(
+    logout_data: Optional[LogoutRequest] = None,
+    token_payload: dict = Depends(auth_middleware.verify_token)
+):
+    """Cerrar sesión: revocar el token de acceso y, si se envía, el de refresh"""
+    user_id = token_payload["sub"]
+    payloads = [token_payload]
+    if logout_data and logout_data.refresh_token:
+        refresh_payload = validate_token(logout_data.refresh_token)
+        if refresh_payload.get("sub") != user_id or refresh_payload.get("type") != "refresh":
+            raise InvalidTokenException("Invalid refresh token")
+        payloads.append(refresh_payload)
+    
+    revocation_list = get_revocation_list()
+    results = [await revocation_list.revoke_payload(payload) for payload in payloads]
+    revoked = sum(1 for result in results if result is not None)
+    propagated = REVOKED_LOCALLY not in results
+    
+    if not propagated:
+        # Revocado solo en esta réplica hasta que vuelva Redis
+        logger.warning(f"User logged out: {user_id} ({revoked} tokens revoked, not propagated)")
+        return SuccessResponse(
+            message="Logout partially successful: token revoked on this instance only",
+            data={"revoked_tokens": revoked, "propagated": False}
+        )
+    logger.info(f"User logged out: {user_id} ({revoked} tokens revoked)")
     return SuccessResponse(
         message="Logout successful",
-        data={}
+        data={"revoked_tokens": revoked, "propagated": True}
     )
 
 
 # Endpoint para validar tokens (usado por otros microservicios)
 @app.post("/validate-token", response_model=SuccessResponse)
 async def validate_token_external(current_user: dict = Depends(get_current_user)):
-    """Validar token para otros microservicios"""
+    """Validar token para otros microservicios (`email` solo si va en los claims)"""
     return SuccessResponse(
         message="Token is valid",
         data={
             "user_id": current_user["user_id"],
             "email": current_user["email"],
             "role": current_user["role"],
-            "permissions": current_user["permissions"]
+            "permissions": current_user["permissions"],
+            "permission_mask": current_user["permission_mask"]
         }
     )
 
 
 # Helper functions
-def _get_user_permissions(subscription_status: str) -> list:
-    """Obtener permisos basados en el estado de suscripción"""
-    permissions_map = {
-        "free": ["chat:basic", "history:read"],
-        "premium": ["chat:advanced", "history:full", "export:pdf"],
-        "enterprise": ["chat:unlimited", "history:unlimited", "analytics:full"],
-        "admin": ["*"]
-    }
-    return permissions_map.get(subscription_status, permissions_map["free"])
+def _token_claims(user_id: str, subscription_status: str, email: str, name: str) -> dict:
+    """Claims del token: permisos en bitmask y plan como entero (ver shared/token_claims.py)"""
+    return build_claims(
+        user_id,
+        subscription_status,
+        email,
+        name,
+        compact=settings.JWT_COMPACT_CLAIMS,
+        include_pii=settings.JWT_INCLUDE_PII
+    )
 
 
 if __name__ == "__main__":
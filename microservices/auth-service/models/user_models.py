@@ -4,19 +4,96 @@ Modelos y repositorio de usuario para Auth Service
 
 import sys
 import os
+import re
+import unicodedata
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import uuid
 
+from pymongo import UpdateOne
+
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 
-from shared.database import BaseRepository, get_database_manager
+from shared.database import (
+    BaseRepository, DocumentRecord, ReadConsistency, get_database_manager, get_batch_loader,
+    decode_cursor, build_keyset_filter, CURSOR_AFTER
+)
 from shared.exceptions import UserNotFoundException
+from shared.tiered_cache import get_tiered_cache
+
+
+# Longitud máxima de prefijo indexado por token de búsqueda
+SEARCH_PREFIX_MAX_LENGTH = 20
+# Por encima de este número el total se reporta como cota inferior
+SEARCH_COUNT_LIMIT = 1000
+# Proyecciones cacheadas en el namespace "user" (clave `{user_id}:{proyección}`)
+CACHED_PROJECTIONS = ("profile",)
+
+
+def normalize_search_text(text: str) -> str:
+    """Normalizar texto para búsqueda: minúsculas y sin acentos"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return text.lower().strip()
+
+
+def build_search_prefixes(name: str, email: str) -> List[str]:
+    """Generar prefijos indexables a partir del nombre y el email"""
+    tokens = re.split(r"[\s\-'.]+", normalize_search_text(name))
+    email = normalize_search_text(email)
+    tokens.append(email)
+    tokens.extend(re.split(r"[@._+\-]+", email))
+    
+    prefixes = set()
+    for token in tokens:
+        token = token[:SEARCH_PREFIX_MAX_LENGTH]
+        for i in range(1, len(token) + 1):
+            prefixes.add(token[:i])
+    return sorted(prefixes)
+
+
+class UserClaimsRecord(DocumentRecord):
+    """Campos mínimos para emitir tokens"""
+    __slots__ = ("id", "email", "name", "is_active", "subscription_status")
 
 
 class UserRepository(BaseRepository):
     """Repositorio para operaciones de usuario"""
     
+    projections = {
+        # Existencia por email en el registro
+        "exists": {"_id": 0, "id": 1},
+        # Login: verificación de contraseña + claims
+        "login": {
+            "_id": 0, "id": 1, "email": 1, "name": 1,
+            "password_hash": 1, "is_active": 1, "subscription_status": 1
+        },
+        # Refresh: claims y estado de la cuenta
+        "claims": {
+            "_id": 0, "id": 1, "email": 1, "name": 1,
+            "is_active": 1, "subscription_status": 1
+        },
+        # Perfil público (/me): nunca el hash de contraseña
+        "profile": {
+            "_id": 0, "id": 1, "email": 1, "name": 1, "subscription_status": 1,
+            "email_verified": 1, "created_at": 1, "last_login": 1
+        },
+        "stats": {
+            "_id": 0, "subscription_status": 1, "email_verified": 1,
+            "last_login": 1, "is_active": 1, "created_at": 1
+        }
+    }
+    
+    read_consistency = {
+        **BaseRepository.read_consistency,
+        # Login/refresh deben ver el último estado de la cuenta
+        "get_by_email": ReadConsistency.PRIMARY,
+        "get_by_id": ReadConsistency.PRIMARY,
+        # Búsquedas de admin toleran datos ligeramente atrasados
+        "search_users": ReadConsistency.SECONDARY_PREFERRED,
+        "search_users_indexed": ReadConsistency.SECONDARY_PREFERRED,
+    }
+    
     def __init__(self):
         super().__init__("users")
     
@@ -35,6 +112,8 @@ class UserRepository(BaseRepository):
             "is_active": user_data.get("is_active", True),
             "email_verified": user_data.get("email_verified", False),
             "last_login": None,
+            "name_lower": normalize_search_text(user_data["name"]),
+            "search_prefixes": build_search_prefixes(user_data["name"], user_data["email"]),
             "created_at": now,
             "updated_at": now
         }
@@ -43,33 +122,76 @@ class UserRepository(BaseRepository):
         await collection.insert_one(user_document)
         return user_id
     
-    async def get_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+    async def get_by_email(
+        self,
+        email: str,
+        projection: Optional[Any] = None,
+        as_type: Optional[type] = None
+    ) -> Optional[Any]:
         """Buscar usuario por email"""
-        collection = self.get_collection()
-        user = await collection.find_one({"email": email.lower()})
-        return user
+        return await self.find_one(
+            {"email": email.lower()}, projection, as_type,
+            consistency=self.consistency_for("get_by_email")
+        )
     
-    async def get_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
+    async def get_by_id(
+        self,
+        user_id: str,
+        projection: Optional[Any] = None,
+        as_type: Optional[type] = None
+    ) -> Optional[Any]:
         """Buscar usuario por ID"""
-        collection = self.get_collection()
-        user = await collection.find_one({"id": user_id})
-        return user
+        return await self.find_by_id(
+            user_id, projection, as_type,
+            consistency=self.consistency_for("get_by_id")
+        )
+    
+    async def get_cached(self, user_id: str, projection: str = "profile") -> Optional[Dict[str, Any]]:
+        """Usuario desde la caché en dos niveles (L1 + Redis), cargado de MongoDB si falta"""
+        return await get_tiered_cache().get_or_load(
+            "user", f"{user_id}:{projection}",
+            lambda: self.get_by_id(user_id, projection=projection)
+        )
+    
+    async def invalidate_cache(self, user_ids: List[str]):
+        """Invalidar los usuarios cacheados en todas las réplicas"""
+        await get_tiered_cache().invalidate(
+            "user", *(f"{user_id}:{projection}" for user_id in user_ids for projection in CACHED_PROJECTIONS)
+        )
+    
+    async def on_deferred_flush(self, collection_name: str, ids: List[str]):
+        """Invalidar tras confirmar escrituras diferidas (p.ej. `last_login`)"""
+        if collection_name == self.collection_name:
+            await self.invalidate_cache(ids)
     
     async def update_user(self, user_id: str, update_data: Dict[str, Any]) -> bool:
         """Actualizar datos de usuario"""
         collection = self.get_collection()
         update_data["updated_at"] = datetime.utcnow()
         
+        # Mantener sincronizados los campos de búsqueda normalizados
+        if "name" in update_data or "email" in update_data:
+            current = await collection.find_one(
+                {"id": user_id}, {"_id": 0, "name": 1, "email": 1}
+            ) or {}
+            name = update_data.get("name", current.get("name", ""))
+            email = update_data.get("email", current.get("email", ""))
+            update_data["name_lower"] = normalize_search_text(name)
+            update_data["search_prefixes"] = build_search_prefixes(name, email)
+        
         result = await collection.update_one(
             {"id": user_id},
             {"$set": update_data}
         )
+        get_batch_loader(self.collection_name).forget(user_id)
+        await self.invalidate_cache([user_id])
         
         return result.modified_count > 0
     
     async def update_last_login(self, user_id: str) -> bool:
-        """Actualizar timestamp de último login"""
-        return await self.update_user(user_id, {"last_login": datetime.utcnow()})
+        """Actualizar timestamp de último login (write-behind, fuera del camino crítico)"""
+        self.update_by_id_deferred(user_id, {"last_login": datetime.utcnow()})
+        return True
     
     async def update_subscription(
         self, 
@@ -88,6 +210,14 @@ class UserRepository(BaseRepository):
         """Desactivar usuario"""
         return await self.update_user(user_id, {"is_active": False})
     
+    async def deactivate_users(self, user_ids: list) -> Dict[str, Any]:
+        """Desactivar múltiples usuarios en lote (admin)"""
+        report = await self.update_many_by_ids(
+            {user_id: {"is_active": False} for user_id in user_ids}
+        )
+        await self.invalidate_cache(user_ids)
+        return report
+    
     async def activate_user(self, user_id: str) -> bool:
         """Activar usuario"""
         return await self.update_user(user_id, {"is_active": True})
@@ -102,7 +232,7 @@ class UserRepository(BaseRepository):
     
     async def get_user_stats(self, user_id: str) -> Dict[str, Any]:
         """Obtener estadísticas básicas del usuario"""
-        user = await self.get_by_id(user_id)
+        user = await self.get_by_id(user_id, projection="stats")
         if not user:
             raise UserNotFoundException("User not found")
         
@@ -130,7 +260,7 @@ class UserRepository(BaseRepository):
         limit: int = 50
     ) -> Dict[str, Any]:
         """Buscar usuarios con filtros (para admin)"""
-        collection = self.get_collection()
+        collection = self.get_read_collection("search_users")
         
         # Construir filtro
         filter_dict = {}
@@ -165,3 +295,123 @@ class UserRepository(BaseRepository):
             "page_size": limit,
             "total_pages": (total_count + limit - 1) // limit
         }
+
+    
+    async def search_users_indexed(
+        self,
+        query: str = None,
+        subscription_status: str = None,
+        is_active: bool = None,
+        cursor: str = None,
+        limit: int = 50
+    ) -> Dict[str, Any]:
+        """
+        Búsqueda de usuarios anclada por prefijo (para admin).
+        
+        Usa `search_prefixes` (multikey) + orden `(created_at, id)` servido
+        por el mismo índice, paginación keyset y totales estimados.
+        """
+        filter_dict = self._build_indexed_search_filter(query, subscription_status, is_active)
+        
+        page = await self.find_page(
+            filter_dict,
+            sort={"created_at": -1, "id": -1},
+            limit=limit,
+            cursor=cursor,
+            projection={"_id": 0, "password_hash": 0, "search_prefixes": 0},
+            consistency=self.consistency_for("search_users_indexed")
+        )
+        total_count, is_lower_bound = await self._estimate_total(filter_dict)
+        
+        return {
+            "users": page["items"],
+            "total_count": total_count,
+            "total_is_lower_bound": is_lower_bound,
+            "page_size": limit,
+            "next_cursor": page["next_cursor"],
+            "previous_cursor": page["previous_cursor"],
+            "has_next": page["has_next"],
+            "has_previous": page["has_previous"]
+        }
+    
+    async def explain_search(self, query: str = None, cursor: str = None, **filters) -> Dict[str, Any]:
+        """Obtener el plan ganador de la búsqueda indexada (diagnóstico)"""
+        collection = self.get_read_collection("search_users_indexed")
+        filter_dict = self._build_indexed_search_filter(query, **filters)
+        sort = [("created_at", -1), ("id", -1)]
+        if cursor:
+            # Mismo filtro keyset que `find_page` para las páginas siguientes
+            decoded = decode_cursor(cursor)
+            forward = decoded["direction"] == CURSOR_AFTER
+            keyset = build_keyset_filter(sort, decoded["values"], forward)
+            filter_dict = {"$and": [filter_dict, keyset]} if filter_dict else keyset
+            if not forward:
+                sort = [(field, -direction) for field, direction in sort]
+        plan = await collection.find(filter_dict).sort(sort).limit(1).explain()
+        return plan.get("queryPlanner", {}).get("winningPlan", {})
+    
+    def _build_indexed_search_filter(
+        self,
+        query: str = None,
+        subscription_status: str = None,
+        is_active: bool = None
+    ) -> Dict[str, Any]:
+        filter_dict = {}
+        
+        if query:
+            terms = [
+                term[:SEARCH_PREFIX_MAX_LENGTH]
+                for term in re.split(r"[\s,;]+", normalize_search_text(query))
+                if term
+            ]
+            if len(terms) == 1:
+                filter_dict["search_prefixes"] = terms[0]
+            elif terms:
+                filter_dict["search_prefixes"] = {"$all": terms}
+        
+        if subscription_status:
+            filter_dict["subscription_status"] = subscription_status
+        
+        if is_active is not None:
+            filter_dict["is_active"] = is_active
+        
+        return filter_dict
+    
+    async def _estimate_total(self, filter_dict: Dict[str, Any]) -> tuple:
+        """Total barato: metadata de la colección o conteo acotado"""
+        collection = self.get_read_collection("search_users_indexed")
+        if not filter_dict:
+            return await collection.estimated_document_count(), False
+        
+        count = await collection.count_documents(filter_dict, limit=SEARCH_COUNT_LIMIT)
+        return count, count >= SEARCH_COUNT_LIMIT
+    
+    async def backfill_search_fields(self, batch_size: int = 1000) -> int:
+        """Poblar campos de búsqueda en usuarios existentes (migración)"""
+        collection = self.get_collection()
+        updated = 0
+        
+        while True:
+            users = await collection.find(
+                {"search_prefixes": {"$exists": False}},
+                {"_id": 0, "id": 1, "name": 1, "email": 1}
+            ).limit(batch_size).to_list(length=batch_size)
+            if not users:
+                break
+            
+            operations = [
+                UpdateOne(
+                    {"id": user["id"]},
+                    {"$set": {
+                        "name_lower": normalize_search_text(user.get("name", "")),
+                        "search_prefixes": build_search_prefixes(
+                            user.get("name", ""), user.get("email", "")
+                        )
+                    }}
+                )
+                for user in users
+            ]
+            await collection.bulk_write(operations, ordered=False)
+            updated += len(operations)
+        
+        return updated
@@ -0,0 +1,14 @@
+"""
+Configuración común de los tests de Auth Service
+
+Ejecutar desde microservices/auth-service:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.join(SERVICE_DIR, '..', '..'))
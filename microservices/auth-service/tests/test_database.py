@@ -0,0 +1,198 @@
+"""
+Utilidades de `shared.database` sin servidor
+
+Las colecciones son falsas en memoria con la parte de la API de motor que
+usa cada utilidad.
+"""
+
+from functools import cmp_to_key
+import asyncio
+
+from shared.database import BatchLoader, BaseRepository, WriteBehindBuffer, loader_scope
+
+
+def _compare(a, b) -> int:
+    # Orden de MongoDB para lo que usan los tests: null antes que cualquier valor
+    if a is None or b is None:
+        return (a is not None) - (b is not None)
+    return (a > b) - (a < b)
+
+
+def _matches(document, query) -> bool:
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(_matches(document, clause) for clause in condition):
+                return False
+        elif field == "$or":
+            if not any(_matches(document, clause) for clause in condition):
+                return False
+        elif field == "$expr":
+            if not condition:
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(field)
+            for operator, operand in condition.items():
+                if operator == "$in":
+                    matched = value in operand
+                elif operator == "$ne":
+                    matched = value != operand
+                else:
+                    # $gt/$lt no comparan null
+                    matched = value is not None and operand is not None and (
+                        value > operand if operator == "$gt" else value < operand
+                    )
+                if not matched:
+                    return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
+class MemoryCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, keys):
+        def compare(a, b):
+            for field, direction in keys:
+                result = _compare(a.get(field), b.get(field)) * direction
+                if result:
+                    return result
+            return 0
+        self.documents = sorted(self.documents, key=cmp_to_key(compare))
+        return self
+
+    def limit(self, count):
+        self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.documents[:length]
+
+
+class MemoryCollection:
+    def __init__(self, documents):
+        self.documents = {document["id"]: document for document in documents}
+        self.finds = 0
+
+    def find(self, query, projection=None):
+        self.finds += 1
+        return MemoryCursor([dict(document) for document in self.documents.values() if _matches(document, query)])
+
+
+class FlakyCollection:
+    """Colección cuyo `bulk_write` falla las primeras `failures` veces"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.writes = []
+
+    async def bulk_write(self, operations, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("primary unavailable")
+        self.writes.append([(operation._filter["id"], operation._doc["$set"]) for operation in operations])
+
+
+class MemoryDatabaseManager:
+    def __init__(self, collections):
+        self.collections = collections
+
+    def get_collection(self, name, consistency=None):
+        return self.collections[name]
+
+
+def test_batch_loader_callers_never_share_documents():
+    users = MemoryCollection([{"id": "u1", "profile": {"name": "Ana"}}])
+    loader = BatchLoader(MemoryDatabaseManager({"users": users}), "users")
+
+    async def scenario():
+        with loader_scope():
+            first, second = await asyncio.gather(loader.load("u1"), loader.load("u1"))
+            first["profile"]["name"] = "changed"
+            second["profile"]["name"] = "also changed"
+            cached = await loader.load("u1")
+        return first, second, cached
+
+    first, second, cached = asyncio.run(scenario())
+
+    assert users.finds == 1
+    assert cached == {"id": "u1", "profile": {"name": "Ana"}}
+    assert first is not second and first["profile"] is not second["profile"]
+    assert loader.stats["scope_hits"] == 1
+
+
+def _walk(repository, sort, forward=True):
+    """IDs de todas las páginas de 2 recorriendo en un sentido"""
+    async def pages():
+        seen = []
+        page = await repository.find_page(sort=sort, limit=2)
+        if not forward:
+            # Ir al final y volver hacia atrás
+            while page["next_cursor"]:
+                page = await repository.find_page(sort=sort, limit=2, cursor=page["next_cursor"])
+            while True:
+                seen[:0] = [document["id"] for document in page["items"]]
+                if not page["previous_cursor"]:
+                    return seen
+                page = await repository.find_page(sort=sort, limit=2, cursor=page["previous_cursor"])
+        while True:
+            seen.extend(document["id"] for document in page["items"])
+            if not page["next_cursor"]:
+                return seen
+            page = await repository.find_page(sort=sort, limit=2, cursor=page["next_cursor"])
+    return asyncio.run(pages())
+
+
+def test_find_page_walks_nullable_sort_keys_both_ways():
+    documents = [
+        {"id": "a", "score": 3}, {"id": "b", "score": None}, {"id": "c", "score": 1},
+        {"id": "d"}, {"id": "e", "score": 3}, {"id": "f", "score": 2}, {"id": "g", "score": None},
+    ]
+    repository = BaseRepository("items")
+    repository.db_manager = MemoryDatabaseManager({"items": MemoryCollection(documents)})
+
+    for direction in (1, -1):
+        sort = {"score": direction}
+        expected = [document["id"] for document in MemoryCollection(documents).find({}).sort(
+            [("score", direction), ("id", direction)]
+        ).documents]
+        assert _walk(repository, sort) == expected, direction
+        assert _walk(repository, sort, forward=False) == expected, direction
+
+
+def test_write_behind_coalesces_updates_to_the_same_document():
+    users = FlakyCollection()
+    buffer = WriteBehindBuffer(MemoryDatabaseManager({"users": users}))
+    buffer.enqueue("users", "u1", {"last_login": 1})
+    buffer.enqueue("users", "u2", {"last_login": 2})
+    buffer.enqueue("users", "u1", {"last_login": 3, "login_count": 7})
+
+    assert asyncio.run(buffer.flush()) == 2
+    assert users.writes == [[("u1", {"last_login": 3, "login_count": 7}), ("u2", {"last_login": 2})]]
+    assert buffer.stats["coalesced"] == 1 and buffer.pending_count() == 0
+
+
+def test_write_behind_requeues_failed_flushes_then_drops_them():
+    users = FlakyCollection(failures=2)
+    buffer = WriteBehindBuffer(MemoryDatabaseManager({"users": users}), max_attempts=3)
+    buffer.enqueue("users", "u1", {"last_login": 1})
+
+    async def scenario():
+        await buffer.flush()
+        # Lo encolado durante el fallo prevalece sobre lo reencolado
+        buffer.enqueue("users", "u1", {"last_login": 2})
+        await buffer.flush()
+        return await buffer.flush()
+
+    assert asyncio.run(scenario()) == 1
+    assert users.writes == [[("u1", {"last_login": 2})]]
+    assert buffer.stats["errors"] == 2 and buffer.stats["dropped"] == 0
+
+    users.failures = 3
+    buffer.enqueue("users", "u2", {"last_login": 3})
+    for _ in range(3):
+        asyncio.run(buffer.flush())
+
+    assert buffer.pending_count() == 0
+    assert buffer.stats["dropped"] == 1
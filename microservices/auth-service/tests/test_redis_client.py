@@ -0,0 +1,129 @@
+"""
+Cliente Redis compartido sobre fakeredis
+
+Pipelining por tick, formato de los valores (byte de cabecera con
+serializador y bit zstd) y TTL por namespace.
+"""
+
+from datetime import datetime
+import asyncio
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from shared.redis_client import (
+    RedisCache, ValueCodec, CACHE_NAMESPACES, FORMAT_MSGPACK, FORMAT_JSON, FLAG_ZSTD
+)
+
+TTLS = {"session": 600, "user": 120, "llm": 3600}
+
+
+def _cache(**options) -> RedisCache:
+    server = fakeredis.FakeServer()
+    namespaces = {name: {**namespace, "ttl": TTLS.get(name)} for name, namespace in CACHE_NAMESPACES.items()}
+    return RedisCache(
+        None,
+        namespaces,
+        client_factory=lambda db: fakeredis.aioredis.FakeRedis(server=server, db=db),
+        **options
+    )
+
+
+def test_commands_of_the_same_tick_share_a_pipeline():
+    cache = _cache()
+
+    async def scenario():
+        await asyncio.gather(*(cache.set("user", f"u{i}", {"n": i}) for i in range(10)))
+        values = await asyncio.gather(*(cache.get("user", f"u{i}") for i in range(10)))
+        # Otra base de datos: su propio pipeline
+        await asyncio.gather(cache.set("llm", "a", 1), cache.set("user", "b", 2))
+        return values
+
+    values = asyncio.run(scenario())
+
+    assert values == [{"n": i} for i in range(10)]
+    assert cache.stats["commands"] == 22
+    # 10 SET + 10 GET en dos pipelines; el último tick, un comando por base
+    assert cache.stats["pipelines"] == 2
+    assert cache.stats["pipelined_commands"] == 20
+
+
+def test_pipeline_size_splits_large_ticks():
+    cache = _cache(pipeline_size=4)
+
+    async def scenario():
+        return await asyncio.gather(*(cache.incr("rate_limit", "k") for _ in range(10)))
+
+    assert sorted(asyncio.run(scenario())) == list(range(1, 11))
+    assert cache.stats["pipelines"] == 3
+
+
+def test_values_round_trip_with_the_format_byte():
+    cache = _cache()
+    small = {"id": "u1", "roles": ["admin"], "at": datetime(2024, 1, 2, 3, 4, 5), "tags": {"a"}}
+
+    async def scenario():
+        await cache.set("user", "small", small)
+        raw = await cache.client("user").get(cache.key("user", "small"))
+        return raw, await cache.get("user", "small")
+
+    raw, value = asyncio.run(scenario())
+
+    assert raw[0] == FORMAT_MSGPACK
+    assert value == {"id": "u1", "roles": ["admin"], "at": "2024-01-02T03:04:05", "tags": ["a"]}
+
+
+def test_large_values_are_compressed_with_zstd():
+    pytest.importorskip("zstandard")
+    cache = _cache(compression_threshold=256)
+    large = {"content": "lorem ipsum " * 500}
+
+    async def scenario():
+        await cache.set("llm", "large", large)
+        raw = await cache.client("llm").get(cache.key("llm", "large"))
+        return raw, await cache.get("llm", "large")
+
+    raw, value = asyncio.run(scenario())
+
+    assert raw[0] == FORMAT_MSGPACK | FLAG_ZSTD
+    assert len(raw) < len(large["content"])
+    assert value == large
+    assert cache.codec.stats["compressed"] == 1
+
+
+def test_values_written_by_another_serializer_stay_readable():
+    # Un proceso sin msgpack escribe JSON: el byte de cabecera lo identifica
+    raw = bytes([FORMAT_JSON]) + json.dumps({"plan": "free"}).encode("utf-8")
+
+    assert ValueCodec().decode(raw) == {"plan": "free"}
+    assert ValueCodec().decode(None) is None
+
+
+def test_each_namespace_applies_its_own_ttl():
+    cache = _cache()
+
+    async def scenario():
+        await cache.set("session", "s1", "x")
+        await cache.set("user", "u1", "x")
+        await cache.set("user", "u2", "x", ttl=30)
+        await cache.set("revoked", "jti", 1)
+        await cache.incr("llm", "hits")
+        await cache.incr("llm", "hits")
+        ttl = {}
+        for namespace, key in [("session", "s1"), ("user", "u1"), ("user", "u2"), ("revoked", "jti"), ("llm", "hits")]:
+            ttl[(namespace, key)] = await cache.client(namespace).ttl(cache.key(namespace, key))
+        # `llm` vive en su propia base de datos
+        ttl["llm in db 0"] = await cache.client("user").exists(cache.key("llm", "hits"))
+        return ttl
+
+    ttl = asyncio.run(scenario())
+
+    assert ttl[("session", "s1")] == 600
+    assert ttl[("user", "u1")] == 120
+    assert ttl[("user", "u2")] == 30
+    # Sin TTL de namespace: la clave no expira sola
+    assert ttl[("revoked", "jti")] == -1
+    assert ttl[("llm", "hits")] == 3600
+    assert ttl["llm in db 0"] == 0
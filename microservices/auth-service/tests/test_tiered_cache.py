@@ -0,0 +1,109 @@
+"""
+Protección contra estampidas de `TieredCache.get_or_load`
+
+Varias réplicas comparten un Redis falso (fakeredis, inyectado con
+`client_factory`) y 1000 lectores concurrentes piden una clave que expira:
+solo debe recalcularse una vez por expiración.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from shared.redis_client import RedisCache, CACHE_NAMESPACES
+from shared.tiered_cache import TieredCache
+
+NAMESPACE = "temp"
+READERS = 1000
+REPLICAS = 4
+
+
+def _replicas(**options) -> list:
+    server = fakeredis.FakeServer()
+    namespaces = {name: {**namespace, "ttl": 60} for name, namespace in CACHE_NAMESPACES.items()}
+    return [
+        TieredCache(
+            RedisCache(None, namespaces, client_factory=lambda db: fakeredis.aioredis.FakeRedis(server=server, db=db)),
+            xfetch_beta=0,
+            lock_ttl=2,
+            lock_poll_interval=0.01,
+            **options
+        )
+        for _ in range(REPLICAS)
+    ]
+
+
+class CountingLoader:
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        version = self.calls
+        await asyncio.sleep(self.delay)
+        return {"version": version}
+
+
+async def _read_all(replicas, loader, key: str, ttl: int) -> list:
+    return await asyncio.gather(*[
+        replicas[i % len(replicas)].get_or_load(NAMESPACE, key, loader, ttl=ttl)
+        for i in range(READERS)
+    ])
+
+
+def test_cold_key_is_loaded_once():
+    async def scenario():
+        replicas = _replicas()
+        loader = CountingLoader()
+        return loader, replicas, await _read_all(replicas, loader, "cold", ttl=10)
+
+    loader, replicas, results = asyncio.run(scenario())
+
+    assert loader.calls == 1
+    assert all(result == {"version": 1} for result in results)
+    # Dentro de cada réplica las lecturas se comparten; entre réplicas, el lock
+    assert sum(replica.stats[NAMESPACE]["loads"] for replica in replicas) == 1
+    assert sum(replica.stats[NAMESPACE]["coalesced"] for replica in replicas) == READERS - REPLICAS
+
+
+def test_expired_key_recomputed_once_while_serving_stale():
+    async def scenario():
+        replicas = _replicas(stale_ttl=10)
+        # Recarga lenta: servir 1000 lecturas obsoletas debe tardar mucho menos
+        loader = CountingLoader(delay=0.5)
+        await _read_all(replicas, loader, "hot", ttl=1)
+        await asyncio.sleep(1.1)
+
+        started = time.monotonic()
+        stale = await _read_all(replicas, loader, "hot", ttl=1)
+        served_in = time.monotonic() - started
+        # Esperar al refresco en segundo plano
+        await asyncio.gather(*[task for replica in replicas for task in replica._refreshes.values()])
+        fresh = await _read_all(replicas, loader, "hot", ttl=1)
+        return loader, replicas, stale, fresh, served_in
+
+    loader, replicas, stale, fresh, served_in = asyncio.run(scenario())
+
+    assert loader.calls == 2
+    assert all(result == {"version": 1} for result in stale)
+    assert served_in < loader.delay
+    assert all(result == {"version": 2} for result in fresh)
+    assert sum(replica.stats[NAMESPACE]["stale_served"] for replica in replicas) >= READERS
+
+
+def test_hard_expiry_recomputed_once():
+    async def scenario():
+        replicas = _replicas(stale_ttl=0)
+        loader = CountingLoader()
+        await _read_all(replicas, loader, "hard", ttl=1)
+        await asyncio.sleep(1.2)
+        return loader, await _read_all(replicas, loader, "hard", ttl=1)
+
+    loader, results = asyncio.run(scenario())
+
+    assert loader.calls == 2
+    assert all(result == {"version": 2} for result in results)
@@ -0,0 +1,49 @@
+"""
+Claims compactos: el bitmask se decodifica con el registro de la versión del token
+"""
+
+from shared.config import UserRoles
+from shared.token_claims import (
+    PERMISSION_REGISTRY,
+    REGISTRY_VERSION,
+    build_claims,
+    plan_permissions,
+    user_from_claims,
+)
+
+
+def test_compact_and_legacy_claims_decode_to_the_same_user():
+    for plan in (UserRoles.FREE, UserRoles.PREMIUM, UserRoles.ENTERPRISE, UserRoles.ADMIN):
+        compact = user_from_claims(build_claims("user-1", plan, "a@example.com", "A"))
+        legacy = user_from_claims(build_claims("user-1", plan, "a@example.com", "A", compact=False))
+
+        assert compact["permissions"] == legacy["permissions"] == plan_permissions(plan)
+        assert compact["permission_mask"] == legacy["permission_mask"]
+        assert compact["role"] == legacy["role"] == plan
+        assert compact["email"] is None
+
+
+def test_bits_from_a_newer_registry_are_ignored():
+    known = len(PERMISSION_REGISTRY[REGISTRY_VERSION])
+    claims = build_claims("user-1", UserRoles.FREE)
+    claims.update({"pv": REGISTRY_VERSION + 1, "pm": claims["pm"] | 1 << known})
+
+    current_user = user_from_claims(claims)
+
+    assert current_user["permissions"] == plan_permissions(UserRoles.FREE)
+    assert current_user["permission_mask"] == build_claims("user-1", UserRoles.FREE)["pm"]
+
+
+def test_mask_decoded_against_token_registry_version(monkeypatch):
+    import shared.token_claims as token_claims
+
+    older = PERMISSION_REGISTRY[REGISTRY_VERSION][:-1]
+    monkeypatch.setitem(token_claims.PERMISSION_REGISTRY, 0, older)
+    monkeypatch.setitem(token_claims._VERSION_MASKS, 0, (1 << len(older)) - 1)
+    claims = build_claims("user-1", UserRoles.ENTERPRISE)
+    claims["pv"] = 0
+
+    current_user = user_from_claims(claims)
+
+    assert PERMISSION_REGISTRY[REGISTRY_VERSION][-1] in plan_permissions(UserRoles.ENTERPRISE)
+    assert current_user["permissions"] == [p for p in plan_permissions(UserRoles.ENTERPRISE) if p in older]
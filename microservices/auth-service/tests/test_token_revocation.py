@@ -0,0 +1,124 @@
+"""
+Lista de revocación de tokens sobre fakeredis
+
+Varias réplicas comparten un servidor falso (pub/sub incluido): filtro de
+Bloom, revocaciones publicadas durante una resincronización y revocación
+local cuando Redis no acepta la escritura.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from shared.redis_client import RedisCache, CACHE_NAMESPACES
+from shared.token_revocation import BloomFilter, TokenRevocationList, REVOKED, REVOKED_LOCALLY
+
+
+def _replica(server) -> TokenRevocationList:
+    cache = RedisCache(
+        None,
+        {name: {**namespace, "ttl": None} for name, namespace in CACHE_NAMESPACES.items()},
+        client_factory=lambda db: fakeredis.aioredis.FakeRedis(server=server, db=db)
+    )
+    return TokenRevocationList(cache, capacity=1000, resync_interval=3600)
+
+
+async def _wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+def test_bloom_filter_has_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"revoked-{i}")
+
+    assert all(f"revoked-{i}" in bloom for i in range(1000))
+    false_positives = sum(f"valid-{i}" in bloom for i in range(20000))
+    assert false_positives / 20000 < 0.02
+
+
+def test_revocations_reach_other_replicas_and_skip_redis_when_filtered():
+    server = fakeredis.FakeServer()
+    first, second = _replica(server), _replica(server)
+
+    async def scenario():
+        first.start()
+        second.start()
+        try:
+            await _wait_for(lambda: first._synced and second._synced)
+            assert await first.revoke("jti-1", time.time() + 60) == REVOKED
+            await _wait_for(lambda: "jti-1" in second.bloom)
+            return await second.is_revoked("jti-1"), await second.is_revoked("jti-2")
+        finally:
+            await first.stop()
+            await second.stop()
+
+    assert asyncio.run(scenario()) == (True, False)
+    # El negativo se resolvió en memoria; el positivo se confirmó en Redis
+    assert second.stats["bloom_negatives"] == 1
+    assert second.stats["redis_lookups"] == 1
+
+
+def test_revocation_published_during_resync_survives_the_rebuild():
+    server = fakeredis.FakeServer()
+    first, second = _replica(server), _replica(server)
+    scan = second._scan
+
+    async def scan_then_revoke():
+        jtis = await scan()
+        # Otra réplica revoca después del SCAN y antes de cambiar el filtro
+        await first.revoke("jti-late", time.time() + 60)
+        await _wait_for(lambda: "jti-late" in (second._published_during_resync or []))
+        return jtis
+
+    async def scenario():
+        second.start()
+        try:
+            await _wait_for(lambda: second._synced)
+            second._scan = scan_then_revoke
+            await second.resync()
+            second._scan = scan
+            return await second.is_revoked("jti-late")
+        finally:
+            await second.stop()
+
+    assert asyncio.run(scenario()) is True
+    assert "jti-late" in second.bloom
+
+
+def test_revocation_falls_back_to_the_replica_when_redis_is_down():
+    server = fakeredis.FakeServer()
+    first, second = _replica(server), _replica(server)
+
+    async def scenario():
+        server.connected = False
+        result = await first.revoke("jti-1", time.time() + 60)
+        locally = await first.is_revoked("jti-1")
+        elsewhere_while_down = await second.is_revoked("jti-1")
+
+        server.connected = True
+        # La resincronización escribe en Redis lo que quedó local
+        await first.resync()
+        return result, locally, elsewhere_while_down, await second.is_revoked("jti-1")
+
+    result, locally, elsewhere_while_down, elsewhere_after = asyncio.run(scenario())
+
+    assert result == REVOKED_LOCALLY
+    assert locally is True
+    assert elsewhere_while_down is False
+    assert elsewhere_after is True
+    assert first.get_stats()["pending_local"] == 0
+
+
+def test_expired_tokens_are_not_revoked():
+    list_ = _replica(fakeredis.FakeServer())
+
+    assert asyncio.run(list_.revoke("jti-old", time.time() - 1)) is None
+    assert list_.stats["revoked"] == 0
@@ -0,0 +1,86 @@
+"""
+Plan de la búsqueda indexada de usuarios (primera página y siguientes)
+
+Necesita un MongoDB real (`MONGODB_TEST_URI`, por defecto localhost); se
+omite si no hay servidor. Usa una base de datos temporal que se elimina al
+terminar.
+"""
+
+from typing import Any, Dict, List
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from shared.database import DatabaseManager
+from shared.indexes import INDEX_DECLARATIONS, ensure_indexes
+from models.user_models import UserRepository
+
+MONGODB_TEST_URI = os.environ.get("MONGODB_TEST_URI", "mongodb://localhost:27017")
+
+
+def _stages(plan: Any) -> List[str]:
+    """Etapas de un plan (recorre inputStage/inputStages/queryPlan)"""
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _stages(item)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for value in plan.values():
+        stages.extend(_stages(value))
+    return stages
+
+
+# (query, filtros) representativos de la búsqueda del panel de administración
+SEARCHES = [
+    ("user", {}),
+    ("user 1", {}),
+    ("user", {"subscription_status": "premium"}),
+    (None, {"subscription_status": "premium"}),
+    (None, {}),
+]
+
+
+async def _explain_searches() -> List[Dict[str, Any]]:
+    manager = DatabaseManager(
+        MONGODB_TEST_URI,
+        f"llm_wrapper_test_{uuid.uuid4().hex[:8]}",
+        client_options={"serverSelectionTimeoutMS": 1000},
+        enable_monitoring=False
+    )
+    try:
+        await manager.connect()
+    except Exception as e:
+        pytest.skip(f"MongoDB not available: {e}")
+    
+    try:
+        await ensure_indexes(manager.db, {"users": INDEX_DECLARATIONS["users"]})
+        repository = UserRepository()
+        repository.db_manager = manager
+        for i in range(50):
+            await repository.create_user({
+                "name": f"User {i}",
+                "email": f"user{i}@example.com",
+                "password_hash": "x",
+                "subscription_status": "premium" if i % 2 else "free"
+            })
+        plans = [await repository.explain_search(query, **filters) for query, filters in SEARCHES]
+        # Páginas siguientes: el filtro keyset debe seguir en el índice
+        for query, filters in SEARCHES:
+            page = await repository.search_users_indexed(query, limit=5, **filters)
+            assert page["next_cursor"], (query, filters)
+            plans.append(await repository.explain_search(query, cursor=page["next_cursor"], **filters))
+        return plans
+    finally:
+        await manager.client.drop_database(manager.database_name)
+        await manager.disconnect()
+
+
+def test_search_uses_index():
+    plans = asyncio.run(_explain_searches())
+    
+    for (query, filters), plan in zip(SEARCHES * 2, plans):
+        stages = _stages(plan)
+        assert "IXSCAN" in stages, (query, filters, plan)
+        assert "COLLSCAN" not in stages, (query, filters, plan)
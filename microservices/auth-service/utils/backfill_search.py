@@ -0,0 +1,44 @@
+"""
+Migración de los campos de búsqueda de usuarios
+
+Puebla `name_lower` y `search_prefixes` en los usuarios creados antes de la
+búsqueda indexada; sin ellos no aparecen en `search_users_indexed`. Es
+idempotente (solo toca usuarios sin `search_prefixes`) y se ejecuta después
+de `python -m shared.indexes`, antes de desplegar la búsqueda indexada.
+
+Uso (desde microservices/auth-service):
+    python -m utils.backfill_search [--batch-size 1000]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from shared.database import get_database_manager
+from models.user_models import UserRepository
+
+
+async def main(batch_size: int) -> int:
+    db_manager = get_database_manager()
+    await db_manager.connect()
+    try:
+        updated = await UserRepository().backfill_search_fields(batch_size=batch_size)
+    finally:
+        await db_manager.disconnect()
+
+    print(json.dumps({"updated": updated}))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill user search fields")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(args.batch_size)))
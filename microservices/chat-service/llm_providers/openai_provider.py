@@ -5,7 +5,7 @@ OpenAI Provider para Chat Service
 import openai
 import os
 import logging
-from typing import Dict, Any, AsyncGenerator, Optional
+from typing import Dict, Any, AsyncGenerator, Optional, List
 import time
 
 # Imports compartidos
@@ -17,6 +17,9 @@ from shared.exceptions import LLMProviderException
 
 logger = logging.getLogger(__name__)
 
+# Tokens de salida si la request no fija `max_tokens`
+DEFAULT_MAX_OUTPUT_TOKENS = 1000
+
 
 class OpenAIProvider:
     """Proveedor para APIs de OpenAI"""
@@ -80,12 +83,21 @@ class OpenAIProvider:
         except Exception as e:
             raise LLMProviderException(f"OpenAI connection test failed: {e}")
     
+    def _build_messages(self, request: ChatRequest) -> List[Dict[str, str]]:
+        """Mensajes sin historial: system prompt y mensaje del usuario"""
+        messages = []
+        if request.system_prompt:
+            messages.append({"role": "system", "content": request.system_prompt})
+        messages.append({"role": "user", "content": request.message})
+        return messages
+    
     async def chat_completion(
         self,
         request: ChatRequest,
-        model: str = "gpt-3.5-turbo"
+        model: str = "gpt-3.5-turbo",
+        context: Optional[List[Dict[str, str]]] = None
     ) -> Dict[str, Any]:
-        """Completión de chat estándar"""
+        """Completión de chat estándar (`context`: mensajes ya armados con el historial)"""
         if not self.is_initialized:
             raise LLMProviderException("OpenAI provider not initialized")
         
@@ -94,19 +106,14 @@ class OpenAIProvider:
         
         try:
             # Preparar mensajes
-            messages = []
-            
-            if request.system_prompt:
-                messages.append({"role": "system", "content": request.system_prompt})
-            
-            messages.append({"role": "user", "content": request.message})
+            messages = context or self._build_messages(request)
             
             # Configurar parámetros
             params = {
                 "model": model,
                 "messages": messages,
                 "temperature": request.temperature,
-                "max_tokens": request.max_tokens or 1000,
+                "max_tokens": request.max_tokens or DEFAULT_MAX_OUTPUT_TOKENS,
                 "stream": False
             }
             
@@ -134,9 +141,10 @@ class OpenAIProvider:
     async def chat_stream(
         self,
         request: ChatRequest,
-        model: str = "gpt-3.5-turbo"
+        model: str = "gpt-3.5-turbo",
+        context: Optional[List[Dict[str, str]]] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        """Stream de chat"""
+        """Stream de chat (`context`: mensajes ya armados con el historial)"""
         if not self.is_initialized:
             raise LLMProviderException("OpenAI provider not initialized")
         
@@ -145,19 +153,14 @@ class OpenAIProvider:
         
         try:
             # Preparar mensajes
-            messages = []
-            
-            if request.system_prompt:
-                messages.append({"role": "system", "content": request.system_prompt})
-            
-            messages.append({"role": "user", "content": request.message})
+            messages = context or self._build_messages(request)
             
             # Configurar parámetros para streaming
             params = {
                 "model": model,
                 "messages": messages,
                 "temperature": request.temperature,
-                "max_tokens": request.max_tokens or 1000,
+                "max_tokens": request.max_tokens or DEFAULT_MAX_OUTPUT_TOKENS,
                 "stream": True
             }
             
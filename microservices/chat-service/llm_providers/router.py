@@ -8,7 +8,7 @@ from typing import Dict, Any, List, Optional, AsyncGenerator
 import re
 
 # Imports locales
-from .openai_provider import OpenAIProvider
+from .openai_provider import OpenAIProvider, DEFAULT_MAX_OUTPUT_TOKENS
 # from .claude_provider import ClaudeProvider
 # from .deepseek_provider import DeepSeekProvider  
 # from .gemini_provider import GeminiProvider
@@ -22,6 +22,15 @@ from shared.exceptions import LLMProviderException
 
 logger = logging.getLogger(__name__)
 
+# Ventana de contexto si el modelo no la declara
+DEFAULT_CONTEXT_TOKENS = 4096
+
+SUMMARY_SYSTEM_PROMPT = (
+    "Resume la conversación siguiente para que un asistente pueda continuarla. "
+    "Conserva hechos, decisiones, datos concretos (nombres, cifras, código) y "
+    "preguntas pendientes. Responde solo con el resumen, en el idioma de la conversación."
+)
+
 
 class LLMRouter:
     """Router para gestionar múltiples proveedores LLM"""
@@ -155,7 +164,8 @@ class LLMRouter:
         self, 
         request: ChatRequest, 
         model: str, 
-        user_id: str
+        user_id: str,
+        context: Optional[List[Dict[str, str]]] = None
     ) -> Dict[str, Any]:
         """Procesar solicitud de chat con un modelo específico"""
         
@@ -170,20 +180,21 @@ class LLMRouter:
         
         try:
             # Intentar con el proveedor principal
-            return await provider.chat_completion(request, model)
+            return await provider.chat_completion(request, model, context)
             
         except Exception as e:
             logger.error(f"Primary provider {provider_name} failed: {e}")
             
             # Intentar con fallback si está habilitado
-            return await self._try_fallback(request, model, user_id, [provider_name])
+            return await self._try_fallback(request, model, user_id, [provider_name], context)
     
     async def _try_fallback(
         self, 
         request: ChatRequest, 
         original_model: str, 
         user_id: str,
-        failed_providers: List[str]
+        failed_providers: List[str],
+        context: Optional[List[Dict[str, str]]] = None
     ) -> Dict[str, Any]:
         """Intentar con proveedores de fallback"""
         
@@ -200,7 +211,7 @@ class LLMRouter:
             
             try:
                 logger.info(f"Trying fallback: {fallback_provider}/{fallback_model}")
-                result = await provider.chat_completion(request, fallback_model)
+                result = await provider.chat_completion(request, fallback_model, context)
                 result["fallback_used"] = True
                 result["original_model"] = original_model
                 return result
@@ -237,7 +248,8 @@ class LLMRouter:
         self, 
         request: ChatRequest, 
         model: str, 
-        user_id: str
+        user_id: str,
+        context: Optional[List[Dict[str, str]]] = None
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """Procesar stream de chat"""
         
@@ -249,9 +261,42 @@ class LLMRouter:
         if not provider:
             raise LLMProviderException(f"Provider {provider_name} not available")
         
-        async for chunk in provider.chat_stream(request, model):
+        async for chunk in provider.chat_stream(request, model, context):
             yield chunk
     
+    def get_context_budget(self, model: str, max_output_tokens: Optional[int] = None) -> int:
+        """Tokens disponibles para el prompt: ventana del modelo menos la salida reservada"""
+        provider = self.providers.get(self.model_to_provider.get(model))
+        model_info = provider.get_model_info(model) if provider else None
+        context_tokens = model_info["max_tokens"] if model_info else DEFAULT_CONTEXT_TOKENS
+        return context_tokens - (max_output_tokens or DEFAULT_MAX_OUTPUT_TOKENS)
+    
+    def select_summary_model(self) -> Optional[str]:
+        """Modelo más barato disponible para tareas internas (resúmenes)"""
+        candidates = [
+            (info["cost_per_1k_input"] + info["cost_per_1k_output"], model)
+            for provider in self.providers.values()
+            for model, info in provider.models.items()
+        ]
+        return min(candidates)[1] if candidates else None
+    
+    async def summarize(
+        self,
+        transcript: str,
+        max_tokens: int,
+        model: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Resumir una transcripción con el modelo indicado o el más barato (con fallback)"""
+        model = model or self.select_summary_model()
+        if not model:
+            raise LLMProviderException("No provider available for summarization")
+        request = ChatRequest(message=transcript, temperature=0.2, max_tokens=max_tokens)
+        context = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": transcript}
+        ]
+        return await self.process_chat_request(request, model, "system", context)
+    
     async def calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
         """Calcular costo estimado"""
         provider_name = self.model_to_provider.get(model)
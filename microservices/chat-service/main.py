@@ -10,6 +10,7 @@ from fastapi.responses import StreamingResponse, JSONResponse
 from contextlib import asynccontextmanager
 import logging
 import json
+import uuid
 from typing import Optional
 
 # Imports locales
@@ -20,6 +21,8 @@ from llm_providers.gemini_provider import GeminiProvider
 from llm_providers.router import LLMRouter
 from utils.token_counter import TokenCounter
 from utils.rate_limiter import ChatRateLimiter
+from utils.context_builder import ContextBuilder
+from utils.summarizer import ConversationSummarizer
 
 # Imports compartidos
 import sys
@@ -28,9 +31,14 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from shared.models import (
     SuccessResponse, ErrorResponse, HealthResponse,
-    ChatRequest, ChatResponse, LLMStatus
+    ChatRequest, ChatResponse, LLMStatus, Message
 )
 from shared.auth_middleware import get_current_user
+from shared.database import init_database, close_database, get_database_manager
+from shared.history_store import ConversationRepository, get_message_buffer, retention_days_for_plan
+from shared.content_codec import init_content_codec, get_content_codec
+from shared.redis_client import get_redis_cache, init_redis_cache, close_redis_cache
+from shared.token_revocation import get_revocation_list
 from shared.exceptions import (
     LLMProviderException, RateLimitExceededException, InsufficientPermissionsException,
     handle_service_exception
@@ -55,10 +63,29 @@ async def lifespan(app: FastAPI):
     await llm_router.initialize_providers()
     logger.info("✅ LLM providers initialized")
     
+    try:
+        await init_database()
+        await init_content_codec(get_database_manager().db)
+        get_message_buffer().start()
+        logger.info("✅ Database connected")
+    except Exception as e:
+        logger.error(f"❌ Database connection failed: {e}")
+        raise
+    
+    await init_redis_cache()
+    get_revocation_list().start()
+    
     yield
     
     # Shutdown
     logger.info("🔄 Shutting down Chat Service...")
+    # Vaciar el buffer de mensajes antes de cerrar la conexión
+    await get_message_buffer().stop()
+    if conversation_summarizer is not None:
+        await conversation_summarizer.close()
+    await get_revocation_list().stop()
+    await close_database()
+    await close_redis_cache()
     await llm_router.cleanup()
     logger.info("✅ Chat Service stopped")
 
@@ -84,6 +111,26 @@ app.add_middleware(
 llm_router = LLMRouter()
 token_counter = TokenCounter()
 rate_limiter = ChatRateLimiter()
+conversation_repo = ConversationRepository()
+context_builder = ContextBuilder(
+    token_counter,
+    conversation_repo=conversation_repo,
+    redis_cache=get_redis_cache() if settings.CONTEXT_REDIS_ENABLED else None,
+    max_conversations=settings.CONTEXT_CACHE_MAX_CONVERSATIONS,
+    window_max_tokens=settings.CONTEXT_WINDOW_MAX_TOKENS,
+    load_max_messages=settings.CONTEXT_LOAD_MAX_MESSAGES,
+    max_prompt_tokens=settings.CONTEXT_MAX_PROMPT_TOKENS,
+    use_summaries=settings.CONTEXT_SUMMARY_ENABLED
+)
+conversation_summarizer = ConversationSummarizer(
+    llm_router,
+    context_builder,
+    threshold_tokens=settings.CONTEXT_SUMMARY_THRESHOLD_TOKENS,
+    keep_recent_tokens=settings.CONTEXT_SUMMARY_KEEP_RECENT_TOKENS,
+    max_summary_tokens=settings.CONTEXT_SUMMARY_MAX_TOKENS,
+    model=settings.CONTEXT_SUMMARY_MODEL,
+    max_concurrency=settings.CONTEXT_SUMMARY_MAX_CONCURRENCY
+) if settings.CONTEXT_SUMMARY_ENABLED else None
 
 
 # Exception handlers
@@ -113,18 +160,87 @@ async def global_exception_handler(request, exc):
 async def health_check():
     """Health check del servicio"""
     provider_health = await llm_router.check_all_providers_health()
+    db_health = await get_database_manager().health_check()
+    message_buffer = get_message_buffer()
     
     return HealthResponse(
         service="chat-service",
-        status="healthy",
+        status="healthy" if db_health["status"] == "healthy" else "degraded",
         version="1.0.0",
         checks={
             "providers": provider_health,
-            "api_keys_configured": llm_router.get_configured_providers()
+            "api_keys_configured": llm_router.get_configured_providers(),
+            "database": db_health,
+            "message_buffer": {
+                **message_buffer.stats,
+                "pending": message_buffer.pending_count()
+            },
+            "content_compression": get_content_codec().get_stats(),
+            "redis": await get_redis_cache().health_check(),
+            "token_revocation": get_revocation_list().get_stats(),
+            "context_cache": context_builder.get_stats(),
+            "context_summaries": conversation_summarizer.get_stats() if conversation_summarizer else None
         }
     )
 
 
+async def persist_chat_turn(
+    user_id: str,
+    user_plan: str,
+    conversation_id: str,
+    user_message: Message,
+    content: str,
+    model: str,
+    output_tokens: int,
+    cost_estimate: float = 0.0,
+    processing_time: Optional[float] = None
+):
+    """Encolar el turno en el buffer (sin esperar a la BD) y añadirlo al contexto en caché"""
+    message_buffer = get_message_buffer()
+    retention_days = retention_days_for_plan(user_plan)
+    assistant_message = Message(
+        conversation_id=conversation_id,
+        role="assistant",
+        content=content,
+        model_used=model,
+        tokens_used=output_tokens,
+        cost_estimate=cost_estimate,
+        processing_time=processing_time,
+        parent_message_id=user_message.id
+    )
+    message_buffer.add_message(user_id, user_message, retention_days, plan=user_plan)
+    message_buffer.add_message(user_id, assistant_message, retention_days, plan=user_plan)
+    await context_builder.append_turn(user_id, conversation_id, [user_message, assistant_message])
+    if conversation_summarizer is not None:
+        conversation_summarizer.maybe_summarize(user_id, conversation_id)
+
+
+def resolve_conversation_id(chat_request: ChatRequest) -> str:
+    """
+    ID de la conversación del turno, sin consultar la base de datos: la
+    ventana de contexto se lee filtrando por usuario y el buffer solo guarda
+    mensajes de conversaciones que el upsert `{id, user_id}` acepta.
+    """
+    return chat_request.conversation_id or str(uuid.uuid4())
+
+
+async def build_context(
+    user_id: str,
+    chat_request: ChatRequest,
+    conversation_id: str,
+    model: str
+) -> list:
+    """Mensajes para el proveedor con el historial recortado al presupuesto del modelo"""
+    return await context_builder.build_messages(
+        user_id,
+        conversation_id,
+        chat_request.message,
+        llm_router.get_context_budget(model, chat_request.max_tokens),
+        system_prompt=chat_request.system_prompt,
+        new_conversation=chat_request.conversation_id is None
+    )
+
+
 # Endpoints principales
 @app.get("/models", response_model=SuccessResponse)
 async def get_available_models(current_user: dict = Depends(get_current_user)):
@@ -185,6 +301,14 @@ async def chat_completion(
     
     # Contar tokens del mensaje de entrada
     input_tokens = token_counter.count_tokens(chat_request.message)
+    conversation_id = resolve_conversation_id(chat_request)
+    user_message = Message(
+        conversation_id=conversation_id,
+        role="user",
+        content=chat_request.message,
+        tokens_used=input_tokens,
+        metadata={"system_prompt": chat_request.system_prompt} if chat_request.system_prompt else {}
+    )
     
     # Verificar límites de tokens diarios
     if not await rate_limiter.check_daily_token_limit(user_id, user_plan, input_tokens):
@@ -206,10 +330,12 @@ async def chat_completion(
     try:
         # Procesar chat
         start_time = time.time()
+        context = await build_context(user_id, chat_request, conversation_id, selected_model)
         response = await llm_router.process_chat_request(
             chat_request,
             selected_model,
-            user_id
+            user_id,
+            context
         )
         processing_time = time.time() - start_time
         
@@ -227,6 +353,11 @@ async def chat_completion(
         # Actualizar contadores de rate limiting
         await rate_limiter.update_counters(user_id, total_tokens)
         
+        await persist_chat_turn(
+            user_id, user_plan, conversation_id, user_message, response["message"],
+            selected_model, output_tokens, cost_estimate, processing_time
+        )
+        
         logger.info(f"Chat completed for user {user_id}: {total_tokens} tokens, ${cost_estimate:.4f}")
         
         return SuccessResponse(
@@ -238,7 +369,7 @@ async def chat_completion(
                 "input_tokens": input_tokens,
                 "output_tokens": output_tokens,
                 "cost_estimate": cost_estimate,
-                "conversation_id": response.get("conversation_id"),
+                "conversation_id": conversation_id,
                 "processing_time": processing_time
             }
         )
@@ -266,6 +397,14 @@ async def chat_stream(
     
     # Forzar streaming
     chat_request.stream = True
+    conversation_id = resolve_conversation_id(chat_request)
+    user_message = Message(
+        conversation_id=conversation_id,
+        role="user",
+        content=chat_request.message,
+        tokens_used=token_counter.count_tokens(chat_request.message),
+        metadata={"system_prompt": chat_request.system_prompt} if chat_request.system_prompt else {}
+    )
     
     # Seleccionar modelo
     selected_model = chat_request.model or await llm_router.select_optimal_model(
@@ -279,14 +418,21 @@ async def chat_stream(
             f"Your plan does not include access to {selected_model}"
         )
     
+    context = await build_context(user_id, chat_request, conversation_id, selected_model)
+    
     async def generate_stream():
         """Generar stream de respuesta"""
+        parts = []
+        start_time = time.time()
         try:
             async for chunk in llm_router.process_chat_stream(
                 chat_request,
                 selected_model,
-                user_id
+                user_id,
+                context
             ):
+                parts.append(chunk.get("delta") or "")
+                chunk["conversation_id"] = conversation_id
                 yield f"data: {json.dumps(chunk)}\n\n"
         except Exception as e:
             error_chunk = {
@@ -295,6 +441,14 @@ async def chat_stream(
             }
             yield f"data: {json.dumps(error_chunk)}\n\n"
         finally:
+            # Persistir también respuestas parciales (cliente desconectado)
+            content = "".join(parts)
+            if content:
+                await persist_chat_turn(
+                    user_id, user_plan, conversation_id, user_message, content, selected_model,
+                    token_counter.count_tokens(content),
+                    processing_time=time.time() - start_time
+                )
             yield "data: [DONE]\n\n"
     
     return StreamingResponse(
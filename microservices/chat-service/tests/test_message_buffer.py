@@ -0,0 +1,162 @@
+"""
+Flush del buffer de mensajes con repositorios en memoria
+
+Los informes de escritura tienen la forma de `BaseRepository._bulk_write`:
+`{"succeeded": n, "failed": [{"index", "id", "code", "message", "transient"}]}`.
+"""
+
+import asyncio
+
+import pytest
+
+import shared.history_store as history_store
+from shared.history_store import DUPLICATE_KEY_ERROR, MessagePersistenceBuffer, ConversationRepository
+from shared.models import Message
+
+
+class NoBlobs:
+    async def externalize(self, documents):
+        return documents
+
+
+class MemoryMessageRepository:
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.documents = {}
+        self.discarded = []
+
+    async def create_many(self, documents):
+        failed = []
+        for index, document in enumerate(documents):
+            if document["id"] in self.fail_ids:
+                failed.append({
+                    "index": index, "id": document["id"], "code": 121,
+                    "message": "Document failed validation", "transient": False
+                })
+            else:
+                self.documents[document["id"]] = document
+        return {"succeeded": len(documents) - len(failed), "failed": failed}
+
+    async def discard(self, message_ids):
+        self.discarded.extend(message_ids)
+        return sum(1 for id in message_ids if self.documents.pop(id, None) is not None)
+
+
+class MemoryConversationRepository:
+    def __init__(self, owners=None):
+        self.owners = dict(owners or {})
+        self.counters = {}
+
+    async def apply_deltas(self, deltas):
+        failed = []
+        for index, (conversation_id, delta) in enumerate(deltas.items()):
+            owner = self.owners.setdefault(conversation_id, delta["user_id"])
+            if owner != delta["user_id"]:
+                failed.append({
+                    "index": index, "id": conversation_id, "code": DUPLICATE_KEY_ERROR,
+                    "message": "E11000 duplicate key", "transient": False
+                })
+                continue
+            counters = self.counters.setdefault(conversation_id, {"message_count": 0, "total_tokens": 0})
+            counters["message_count"] += delta["message_count"]
+            counters["total_tokens"] += delta["total_tokens"]
+        return {"succeeded": len(deltas) - len(failed), "failed": failed}
+
+
+@pytest.fixture(autouse=True)
+def no_blob_store(monkeypatch):
+    monkeypatch.setattr(history_store, "get_blob_store", lambda: NoBlobs())
+
+
+def _message(conversation_id, n, tokens=10):
+    return Message(conversation_id=conversation_id, role="user", content=f"message {n}", tokens_used=tokens)
+
+
+def test_messages_of_another_users_conversation_are_discarded():
+    messages = MemoryMessageRepository()
+    conversations = MemoryConversationRepository(owners={"taken": "owner"})
+    buffer = MessagePersistenceBuffer(messages, conversations)
+    buffer.add_message("intruder", _message("taken", 1))
+    buffer.add_message("intruder", _message("mine", 2))
+
+    asyncio.run(buffer.flush())
+
+    assert [document["conversation_id"] for document in messages.documents.values()] == ["mine"]
+    assert len(messages.discarded) == 1
+    assert "taken" not in conversations.counters
+    assert buffer.stats["messages_dropped"] == 1
+    assert buffer.stats["conversation_updates_dropped"] == 1
+    assert buffer.pending_count() == 0 and not buffer._deltas
+
+
+def test_pending_conversation_is_not_shared_between_users():
+    messages = MemoryMessageRepository()
+    buffer = MessagePersistenceBuffer(messages, MemoryConversationRepository())
+    buffer.add_message("first", _message("new", 1))
+    buffer.add_message("second", _message("new", 2))
+
+    asyncio.run(buffer.flush())
+
+    assert [document["user_id"] for document in messages.documents.values()] == ["first"]
+    assert buffer.stats["messages_dropped"] == 1
+
+
+def test_permanently_dropped_messages_are_not_counted():
+    kept, rejected, alone = _message("c1", 1, tokens=10), _message("c1", 2, tokens=25), _message("c2", 3)
+    messages = MemoryMessageRepository(fail_ids={rejected.id, alone.id})
+    conversations = MemoryConversationRepository()
+    buffer = MessagePersistenceBuffer(messages, conversations)
+    for message in (kept, rejected, alone):
+        buffer.add_message("user", message)
+
+    asyncio.run(buffer.flush())
+
+    assert conversations.counters == {"c1": {"message_count": 1, "total_tokens": 10}}
+    # Sin mensajes guardados no se crea la conversación
+    assert "c2" not in conversations.owners
+    assert buffer.stats["messages_dropped"] == 2
+
+
+def test_blob_referencing_messages_are_left_out_of_the_ttl(monkeypatch):
+    class ContentBlobs:
+        async def externalize(self, documents):
+            for document in documents:
+                if document["content"].startswith("large"):
+                    document["content"] = ""
+                    document["blob_refs"] = {"content": "digest"}
+
+    monkeypatch.setattr(history_store, "get_blob_store", lambda: ContentBlobs())
+    messages = MemoryMessageRepository()
+    buffer = MessagePersistenceBuffer(messages, MemoryConversationRepository())
+    large = Message(conversation_id="c1", role="user", content="large message", tokens_used=1)
+    small = _message("c1", 1)
+    buffer.add_message("user", large, retention_days=30)
+    buffer.add_message("user", small, retention_days=30)
+
+    asyncio.run(buffer.flush())
+
+    assert "expire_at" not in messages.documents[large.id]
+    assert "expire_at" in messages.documents[small.id]
+
+
+def test_unlimited_plan_clears_the_previous_retention(monkeypatch):
+    repository = ConversationRepository()
+    operations = []
+
+    async def capture(batch):
+        operations.extend(operation for _, operation, _ in batch)
+        return {"succeeded": len(batch), "failed": []}
+
+    monkeypatch.setattr(repository, "_bulk_write", capture)
+    message = _message("c1", 1)
+    delta = {
+        "user_id": "user", "message_count": 1, "total_tokens": 10,
+        "first_message_at": message.created_at, "last_message_at": message.created_at,
+        "models_used": set(), "title": None, "retention_until": None, "plan": "enterprise"
+    }
+
+    asyncio.run(repository.apply_deltas({"c1": delta}))
+
+    update = operations[0]._doc
+    assert update["$set"] == {"retention_until": None, "plan": "enterprise"}
+    assert "retention_until" not in update["$setOnInsert"]
@@ -0,0 +1,198 @@
+"""
+Resumen incremental de conversaciones
+
+El router es un stub (`summarize` y `calculate_cost`) y la conversación se
+guarda en un repositorio en memoria, así que no hace falta MongoDB, Redis ni
+proveedores LLM.
+"""
+
+from datetime import datetime, timedelta
+import asyncio
+
+import pytest
+
+from shared.models import Message
+from utils.context_builder import ContextBuilder, SUMMARY_PREFIX
+from utils.summarizer import ConversationSummarizer
+from utils.token_counter import TokenCounter
+
+USER_ID = "user-1"
+CONVERSATION_ID = "conv-1"
+START = datetime(2024, 1, 1)
+
+
+class StubRouter:
+    """`LLMRouter` reducido a lo que usa el resumidor"""
+
+    def __init__(self, summary: str = "Resumen de los turnos anteriores"):
+        self.summary = summary
+        self.calls = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.error = None
+
+    async def summarize(self, transcript: str, max_tokens: int, model=None):
+        self.calls.append(transcript)
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return {"message": f" {self.summary} ", "model": "cheap-model", "input_tokens": 300, "output_tokens": 20}
+
+    async def calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        return 0.0005
+
+
+class MemoryConversationRepository:
+    def __init__(self):
+        self.summaries = []
+
+    async def set_summary(self, conversation_id, user_id, summary, summary_until, summarized_tokens):
+        self.summaries.append((conversation_id, user_id, summary, summary_until, summarized_tokens))
+        return True
+
+
+def _turn(n: int) -> list:
+    created_at = START + timedelta(minutes=n)
+    return [
+        Message(conversation_id=CONVERSATION_ID, role="user", content=f"question {n} " * 30,
+                tokens_used=60, created_at=created_at),
+        Message(conversation_id=CONVERSATION_ID, role="assistant", content=f"answer {n} " * 30,
+                tokens_used=60, created_at=created_at + timedelta(seconds=30)),
+    ]
+
+
+def _setup(router=None, window_max_tokens=32000):
+    repository = MemoryConversationRepository()
+    builder = ContextBuilder(
+        TokenCounter(),
+        message_repo=object(),
+        conversation_repo=repository,
+        window_max_tokens=window_max_tokens,
+        use_summaries=True
+    )
+    summarizer = ConversationSummarizer(
+        router or StubRouter(),
+        builder,
+        conversation_repo=repository,
+        threshold_tokens=500,
+        keep_recent_tokens=200
+    )
+    return builder, summarizer, repository
+
+
+async def _add_turns(builder, turns):
+    await builder.build_messages(USER_ID, CONVERSATION_ID, "hi", 4000, new_conversation=True)
+    for n in turns:
+        await builder.append_turn(USER_ID, CONVERSATION_ID, _turn(n))
+
+
+async def _wait(summarizer):
+    await asyncio.gather(*list(summarizer._tasks.values()))
+
+
+def test_threshold_triggers_a_single_summary():
+    async def scenario():
+        builder, summarizer, _ = _setup()
+        await _add_turns(builder, range(1))
+        assert builder.peek_window(USER_ID, CONVERSATION_ID).total_tokens < 500
+        assert not summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+
+        for n in range(1, 8):
+            await builder.append_turn(USER_ID, CONVERSATION_ID, _turn(n))
+        assert summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        # Ya hay uno en curso para la conversación
+        assert not summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        assert summarizer.get_stats()["in_progress"] == 1
+        await _wait(summarizer)
+        return summarizer
+
+    summarizer = asyncio.run(scenario())
+    assert summarizer.stats["summaries"] == 1
+    assert summarizer.get_stats()["in_progress"] == 0
+
+
+def test_apply_summary_replaces_covered_turns():
+    async def scenario():
+        router = StubRouter()
+        builder, summarizer, repository = _setup(router)
+        await _add_turns(builder, range(8))
+        before = list(builder.peek_window(USER_ID, CONVERSATION_ID).entries())
+        covered = builder.peek_window(USER_ID, CONVERSATION_ID).older_than(200)
+
+        summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        await _wait(summarizer)
+        messages = await builder.build_messages(USER_ID, CONVERSATION_ID, "next", 4000)
+        return router, builder, repository, before, covered, messages
+
+    router, builder, repository, before, covered, messages = asyncio.run(scenario())
+    entries = builder.peek_window(USER_ID, CONVERSATION_ID).entries()
+
+    assert entries[0]["summary"] is True
+    assert entries[0]["content"] == router.summary
+    assert entries[0]["summarized_tokens"] == sum(entry["tokens"] for entry in covered)
+    # Los turnos recientes se conservan tal cual detrás del resumen
+    assert entries[1:] == before[len(covered):]
+    assert "question 0" in router.calls[0]
+
+    assert repository.summaries == [(
+        CONVERSATION_ID, USER_ID, router.summary, covered[-1]["created_at"],
+        entries[0]["summarized_tokens"]
+    )]
+    assert messages[0] == {"role": "system", "content": SUMMARY_PREFIX + router.summary}
+    assert messages[-1] == {"role": "user", "content": "next"}
+
+
+def test_summary_discarded_when_window_changes_meanwhile():
+    async def scenario():
+        router = StubRouter()
+        router.release.clear()
+        builder, summarizer, repository = _setup(router, window_max_tokens=600)
+        await _add_turns(builder, range(5))
+        summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        await asyncio.sleep(0)
+        assert router.calls
+
+        # Turnos nuevos recortan la ventana más allá de lo que se estaba resumiendo
+        for n in range(5, 10):
+            await builder.append_turn(USER_ID, CONVERSATION_ID, _turn(n))
+        router.release.set()
+        await _wait(summarizer)
+        return builder, summarizer, repository
+
+    builder, summarizer, repository = asyncio.run(scenario())
+
+    assert summarizer.stats["discarded"] == 1
+    assert summarizer.stats["summaries"] == 0
+    assert repository.summaries == []
+    assert not any(entry.get("summary") for entry in builder.peek_window(USER_ID, CONVERSATION_ID).entries())
+
+
+def test_stats():
+    async def scenario():
+        router = StubRouter()
+        builder, summarizer, _ = _setup(router)
+        await _add_turns(builder, range(8))
+        covered = builder.peek_window(USER_ID, CONVERSATION_ID).older_than(200)
+        summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        await _wait(summarizer)
+        await builder.build_messages(USER_ID, CONVERSATION_ID, "next", 4000)
+
+        router.error = RuntimeError("provider down")
+        for n in range(8, 16):
+            await builder.append_turn(USER_ID, CONVERSATION_ID, _turn(n))
+        summarizer.maybe_summarize(USER_ID, CONVERSATION_ID)
+        await _wait(summarizer)
+        return builder, summarizer, covered
+
+    builder, summarizer, covered = asyncio.run(scenario())
+    stats = summarizer.get_stats()
+    summary_entry = builder.peek_window(USER_ID, CONVERSATION_ID).entries()[0]
+
+    assert stats["summaries"] == 1
+    assert stats["errors"] == 1
+    assert stats["summarized_messages"] == len(covered)
+    assert stats["tokens_before"] == sum(entry["tokens"] for entry in covered)
+    assert stats["tokens_after"] == summary_entry["tokens"]
+    assert stats["cost_estimate"] == pytest.approx(0.0005)
+    assert stats["prompt_tokens_saved"] == summary_entry["summarized_tokens"] - summary_entry["tokens"]
+    assert stats["avg_prompt_tokens_saved_per_turn"] == stats["prompt_tokens_saved"]
@@ -0,0 +1,397 @@
+"""
+Construcción del contexto de conversación para los proveedores LLM
+
+Cada conversación tiene una ventana en caché con sus mensajes recientes y
+los tokens acumulados (sumas prefijas), así que:
+
+- añadir un turno cuesta O(turno): solo se tokeniza lo nuevo;
+- recortar al presupuesto del modelo es una búsqueda binaria sobre las
+  sumas prefijas (se descartan los más antiguos primero);
+- la conversación solo se lee de MongoDB si no está en memoria ni en Redis.
+
+La capa Redis (opcional, namespace `context` del cliente compartido) reparte
+las ventanas entre réplicas: una lista por conversación más un contador de
+versión; una ventana en memoria solo se usa si su versión coincide con la de
+Redis.
+
+Con resúmenes activados, los turnos antiguos pueden sustituirse por una
+entrada de resumen al principio de la ventana (ver `utils/summarizer.py`);
+el resumen se guarda en la conversación y se usa también en la carga en frío.
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+from collections import OrderedDict
+from datetime import datetime
+from bisect import bisect_left
+import json
+import logging
+
+try:
+    from redis.exceptions import WatchError
+except ImportError:  # pragma: no cover - dependencia opcional
+    WatchError = None
+
+# Imports compartidos
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from shared.models import Message
+from shared.history_store import ConversationRepository, MessageRepository
+from shared.redis_client import RedisCache
+
+from .token_counter import TokenCounter
+
+logger = logging.getLogger(__name__)
+
+# Tokens de formato por mensaje (rol y separadores del chat)
+MESSAGE_OVERHEAD_TOKENS = 4
+REDIS_NAMESPACE = "context"
+SUMMARY_PREFIX = "Resumen de la conversación anterior:\n"
+
+
+def _encode_entry(entry: Dict[str, Any]) -> str:
+    created_at = entry.get("created_at")
+    if isinstance(created_at, datetime):
+        entry = {**entry, "created_at": created_at.isoformat()}
+    return json.dumps(entry)
+
+
+def _decode_entry(raw: bytes) -> Dict[str, Any]:
+    entry = json.loads(raw)
+    if entry.get("created_at"):
+        entry["created_at"] = datetime.fromisoformat(entry["created_at"])
+    return entry
+
+
+class ContextWindow:
+    """Mensajes recientes de una conversación con tokens acumulados"""
+
+    def __init__(self, version: int = 0):
+        self.messages: List[Dict[str, Any]] = []
+        # prefix[i] = tokens de messages[:i]
+        self.prefix: List[int] = [0]
+        self.start = 0
+        self.version = version
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prefix[-1] - self.prefix[self.start]
+
+    def __len__(self) -> int:
+        return len(self.messages) - self.start
+
+    def append(self, role: str, content: str, tokens: int, **fields):
+        """Añadir un mensaje (tokens ya contados)"""
+        self.messages.append({"role": role, "content": content, "tokens": tokens, **fields})
+        self.prefix.append(self.prefix[-1] + tokens)
+
+    def _tail_start(self, budget: int) -> int:
+        # Primer índice cuyo sufijo cabe en el presupuesto
+        return bisect_left(self.prefix, self.prefix[-1] - budget, lo=self.start, hi=len(self.messages))
+
+    def trim(self, max_tokens: int) -> int:
+        """Descartar los mensajes más antiguos hasta caber en `max_tokens`"""
+        start = self._tail_start(max_tokens)
+        dropped = start - self.start
+        self.start = start
+        # Compactar de vez en cuando: coste amortizado O(1) por mensaje
+        if self.start > 64 and self.start * 2 > len(self.messages):
+            base = self.prefix[self.start]
+            self.messages = self.messages[self.start:]
+            self.prefix = [value - base for value in self.prefix[self.start:]]
+            self.start = 0
+        return dropped
+
+    def tail(self, budget: int) -> List[Dict[str, Any]]:
+        """Los mensajes más recientes que caben en `budget` tokens"""
+        if budget <= 0:
+            return []
+        return self.messages[self._tail_start(budget):]
+
+    def entries(self) -> List[Dict[str, Any]]:
+        return self.messages[self.start:]
+
+    def older_than(self, keep_tokens: int) -> List[Dict[str, Any]]:
+        """Mensajes que quedan fuera de los `keep_tokens` más recientes"""
+        return self.messages[self.start:self._tail_start(keep_tokens)]
+
+
+class ContextBuilder:
+    """Ventanas de contexto por conversación en memoria, Redis y MongoDB"""
+
+    def __init__(
+        self,
+        token_counter: TokenCounter = None,
+        message_repo: MessageRepository = None,
+        conversation_repo: ConversationRepository = None,
+        redis_cache: Optional[RedisCache] = None,
+        max_conversations: int = 10000,
+        window_max_tokens: int = 32000,
+        load_max_messages: int = 200,
+        max_prompt_tokens: Optional[int] = None,
+        use_summaries: bool = False
+    ):
+        self.token_counter = token_counter or TokenCounter()
+        self.message_repo = message_repo or MessageRepository()
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.max_conversations = max_conversations
+        self.window_max_tokens = window_max_tokens
+        self.load_max_messages = load_max_messages
+        self.max_prompt_tokens = max_prompt_tokens
+        self.use_summaries = use_summaries
+        self.redis_cache = redis_cache if redis_cache is not None and redis_cache.enabled else None
+        self.redis = self.redis_cache.client(REDIS_NAMESPACE) if self.redis_cache else None
+        self.redis_ttl_seconds = self.redis_cache.default_ttl(REDIS_NAMESPACE) if self.redis_cache else None
+        self._windows: "OrderedDict[Tuple[str, str], ContextWindow]" = OrderedDict()
+        self.stats = {
+            "memory_hits": 0,
+            "redis_hits": 0,
+            "cold_loads": 0,
+            "trimmed_messages": 0,
+            "redis_errors": 0,
+            "summarized_prompts": 0,
+            "prompt_tokens_saved": 0
+        }
+
+    def message_tokens(self, content: str) -> int:
+        """Tokens de un mensaje incluyendo el formato del chat"""
+        return self.token_counter.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    # Claves Redis: la ventana es del usuario, no solo de la conversación
+    def _redis_keys(self, user_id: str, conversation_id: str) -> Tuple[str, str]:
+        key = self.redis_cache.key(REDIS_NAMESPACE, f"{user_id}:{conversation_id}")
+        return key, f"{key}:version"
+
+    def _remember(self, key: Tuple[str, str], window: ContextWindow):
+        self._windows[key] = window
+        self._windows.move_to_end(key)
+        while len(self._windows) > self.max_conversations:
+            self._windows.popitem(last=False)
+
+    async def _load_from_redis(self, user_id: str, conversation_id: str, cached: Optional[ContextWindow]):
+        list_key, version_key = self._redis_keys(user_id, conversation_id)
+        version = await self.redis.get(version_key)
+        if version is None:
+            return None
+        if cached is not None and cached.version == int(version):
+            return cached
+        window = ContextWindow(int(version))
+        for raw in await self.redis.lrange(list_key, 0, -1):
+            window.append(**_decode_entry(raw))
+        return window
+
+    async def _load_from_database(self, user_id: str, conversation_id: str) -> ContextWindow:
+        window = ContextWindow()
+        summary_until = None
+        if self.use_summaries:
+            conversation = await self.conversation_repo.get_for_user(
+                conversation_id, user_id,
+                {"_id": 0, "summary": 1, "summary_until": 1, "summarized_tokens": 1}
+            )
+            if conversation and conversation.get("summary"):
+                summary_until = conversation["summary_until"]
+                window.append(**self.summary_entry(
+                    conversation["summary"], summary_until, conversation.get("summarized_tokens", 0)
+                ))
+        messages = await self.message_repo.list_recent_for_user(
+            conversation_id, user_id, self.load_max_messages, after=summary_until
+        )
+        for message in messages:
+            window.append(
+                message["role"], message["content"], self.message_tokens(message["content"]),
+                created_at=message.get("created_at")
+            )
+        self.stats["trimmed_messages"] += window.trim(self.window_max_tokens)
+        return window
+
+    async def get_window(self, user_id: str, conversation_id: str) -> ContextWindow:
+        """Ventana de la conversación: memoria, luego Redis, luego MongoDB"""
+        key = (user_id, conversation_id)
+        cached = self._windows.get(key)
+
+        if self.redis is not None:
+            try:
+                window = await self._load_from_redis(user_id, conversation_id, cached)
+                if window is not None:
+                    self.stats["memory_hits" if window is cached else "redis_hits"] += 1
+                    self._remember(key, window)
+                    return window
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning(f"Context cache Redis read failed: {e}")
+                if cached is not None:
+                    return cached
+        elif cached is not None:
+            self.stats["memory_hits"] += 1
+            self._windows.move_to_end(key)
+            return cached
+
+        window = await self._load_from_database(user_id, conversation_id)
+        self.stats["cold_loads"] += 1
+        self._remember(key, window)
+        if self.redis is not None and len(window):
+            await self._write_redis(user_id, conversation_id, window, window.entries(), replace=True)
+        return window
+
+    async def build_messages(
+        self,
+        user_id: str,
+        conversation_id: Optional[str],
+        user_message: str,
+        max_context_tokens: int,
+        system_prompt: Optional[str] = None,
+        new_conversation: bool = False
+    ) -> List[Dict[str, str]]:
+        """
+        Lista de mensajes para el proveedor: system prompt, historial reciente
+        que quepa en `max_context_tokens` y el mensaje nuevo.
+        """
+        if self.max_prompt_tokens:
+            max_context_tokens = min(max_context_tokens, self.max_prompt_tokens)
+        budget = max_context_tokens - self.message_tokens(user_message)
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+            budget -= self.message_tokens(system_prompt)
+
+        if new_conversation:
+            self._remember((user_id, conversation_id), ContextWindow())
+        elif conversation_id:
+            window = await self.get_window(user_id, conversation_id)
+            for entry in window.tail(budget):
+                if entry.get("summary"):
+                    self.stats["summarized_prompts"] += 1
+                    self.stats["prompt_tokens_saved"] += entry["summarized_tokens"] - entry["tokens"]
+                    messages.append({"role": "system", "content": SUMMARY_PREFIX + entry["content"]})
+                else:
+                    messages.append({"role": entry["role"], "content": entry["content"]})
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    async def append_turn(self, user_id: str, conversation_id: str, turn: List[Message]):
+        """Añadir los mensajes del turno (con `tokens_used` ya contados) a la ventana en caché"""
+        window = self._windows.get((user_id, conversation_id))
+        if window is None:
+            # Expulsada durante el turno: la próxima lectura la recarga de MongoDB
+            if self.redis is not None:
+                try:
+                    await self.redis.delete(*self._redis_keys(user_id, conversation_id))
+                except Exception as e:
+                    self.stats["redis_errors"] += 1
+                    logger.warning(f"Context cache Redis invalidation failed: {e}")
+            return
+        entries = []
+        for message in turn:
+            window.append(
+                message.role, message.content, message.tokens_used + MESSAGE_OVERHEAD_TOKENS,
+                created_at=message.created_at
+            )
+            entries.append(window.messages[-1])
+        self.stats["trimmed_messages"] += window.trim(self.window_max_tokens)
+
+        if self.redis is not None:
+            await self._write_redis(user_id, conversation_id, window, entries)
+
+    def peek_window(self, user_id: str, conversation_id: str) -> Optional[ContextWindow]:
+        """Ventana en memoria, si la hay (sin recargarla ni cambiar el LRU)"""
+        return self._windows.get((user_id, conversation_id))
+
+    def summary_entry(self, summary: str, created_at: Optional[datetime], summarized_tokens: int) -> Dict[str, Any]:
+        """Entrada de ventana para un resumen de los turnos anteriores a `created_at`"""
+        return {
+            "role": "system",
+            "content": summary,
+            "tokens": self.message_tokens(SUMMARY_PREFIX + summary),
+            "created_at": created_at,
+            "summary": True,
+            "summarized_tokens": summarized_tokens
+        }
+
+    async def apply_summary(
+        self,
+        user_id: str,
+        conversation_id: str,
+        covered: List[Dict[str, Any]],
+        summary: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Sustituir por `summary` los mensajes de la ventana hasta el último de
+        `covered`. Devuelve la entrada del resumen, o None si la ventana
+        cambió de forma incompatible mientras se resumía.
+        """
+        key = (user_id, conversation_id)
+        window = self._windows.get(key)
+        if window is None or window.version == -1:
+            return None
+        live = window.entries()
+        last = next((i for i, entry in enumerate(live) if entry is covered[-1]), None)
+        if last is None:
+            return None
+
+        summarized_tokens = sum(entry.get("summarized_tokens", entry["tokens"]) for entry in live[:last + 1])
+        entry = self.summary_entry(summary, covered[-1].get("created_at"), summarized_tokens)
+        replacement = ContextWindow(window.version)
+        for item in [entry, *live[last + 1:]]:
+            replacement.append(**item)
+
+        if self.redis is not None:
+            length = len(window.messages)
+            if not await self._write_redis(
+                user_id, conversation_id, replacement, replacement.entries(),
+                replace=True, expected_version=window.version
+            ):
+                return None
+            if len(window.messages) != length:
+                # Turno añadido durante la escritura: la próxima lectura recarga de Redis
+                self._windows.pop(key, None)
+                return entry
+        self._remember(key, replacement)
+        return entry
+
+    async def _write_redis(
+        self,
+        user_id: str,
+        conversation_id: str,
+        window: ContextWindow,
+        entries: List[Dict[str, Any]],
+        replace: bool = False,
+        expected_version: Optional[int] = None
+    ) -> bool:
+        list_key, version_key = self._redis_keys(user_id, conversation_id)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                if expected_version is not None:
+                    # Reemplazo optimista: se aborta si otra réplica escribió antes
+                    await pipe.watch(version_key)
+                    if int(await pipe.get(version_key) or 0) != expected_version:
+                        await pipe.reset()
+                        return False
+                    pipe.multi()
+                if replace:
+                    pipe.delete(list_key)
+                pipe.rpush(list_key, *(_encode_entry(entry) for entry in entries))
+                pipe.ltrim(list_key, -max(len(window), 1), -1)
+                pipe.incr(version_key)
+                pipe.expire(list_key, self.redis_ttl_seconds)
+                pipe.expire(version_key, self.redis_ttl_seconds)
+                results = await pipe.execute()
+            version = results[3 if replace else 2]
+            # Otra réplica escribió en medio: la ventana local está incompleta
+            window.version = version if replace or version == window.version + 1 else -1
+            return True
+        except Exception as e:
+            if WatchError is not None and isinstance(e, WatchError):
+                return False
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Context cache Redis write failed: {e}")
+            return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas de la caché de contexto"""
+        stats = {**self.stats, "cached_conversations": len(self._windows), "redis": self.redis is not None}
+        if self.stats["summarized_prompts"]:
+            stats["avg_prompt_tokens_saved"] = round(
+                self.stats["prompt_tokens_saved"] / self.stats["summarized_prompts"], 1
+            )
+        return stats
@@ -0,0 +1,134 @@
+"""
+Resumen incremental de conversaciones largas
+
+Cuando la ventana en caché de una conversación supera `threshold_tokens`,
+los turnos anteriores a los `keep_recent_tokens` más recientes se resumen en
+segundo plano con el modelo más barato del router. El resumen sustituye a
+esos turnos en la ventana (ver `ContextBuilder.apply_summary`) y se guarda en
+la conversación para las cargas en frío. Un resumen previo entra en la
+transcripción del siguiente, así que el resumen es acumulado.
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+import asyncio
+import logging
+
+# Imports compartidos
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from shared.history_store import ConversationRepository
+
+from llm_providers.router import LLMRouter
+from .context_builder import ContextBuilder
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """Compacta el contexto de conversaciones largas con resúmenes en segundo plano"""
+
+    def __init__(
+        self,
+        llm_router: LLMRouter,
+        context_builder: ContextBuilder,
+        conversation_repo: ConversationRepository = None,
+        threshold_tokens: int = 6000,
+        keep_recent_tokens: int = 2000,
+        max_summary_tokens: int = 500,
+        model: Optional[str] = None,
+        max_concurrency: int = 4
+    ):
+        self.llm_router = llm_router
+        self.context_builder = context_builder
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent_tokens = keep_recent_tokens
+        self.max_summary_tokens = max_summary_tokens
+        self.model = model
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.stats = {
+            "summaries": 0,
+            "summarized_messages": 0,
+            "tokens_before": 0,
+            "tokens_after": 0,
+            "discarded": 0,
+            "errors": 0,
+            "cost_estimate": 0.0
+        }
+
+    def maybe_summarize(self, user_id: str, conversation_id: str) -> bool:
+        """Programar un resumen si la ventana supera el umbral (no bloquea)"""
+        key = (user_id, conversation_id)
+        window = self.context_builder.peek_window(user_id, conversation_id)
+        if window is None or window.total_tokens < self.threshold_tokens or key in self._tasks:
+            return False
+        task = asyncio.create_task(self._summarize(user_id, conversation_id))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return True
+
+    def _transcript(self, entries: List[Dict[str, Any]]) -> str:
+        lines = []
+        for entry in entries:
+            label = "Resumen previo" if entry.get("summary") else entry["role"]
+            lines.append(f"{label}: {entry['content']}")
+        return "\n\n".join(lines)
+
+    async def _summarize(self, user_id: str, conversation_id: str):
+        async with self._semaphore:
+            window = self.context_builder.peek_window(user_id, conversation_id)
+            if window is None:
+                return
+            covered = window.older_than(self.keep_recent_tokens)
+            # Nada que compactar: un único mensaje o solo el resumen anterior
+            if len(covered) < 2 or not covered[-1].get("created_at"):
+                return
+            tokens_before = sum(entry["tokens"] for entry in covered)
+
+            try:
+                result = await self.llm_router.summarize(
+                    self._transcript(covered), self.max_summary_tokens, self.model
+                )
+                summary = result["message"].strip()
+                entry = await self.context_builder.apply_summary(user_id, conversation_id, covered, summary)
+                if entry is None:
+                    self.stats["discarded"] += 1
+                    return
+                await self.conversation_repo.set_summary(
+                    conversation_id, user_id, summary, entry["created_at"], entry["summarized_tokens"]
+                )
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Failed to summarize conversation {conversation_id}: {e}")
+                return
+
+            self.stats["summaries"] += 1
+            self.stats["summarized_messages"] += len(covered)
+            self.stats["tokens_before"] += tokens_before
+            self.stats["tokens_after"] += entry["tokens"]
+            self.stats["cost_estimate"] += await self.llm_router.calculate_cost(
+                result["model"], result.get("input_tokens", 0), result.get("output_tokens", 0)
+            )
+            logger.info(
+                f"Conversation {conversation_id} summarized with {result['model']}: "
+                f"{len(covered)} messages, {tokens_before} -> {entry['tokens']} prompt tokens"
+            )
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas de los resúmenes y tokens de prompt ahorrados por turno"""
+        stats = {**self.stats, "in_progress": len(self._tasks)}
+        stats["cost_estimate"] = round(stats["cost_estimate"], 6)
+        context_stats = self.context_builder.get_stats()
+        stats["prompt_tokens_saved"] = context_stats["prompt_tokens_saved"]
+        stats["avg_prompt_tokens_saved_per_turn"] = context_stats.get("avg_prompt_tokens_saved")
+        return stats
+
+    async def close(self):
+        """Cancelar los resúmenes en curso"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
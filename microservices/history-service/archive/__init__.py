@@ -0,0 +1,3 @@
+"""
+Archivo en frío de conversaciones
+"""
@@ -0,0 +1,247 @@
+"""
+Archivado en frío de conversaciones inactivas
+
+Las conversaciones sin mensajes nuevos desde `archive_after_days` (según el
+plan) se mueven a segmentos locales: se escribe el registro, se marca el
+stub en `conversations` (`archived_at`, `archived_until`) y se borran los
+mensajes de MongoDB. El stub solo se marca si `last_message_at` no cambió
+desde la lectura, y los mensajes se borran por `id`, así que un mensaje que
+llegue durante el archivado nunca se pierde.
+
+Las lecturas son transparentes: `iter_messages` combina el registro
+archivado con los mensajes en caliente, y `fault_in` devuelve la
+conversación a MongoDB cuando hace falta paginarla. Una conversación
+recuperada para leerla lleva `restored_at` y no se vuelve a archivar hasta
+que pase de nuevo el plazo de inactividad.
+"""
+
+from typing import Optional, Dict, Any
+from datetime import datetime, timedelta
+import asyncio
+import logging
+
+from shared.config import SubscriptionPlans
+from shared.content_codec import get_content_codec, STORAGE_FIELDS
+from shared.blob_store import get_blob_store, BLOB_REFS_FIELD
+from shared.exceptions import BaseServiceException
+from shared.history_store import ConversationRepository, MessageRepository, DUPLICATE_KEY_ERROR
+
+from .segments import SegmentStore
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PLANS = (SubscriptionPlans.FREE, SubscriptionPlans.PREMIUM, SubscriptionPlans.ENTERPRISE)
+# Campos de mensaje que devuelve `iter_messages` (los mismos que la exportación)
+MESSAGE_FIELDS = [
+    field for field in MessageRepository.projections["export"]
+    if field != "_id" and field not in STORAGE_FIELDS and not field.startswith(BLOB_REFS_FIELD)
+]
+
+
+class ConversationArchiver:
+    """Mueve conversaciones inactivas a segmentos y las recupera al leerlas"""
+
+    def __init__(
+        self,
+        store: SegmentStore,
+        conversation_repo: ConversationRepository = None,
+        message_repo: MessageRepository = None,
+        batch_size: int = 100,
+        read_batch_size: int = 500,
+        interval_seconds: float = 3600.0,
+        compaction_min_live_ratio: float = 0.5
+    ):
+        self.store = store
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.message_repo = message_repo or MessageRepository()
+        self.batch_size = batch_size
+        self.read_batch_size = read_batch_size
+        self.interval_seconds = interval_seconds
+        self.compaction_min_live_ratio = compaction_min_live_ratio
+        self._fault_locks: Dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "runs": 0,
+            "archived": 0,
+            "messages_archived": 0,
+            "faulted_in": 0,
+            "compacted_segments": 0,
+            "last_run": None,
+            "errors": 0
+        }
+
+    async def archive_conversation(self, conversation: Dict[str, Any]) -> bool:
+        """Archivar una conversación; False si cambió mientras tanto"""
+        conversation_id = conversation["id"]
+        # Archivada antes y con mensajes nuevos: se archiva completa otra vez
+        if conversation.get("archived_until"):
+            await self.fault_in(conversation_id, restored_for_read=False)
+
+        documents = await self.message_repo.list_for_archive(conversation_id)
+        location = None
+        if documents:
+            location = await asyncio.to_thread(self.store.put, conversation_id, documents)
+
+        archived = await self.conversation_repo.mark_archived(
+            conversation_id,
+            conversation["last_message_at"],
+            location["length"] if location else 0
+        )
+        if not archived:
+            if location:
+                await asyncio.to_thread(self.store.drop, conversation_id)
+            return False
+
+        if documents:
+            await self.message_repo.delete_by_ids([document["id"] for document in documents])
+        self.stats["archived"] += 1
+        self.stats["messages_archived"] += len(documents)
+        return True
+
+    async def _archived_batches(self, conversation_id: str):
+        # Lotes del registro archivado, decodificados en un hilo lote a lote
+        batches = self.store.iter_batches(conversation_id, self.read_batch_size)
+        try:
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            batches.close()
+
+    async def fault_in(self, conversation_id: str, restored_for_read: bool = True) -> int:
+        """
+        Devolver los mensajes archivados a MongoDB y quitar la marca del stub.
+
+        Con `restored_for_read` se anota `restored_at`: la conversación no
+        vuelve a archivarse hasta pasar otra vez el plazo de inactividad.
+        """
+        lock = self._fault_locks.setdefault(conversation_id, asyncio.Lock())
+        try:
+            async with lock:
+                if self.store.locate(conversation_id) is None:
+                    return 0
+                restored = 0
+                async for documents in self._archived_batches(conversation_id):
+                    report = await self.message_repo.create_many(documents)
+                    # Duplicados = el archivado se interrumpió antes de borrar
+                    failed = [f for f in report["failed"] if f["code"] != DUPLICATE_KEY_ERROR]
+                    if failed:
+                        raise BaseServiceException(
+                            f"Failed to restore {len(failed)} archived messages of {conversation_id}",
+                            "ARCHIVE_RESTORE_FAILED"
+                        )
+                    restored += len(documents)
+                await self.conversation_repo.mark_restored(
+                    conversation_id, datetime.utcnow() if restored_for_read else None
+                )
+                await asyncio.to_thread(self.store.drop, conversation_id)
+                self.stats["faulted_in"] += 1
+                logger.info(f"Conversation {conversation_id} restored from archive ({restored} messages)")
+                return restored
+        finally:
+            if not lock.locked():
+                self._fault_locks.pop(conversation_id, None)
+
+    async def iter_messages(self, conversation_id: str, user_id: Optional[str] = None):
+        """
+        Mensajes de una conversación en orden cronológico, archivados o no.
+
+        Decodifica el registro en streaming, `read_batch_size` mensajes a la
+        vez, sin devolverlo a MongoDB (exportaciones y PDF), y continúa con
+        los mensajes en caliente. Con `user_id` solo se devuelven los
+        mensajes de ese usuario.
+        """
+        codec = get_content_codec()
+        blob_store = get_blob_store()
+        archived_ids = set()
+        async for documents in self._archived_batches(conversation_id):
+            if user_id is not None:
+                documents = [document for document in documents if document.get("user_id") == user_id]
+            for document in documents:
+                archived_ids.add(document["id"])
+                codec.decode_document(document)
+                # Solo se devuelve `content`: no hace falta resolver otros blobs
+                if document.get(BLOB_REFS_FIELD):
+                    document[BLOB_REFS_FIELD] = {
+                        path: digest for path, digest in document[BLOB_REFS_FIELD].items() if path == "content"
+                    }
+            for document in await blob_store.resolve(documents):
+                yield {field: document.get(field) for field in MESSAGE_FIELDS}
+        async for message in self.message_repo.iter_for_conversation(conversation_id, user_id=user_id):
+            if message["id"] not in archived_ids:
+                yield message
+
+    async def forget(self, conversation: Dict[str, Any]):
+        """Descartar el registro archivado de una conversación eliminada y liberar sus blobs"""
+        dropped = False
+        async for documents in self._archived_batches(conversation["id"]):
+            if not dropped:
+                # Sacarlo del índice antes de liberar: un fallo a medias deja
+                # referencias de más, nunca blobs liberados dos veces
+                await asyncio.to_thread(self.store.drop, conversation["id"])
+                dropped = True
+            await get_blob_store().release_documents(documents)
+        if not dropped:
+            await asyncio.to_thread(self.store.drop, conversation["id"])
+
+    async def run_once(self) -> Dict[str, int]:
+        """Archivar todo lo inactivo según el plan y compactar segmentos"""
+        now = datetime.utcnow()
+        report = {"conversations": 0, "messages": 0}
+        messages_before = self.stats["messages_archived"]
+
+        for plan in ARCHIVE_PLANS:
+            if not plan.get("archive_after_days"):
+                continue
+            before = now - timedelta(days=plan["archive_after_days"])
+            # Conversaciones anteriores al campo `plan`: política del plan gratuito
+            plans = [plan["name"], None] if plan is SubscriptionPlans.FREE else [plan["name"]]
+            while True:
+                candidates = await self.conversation_repo.find_archivable(plans, before, self.batch_size)
+                archived = 0
+                for conversation in candidates:
+                    if await self.archive_conversation(conversation):
+                        archived += 1
+                report["conversations"] += archived
+                if len(candidates) < self.batch_size or archived == 0:
+                    break
+
+        compaction = await asyncio.to_thread(self.store.compact, self.compaction_min_live_ratio)
+        self.stats["compacted_segments"] += compaction["segments"]
+        report["messages"] = self.stats["messages_archived"] - messages_before
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = now
+        if report["conversations"] or compaction["segments"]:
+            logger.info(
+                f"Archive run: {report['conversations']} conversations, {report['messages']} messages archived, "
+                f"{compaction['segments']} segments compacted "
+                f"({compaction['bytes_reclaimed'] / (1024 * 1024):.1f} MB reclaimed)"
+            )
+        return report
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Archive run failed: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        """Iniciar el archivado periódico"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener el archivado"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
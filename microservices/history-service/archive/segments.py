@@ -0,0 +1,303 @@
+"""
+Segmentos de archivo en frío
+
+Cada conversación archivada es un registro en un archivo de segmento
+append-only (`segment-000001.seg`): cabecera (magic, flags, longitud, CRC)
+seguida de los documentos BSON de sus mensajes concatenados y comprimidos
+con zstd. Al llegar a `max_segment_bytes` se abre un segmento nuevo.
+
+El índice de offsets es un SQLite (`index.sqlite`) con la ubicación de cada
+conversación; se confirma después del fsync del segmento, así que una caída
+deja como mucho bytes huérfanos al final del archivo. Las lecturas usan
+`mmap`: se lee solo el registro pedido, sin cargar el segmento, y
+`iter_batches` lo descomprime y decodifica en streaming.
+
+Los registros de conversaciones recuperadas o eliminadas quedan como basura
+hasta que `compact()` copia los registros vivos de los segmentos poco
+aprovechados al segmento activo y borra los originales.
+"""
+
+from typing import Optional, Dict, Any, List, Iterator
+from datetime import datetime
+import threading
+import sqlite3
+import io
+import struct
+import mmap
+import zlib
+import os
+import re
+
+import bson
+
+try:
+    import zstandard as zstd
+except ImportError:  # pragma: no cover - dependencia opcional
+    zstd = None
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS locations (
+        conversation_id TEXT PRIMARY KEY,
+        segment INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        message_count INTEGER NOT NULL,
+        archived_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_locations_segment ON locations(segment, offset)",
+]
+
+RECORD_MAGIC = b"ARC1"
+# magic, flags, longitud del payload, crc32 del payload
+RECORD_HEADER = struct.Struct("<4sBII")
+FLAG_ZSTD = 1
+
+_SEGMENT_RE = re.compile(r"^segment-(\d{6})\.seg$")
+
+
+class SegmentCorruptedError(Exception):
+    """Registro de archivo ilegible (cabecera o CRC inválidos)"""
+    pass
+
+
+class SegmentStore:
+    """Almacén de conversaciones archivadas en segmentos con índice de offsets"""
+
+    def __init__(self, path: str, max_segment_bytes: int = 256 * 1024 * 1024, level: int = 3):
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        self.level = level
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._maps_lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._local = threading.local()
+        self._writer = self._connect()
+        for statement in SCHEMA:
+            self._writer.execute(statement)
+        self._writer.commit()
+
+        segments = self.list_segments()
+        self._active = segments[-1] if segments else 1
+        self._active_file = open(self._segment_path(self._active), "ab")
+        if self._active_file.tell() >= self.max_segment_bytes:
+            self._rotate()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(os.path.join(self.path, "index.sqlite"), check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"segment-{segment:06d}.seg")
+
+    def list_segments(self) -> List[int]:
+        """Números de segmento presentes en disco"""
+        return sorted(
+            int(match.group(1)) for match in map(_SEGMENT_RE.match, os.listdir(self.path)) if match
+        )
+
+    def _rotate(self):
+        self._active_file.close()
+        self._active += 1
+        self._active_file = open(self._segment_path(self._active), "ab")
+
+    def _append(self, record: bytes) -> tuple:
+        # Llamar con self._lock tomado; el fsync precede al commit del índice
+        if self._active_file.tell() + len(record) > self.max_segment_bytes and self._active_file.tell() > 0:
+            self._rotate()
+        offset = self._active_file.tell()
+        self._active_file.write(record)
+        self._active_file.flush()
+        os.fsync(self._active_file.fileno())
+        return self._active, offset
+
+    def _encode_record(self, documents: List[Dict[str, Any]]) -> bytes:
+        payload = b"".join(bson.encode(document) for document in documents)
+        flags = 0
+        if zstd is not None:
+            payload = zstd.ZstdCompressor(level=self.level).compress(payload)
+            flags |= FLAG_ZSTD
+        return RECORD_HEADER.pack(RECORD_MAGIC, flags, len(payload), zlib.crc32(payload)) + payload
+
+    def put(self, conversation_id: str, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Archivar los mensajes de una conversación (reemplaza un registro anterior)"""
+        record = self._encode_record(documents)
+        with self._lock:
+            segment, offset = self._append(record)
+            self._writer.execute(
+                "INSERT OR REPLACE INTO locations"
+                "(conversation_id, segment, offset, length, message_count, archived_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, segment, offset, len(record), len(documents), datetime.utcnow().isoformat())
+            )
+            self._writer.commit()
+        return {"segment": segment, "offset": offset, "length": len(record)}
+
+    def locate(self, conversation_id: str) -> Optional[Dict[str, int]]:
+        """Ubicación del registro de una conversación, si está archivada"""
+        row = self._reader().execute(
+            "SELECT segment, offset, length FROM locations WHERE conversation_id = ?",
+            (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"segment": row[0], "offset": row[1], "length": row[2]}
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        # El segmento activo crece: se vuelve a mapear si el registro queda fuera.
+        # Los mapas reemplazados se liberan cuando no quedan vistas sobre ellos.
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                with open(self._segment_path(segment), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+            return mapped
+
+    def _open_record(self, location: Dict[str, int]):
+        # Flujo con los BSON del registro (descomprimidos bajo demanda)
+        start = location["offset"]
+        mapped = self._map(location["segment"], start + location["length"])
+        view = memoryview(mapped)[start:start + location["length"]]
+        magic, flags, length, crc = RECORD_HEADER.unpack_from(view)
+        payload = view[RECORD_HEADER.size:RECORD_HEADER.size + length]
+        if magic != RECORD_MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+            raise SegmentCorruptedError(
+                f"Corrupted archive record in segment {location['segment']} at offset {start}"
+            )
+        if flags & FLAG_ZSTD:
+            if zstd is None:
+                raise SegmentCorruptedError("zstandard is required to read compressed archive records")
+            return zstd.ZstdDecompressor().stream_reader(payload)
+        return io.BytesIO(payload)
+
+    def _locate_and_open(self, conversation_id: str):
+        location = self.locate(conversation_id)
+        if location is None:
+            return None
+        try:
+            return self._open_record(location)
+        except FileNotFoundError:
+            # Una compactación movió el registro entre la consulta y la lectura
+            location = self.locate(conversation_id)
+            return self._open_record(location) if location else None
+
+    def read(self, conversation_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Leer los mensajes archivados de una conversación (None si no está)"""
+        stream = self._locate_and_open(conversation_id)
+        if stream is None:
+            return None
+        with stream:
+            return list(bson.decode_file_iter(stream))
+
+    def iter_batches(self, conversation_id: str, batch_size: int = 500) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Mensajes archivados en lotes de `batch_size`, decodificados en
+        streaming: en memoria solo hay un lote y el buffer del descompresor.
+        """
+        stream = self._locate_and_open(conversation_id)
+        if stream is None:
+            return
+        with stream:
+            batch = []
+            for document in bson.decode_file_iter(stream):
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    def drop(self, conversation_id: str) -> bool:
+        """Sacar una conversación del archivo (su registro queda como basura)"""
+        with self._lock:
+            cursor = self._writer.execute(
+                "DELETE FROM locations WHERE conversation_id = ?", (conversation_id,)
+            )
+            self._writer.commit()
+        return cursor.rowcount > 0
+
+    def _live_bytes(self) -> Dict[int, int]:
+        return dict(self._reader().execute(
+            "SELECT segment, SUM(length) FROM locations GROUP BY segment"
+        ).fetchall())
+
+    def compact(self, min_live_ratio: float = 0.5) -> Dict[str, int]:
+        """
+        Reescribir los segmentos cerrados con menos de `min_live_ratio` de
+        datos vivos: sus registros vivos se copian tal cual al segmento
+        activo y el archivo original se borra.
+        """
+        report = {"segments": 0, "records_moved": 0, "bytes_reclaimed": 0}
+        live_bytes = self._live_bytes()
+        for segment in self.list_segments():
+            if segment == self._active:
+                continue
+            size = os.path.getsize(self._segment_path(segment))
+            live = live_bytes.get(segment, 0)
+            if size and live / size >= min_live_ratio:
+                continue
+
+            with self._lock:
+                rows = self._writer.execute(
+                    "SELECT conversation_id, offset, length FROM locations "
+                    "WHERE segment = ? ORDER BY offset",
+                    (segment,)
+                ).fetchall()
+                moved = []
+                if rows:
+                    mapped = self._map(segment, size)
+                    for conversation_id, offset, length in rows:
+                        new_segment, new_offset = self._append(mapped[offset:offset + length])
+                        moved.append((new_segment, new_offset, conversation_id, segment))
+                self._writer.executemany(
+                    "UPDATE locations SET segment = ?, offset = ? "
+                    "WHERE conversation_id = ? AND segment = ?",
+                    moved
+                )
+                self._writer.commit()
+                with self._maps_lock:
+                    self._maps.pop(segment, None)
+                os.remove(self._segment_path(segment))
+
+            report["segments"] += 1
+            report["records_moved"] += len(moved)
+            report["bytes_reclaimed"] += size - live
+        return report
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Tamaño en disco, datos vivos y número de conversaciones archivadas"""
+        conversations, messages, live = self._reader().execute(
+            "SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(length), 0) FROM locations"
+        ).fetchone()
+        segments = self.list_segments()
+        disk_bytes = sum(os.path.getsize(self._segment_path(segment)) for segment in segments)
+        return {
+            "conversations": conversations,
+            "messages": messages,
+            "segments": len(segments),
+            "active_segment": self._active,
+            "disk_bytes": disk_bytes,
+            "live_bytes": live,
+            "live_ratio": round(live / disk_bytes, 3) if disk_bytes else None
+        }
+
+    def close(self):
+        """Cerrar el segmento activo y el índice"""
+        with self._lock:
+            self._active_file.close()
+            self._writer.close()
+        with self._maps_lock:
+            self._maps.clear()
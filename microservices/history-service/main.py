@@ -0,0 +1,500 @@
+"""
+History Service - Servicio de Historial
+Puerto: 8004
+"""
+
+import uvicorn
+from fastapi import FastAPI, Depends, Query
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from contextlib import asynccontextmanager
+from typing import Optional, List
+from datetime import datetime
+import logging
+
+# Imports locales
+from utils.export_engine import ExportEngine, EXPORT_FORMATS, export_filename
+
+# Imports compartidos
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from shared.models import (
+    SuccessResponse, HealthResponse, CursorPaginatedResponse, ConversationBase
+)
+from shared.auth_middleware import get_current_user
+from shared.database import (
+    init_database, close_database, get_database_manager, get_database_metrics, loader_scope
+)
+from shared.history_store import ConversationRepository, MessageRepository
+from shared.content_codec import init_content_codec, get_content_codec
+from shared.blob_store import get_blob_store
+from shared.pdf_rendering import get_pdf_renderer, stream_file, PdfJobStatus
+from shared.exceptions import (
+    BaseServiceException, ConversationNotFoundException, NotFoundException, ValidationException,
+    handle_service_exception
+)
+from shared.config import get_settings
+from shared.redis_client import get_redis_cache, init_redis_cache, close_redis_cache
+from shared.tiered_cache import get_tiered_cache
+from shared.token_revocation import get_revocation_list
+
+from search.index import MessageSearchIndex
+from search.indexer import MessageIndexer
+from utils.retention import RetentionWorker
+from archive.segments import SegmentStore
+from archive.archiver import ConversationArchiver
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Settings
+settings = get_settings()
+
+# Índice de búsqueda de mensajes
+search_index = MessageSearchIndex(
+    settings.SEARCH_INDEX_PATH,
+    shards=settings.SEARCH_INDEX_SHARDS,
+    max_candidates=settings.SEARCH_MAX_CANDIDATES
+)
+
+# Campos que el usuario puede editar en una conversación
+EDITABLE_FIELDS = set(ConversationBase.model_fields)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Lifespan events para inicialización y limpieza"""
+    # Startup
+    logger.info("🚀 Starting History Service...")
+    try:
+        await init_database()
+        await init_content_codec(get_database_manager().db)
+        logger.info("✅ Database connected")
+    except Exception as e:
+        logger.error(f"❌ Database connection failed: {e}")
+        raise
+
+    await init_redis_cache()
+    get_tiered_cache().start()
+    get_revocation_list().start()
+    search_indexer.start()
+    get_pdf_renderer().start()
+    logger.info(f"✅ Search indexer started ({search_index.document_count()} messages indexed)")
+    if settings.RETENTION_ENABLED:
+        retention_worker.start()
+        logger.info("✅ Retention worker started")
+    if settings.ARCHIVE_ENABLED:
+        archiver.start()
+        logger.info("✅ Archiver started")
+
+    yield
+
+    # Shutdown
+    logger.info("🔄 Shutting down History Service...")
+    await retention_worker.stop()
+    await archiver.stop()
+    await search_indexer.stop()
+    await get_pdf_renderer().shutdown()
+    await get_tiered_cache().stop()
+    await get_revocation_list().stop()
+    await close_database()
+    await close_redis_cache()
+    logger.info("✅ History Service stopped")
+
+
+# Crear aplicación FastAPI
+app = FastAPI(
+    title="LLM Wrapper - History Service",
+    description="Servicio de historial de conversaciones",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+# Configurar CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=settings.CORS_ORIGINS,
+    allow_credentials=settings.CORS_ALLOW_CREDENTIALS,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Alcance de deduplicación de lecturas por ID para cada request
+@app.middleware("http")
+async def database_loader_scope(request, call_next):
+    with loader_scope():
+        return await call_next(request)
+
+
+# Repositorios
+conversation_repo = ConversationRepository()
+message_repo = MessageRepository()
+search_indexer = MessageIndexer(
+    search_index,
+    message_repo,
+    conversation_repo,
+    poll_interval=settings.SEARCH_INDEX_POLL_INTERVAL_SECONDS,
+    lag_seconds=settings.SEARCH_INDEX_LAG_SECONDS
+)
+
+
+archiver = ConversationArchiver(
+    SegmentStore(settings.ARCHIVE_PATH, max_segment_bytes=settings.ARCHIVE_SEGMENT_MAX_BYTES),
+    conversation_repo,
+    message_repo,
+    batch_size=settings.ARCHIVE_BATCH_SIZE,
+    interval_seconds=settings.ARCHIVE_INTERVAL_SECONDS,
+    compaction_min_live_ratio=settings.ARCHIVE_COMPACTION_MIN_LIVE_RATIO
+)
+
+
+async def _on_conversation_purged(conversation: dict):
+    await search_index.remove_conversation(conversation["id"], conversation["user_id"])
+    await archiver.forget(conversation)
+
+
+retention_worker = RetentionWorker(
+    conversation_repo,
+    message_repo,
+    batch_size=settings.RETENTION_BATCH_SIZE,
+    max_deletes_per_second=settings.RETENTION_MAX_DELETES_PER_SECOND,
+    interval_seconds=settings.RETENTION_INTERVAL_SECONDS,
+    on_conversation_purged=_on_conversation_purged
+)
+
+
+# Exception handlers
+@app.exception_handler(Exception)
+async def global_exception_handler(request, exc):
+    """Handler global para excepciones"""
+    if isinstance(exc, BaseServiceException):
+        http_exc = handle_service_exception(exc)
+        return JSONResponse(
+            status_code=http_exc.status_code,
+            content=http_exc.detail
+        )
+
+    logger.error(f"Unhandled exception: {exc}")
+    return JSONResponse(
+        status_code=500,
+        content={
+            "error_code": "INTERNAL_SERVER_ERROR",
+            "message": "An internal error occurred"
+        }
+    )
+
+
+# Health Check
+@app.get("/health", response_model=HealthResponse)
+async def health_check():
+    """Health check del servicio"""
+    db_manager = get_database_manager()
+    db_health = await db_manager.health_check()
+
+    return HealthResponse(
+        service="history-service",
+        status="healthy" if db_health["status"] == "healthy" else "degraded",
+        version="1.0.0",
+        checks={
+            "database": db_health,
+            "search_index": search_indexer.stats,
+            "retention": retention_worker.stats,
+            "archive": {**archiver.stats, **archiver.store.get_stats()},
+            "content_compression": get_content_codec().get_stats(),
+            "blobs": get_blob_store().get_stats(),
+            "redis": await get_redis_cache().health_check(),
+            "cache": get_tiered_cache().get_stats(),
+            "token_revocation": get_revocation_list().get_stats()
+        }
+    )
+
+
+@app.get("/metrics", response_model=SuccessResponse)
+async def database_metrics():
+    """Latencias p50/p95/p99 por repositorio y comando, y consultas lentas"""
+    return SuccessResponse(
+        message="Metrics retrieved successfully",
+        data=get_database_metrics()
+    )
+
+
+async def _get_owned_conversation(conversation_id: str, user_id: str, projection=None) -> dict:
+    conversation = await conversation_repo.get_for_user(conversation_id, user_id, projection)
+    if not conversation:
+        raise ConversationNotFoundException(f"Conversation {conversation_id} not found")
+    return conversation
+
+
+# Endpoints de conversaciones
+@app.get("/conversations", response_model=CursorPaginatedResponse)
+async def list_conversations(
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    is_favorite: Optional[bool] = None,
+    tag: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Listar conversaciones del usuario"""
+    page = await conversation_repo.list_for_user(
+        current_user["user_id"],
+        cursor=cursor,
+        limit=limit,
+        is_favorite=is_favorite,
+        tag=tag
+    )
+
+    return CursorPaginatedResponse(
+        message="Conversations retrieved successfully",
+        data=page["items"],
+        page_size=page["page_size"],
+        next_cursor=page["next_cursor"],
+        previous_cursor=page["previous_cursor"],
+        has_next=page["has_next"],
+        has_previous=page["has_previous"]
+    )
+
+
+@app.get("/conversations/{conversation_id}", response_model=SuccessResponse)
+async def get_conversation(
+    conversation_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Obtener conversación específica"""
+    conversation = await _get_owned_conversation(conversation_id, current_user["user_id"])
+
+    return SuccessResponse(
+        message="Conversation retrieved successfully",
+        data=conversation
+    )
+
+
+@app.get("/conversations/{conversation_id}/messages", response_model=CursorPaginatedResponse)
+async def list_messages(
+    conversation_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    include_content: bool = True,
+    current_user: dict = Depends(get_current_user)
+):
+    """Listar mensajes de una conversación (sin contenido: no se descomprime)"""
+    conversation = await _get_owned_conversation(
+        conversation_id, current_user["user_id"], {"_id": 0, "id": 1, "archived_until": 1}
+    )
+    # Conversación archivada: se devuelve a MongoDB para paginarla
+    if conversation.get("archived_until"):
+        await archiver.fault_in(conversation_id)
+    page = await message_repo.list_for_conversation(
+        conversation_id, cursor=cursor, limit=limit, include_content=include_content,
+        user_id=current_user["user_id"]
+    )
+
+    return CursorPaginatedResponse(
+        message="Messages retrieved successfully",
+        data=page["items"],
+        page_size=page["page_size"],
+        next_cursor=page["next_cursor"],
+        previous_cursor=page["previous_cursor"],
+        has_next=page["has_next"],
+        has_previous=page["has_previous"]
+    )
+
+
+@app.put("/conversations/{conversation_id}", response_model=SuccessResponse)
+async def update_conversation(
+    conversation_id: str,
+    update_data: dict,
+    current_user: dict = Depends(get_current_user)
+):
+    """Actualizar título, etiquetas, categoría o flags de una conversación"""
+    fields = {k: v for k, v in update_data.items() if k in EDITABLE_FIELDS}
+    if not fields or not await conversation_repo.update_for_user(
+        conversation_id, current_user["user_id"], fields
+    ):
+        raise ConversationNotFoundException(f"Conversation {conversation_id} not found")
+
+    return SuccessResponse(
+        message="Conversation updated successfully",
+        data={"id": conversation_id, "updated_fields": list(fields)}
+    )
+
+
+@app.delete("/conversations/{conversation_id}", response_model=SuccessResponse)
+async def delete_conversation(
+    conversation_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Eliminar conversación y sus mensajes"""
+    if not await conversation_repo.delete_for_user(conversation_id, current_user["user_id"]):
+        raise ConversationNotFoundException(f"Conversation {conversation_id} not found")
+    deleted_messages = await message_repo.delete_for_conversation(conversation_id)
+    await _on_conversation_purged({"id": conversation_id, "user_id": current_user["user_id"]})
+
+    return SuccessResponse(
+        message="Conversation deleted successfully",
+        data={"id": conversation_id, "deleted_messages": deleted_messages}
+    )
+
+
+@app.get("/search", response_model=SuccessResponse)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=500),
+    model: Optional[str] = None,
+    tag: Optional[List[str]] = Query(None),
+    conversation_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=50),
+    offset: int = Query(0, ge=0, le=1000),
+    current_user: dict = Depends(get_current_user)
+):
+    """Buscar en el contenido de los mensajes (BM25 + snippets)"""
+    result = await search_index.search(
+        current_user["user_id"],
+        q,
+        limit=limit,
+        offset=offset,
+        model=model,
+        tags=tag,
+        conversation_id=conversation_id,
+        date_from=date_from,
+        date_to=date_to
+    )
+
+    return SuccessResponse(
+        message="Search completed successfully",
+        data={
+            "query": q,
+            "results": result["results"],
+            "took_ms": result["took_ms"]
+        }
+    )
+
+
+@app.get("/stats", response_model=SuccessResponse)
+async def get_stats(current_user: dict = Depends(get_current_user)):
+    """Estadísticas de uso del historial"""
+    stats = await conversation_repo.get_user_statistics(current_user["user_id"])
+    # Deduplicación de blobs (global, no por usuario): recorre toda la colección,
+    # así que se cachea y solo una réplica lo recalcula al expirar
+    stats["blob_storage"] = await get_tiered_cache().get_or_load(
+        "analytics",
+        "blob_storage",
+        get_blob_store().repository.get_storage_stats,
+        ttl=settings.BLOB_STATS_CACHE_TTL_SECONDS
+    )
+
+    return SuccessResponse(
+        message="Statistics retrieved successfully",
+        data=stats
+    )
+
+
+@app.get("/export")
+async def export_conversations(
+    format: str = "json",
+    conversation_id: Optional[List[str]] = Query(None),
+    gzip: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Exportar conversaciones en streaming (JSON, NDJSON o TXT)"""
+    if format not in EXPORT_FORMATS:
+        raise ValidationException(
+            f"Unsupported export format '{format}'. Supported: {', '.join(EXPORT_FORMATS)}"
+        )
+
+    user_id = current_user["user_id"]
+    engine = ExportEngine(
+        conversation_repo.iter_for_user(user_id, conversation_id),
+        lambda conversation_id: archiver.iter_messages(conversation_id, user_id)
+    )
+    filename = export_filename(user_id, format, gzip)
+    logger.info(f"Export started for user {user_id}: format={format} gzip={gzip}")
+
+    return StreamingResponse(
+        engine.stream(format, compress=gzip),
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.get("/conversations/{conversation_id}/pdf")
+async def export_conversation_pdf(
+    conversation_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Exportar una conversación a PDF.
+
+    Las conversaciones grandes se renderizan como job: se responde 202 con
+    el ID para consultar `/exports/jobs/{job_id}`.
+    """
+    user_id = current_user["user_id"]
+    conversation = await _get_owned_conversation(conversation_id, user_id, "summary")
+    renderer = get_pdf_renderer()
+    render = renderer.render_conversation(
+        conversation, archiver.iter_messages(conversation_id, user_id)
+    )
+
+    if conversation.get("message_count", 0) > settings.PDF_SYNC_MAX_MESSAGES:
+        job_id = renderer.submit_job("conversation", render, owner=user_id)
+        return JSONResponse(
+            status_code=202,
+            content=SuccessResponse(
+                message="PDF export scheduled",
+                data={"job_id": job_id, "status": PdfJobStatus.PENDING}
+            ).model_dump(mode="json")
+        )
+
+    result = await render
+    return StreamingResponse(
+        stream_file(result["path"], delete=True),
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'attachment; filename="{conversation_id}.pdf"'}
+    )
+
+
+def _get_owned_job(job_id: str, user_id: str) -> dict:
+    job = get_pdf_renderer().get_job(job_id)
+    if not job or job["owner"] != user_id:
+        raise NotFoundException(f"Export job {job_id} not found")
+    return job
+
+
+@app.get("/exports/jobs/{job_id}", response_model=SuccessResponse)
+async def get_export_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Estado de un job de exportación PDF"""
+    job = _get_owned_job(job_id, current_user["user_id"])
+
+    return SuccessResponse(
+        message="Export job retrieved successfully",
+        data={k: v for k, v in job.items() if k not in ("path", "owner")}
+    )
+
+
+@app.get("/exports/jobs/{job_id}/download")
+async def download_export_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Descargar el PDF de un job completado"""
+    job = _get_owned_job(job_id, current_user["user_id"])
+    if job["status"] != PdfJobStatus.COMPLETED:
+        raise ValidationException(f"Export job {job_id} is {job['status']}")
+
+    return FileResponse(job["path"], media_type="application/pdf", filename=f"{job_id}.pdf")
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8004,
+        reload=True,
+        log_level="info"
+    )
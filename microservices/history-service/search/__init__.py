@@ -0,0 +1,3 @@
+"""
+Búsqueda de texto completo sobre mensajes
+"""
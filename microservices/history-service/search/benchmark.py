@@ -0,0 +1,90 @@
+"""
+Benchmark de latencia de búsqueda
+
+Indexa mensajes sintéticos (un usuario con N mensajes más ruido de otros
+usuarios en el mismo shard) y mide p50/p95/máx de consultas típicas.
+
+Uso (desde microservices/history-service):
+    python -m search.benchmark [--messages 100000] [--path /tmp/search-bench]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import random
+import shutil
+import time
+
+from .index import MessageSearchIndex
+
+VOCABULARY = (
+    "python mongodb index query cursor latency cache redis token model stream export "
+    "invoice payment subscription docker kubernetes deploy async await database shard "
+    "search ranking snippet summary context window prompt embedding vector error retry "
+    "timeout pool connection compression archive retention backup migration schema"
+).split()
+# Cola larga de vocabulario con frecuencias tipo Zipf
+VOCABULARY += [f"term{i}" for i in range(5000)]
+WEIGHTS = [1.0 / (rank + 1) for rank in range(len(VOCABULARY))]
+MODELS = ["gpt-3.5-turbo", "gpt-4", "claude-3-haiku", "gemini-pro"]
+QUERIES = [
+    "python", "mongodb cursor", "redis cache", "deploy kubernetes timeout",
+    "compress*", "term1200", "schema term40", "retry term300 timeout"
+]
+
+
+def _synthetic_messages(user_id: str, count: int, rng: random.Random):
+    started = datetime(2024, 1, 1)
+    for i in range(count):
+        yield {
+            "id": f"{user_id}-{i}",
+            "conversation_id": f"{user_id}-conv-{i // 50}",
+            "user_id": user_id,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "model_used": None if i % 2 == 0 else rng.choice(MODELS),
+            "content": " ".join(rng.choices(VOCABULARY, WEIGHTS, k=rng.randint(20, 120))),
+            "created_at": started + timedelta(minutes=i)
+        }
+
+
+async def main(messages: int, path: str, runs: int):
+    rng = random.Random(42)
+    shutil.rmtree(path, ignore_errors=True)
+    index = MessageSearchIndex(path, shards=1)
+
+    started = time.perf_counter()
+    batch = []
+    for user_id, count in [("heavy-user", messages), ("other-a", messages // 2), ("other-b", messages // 2)]:
+        for message in _synthetic_messages(user_id, count, rng):
+            batch.append(message)
+            if len(batch) >= 5000:
+                await index.index_messages(batch)
+                batch = []
+    if batch:
+        await index.index_messages(batch)
+    print(f"indexed {index.document_count()} messages in {time.perf_counter() - started:.1f}s")
+
+    for label, filters in [
+        ("no filters", {}),
+        ("model", {"model": "gpt-4"}),
+        ("date range", {"date_from": datetime(2024, 2, 1), "date_to": datetime(2024, 3, 1)}),
+    ]:
+        timings = []
+        for _ in range(runs):
+            for query in QUERIES:
+                result = await index.search("heavy-user", query, limit=20, **filters)
+                timings.append(result["took_ms"])
+        timings.sort()
+        p50 = timings[len(timings) // 2]
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        print(f"{label:>12}: p50={p50:.1f}ms p95={p95:.1f}ms max={timings[-1]:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Message search latency benchmark")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--path", default="/tmp/search-bench")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.messages, args.path, args.runs))
@@ -0,0 +1,348 @@
+"""
+Índice de texto completo de mensajes (SQLite FTS5)
+
+El índice se reparte en shards por usuario; cada shard es un archivo SQLite
+con una tabla FTS5 sobre `content` y una tabla de metadatos para filtrar por
+conversación, modelo y fecha. Cada documento lleva un token de propietario en
+una columna indexada, así `owner:<token> AND content:(...)` intersecta
+posting lists en lugar de escanear los mensajes de otros usuarios.
+"""
+
+from typing import Optional, Dict, Any, List, Iterable
+from datetime import datetime
+import threading
+import hashlib
+import sqlite3
+import asyncio
+import logging
+import time
+import re
+import os
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS messages_meta (
+        rowid INTEGER PRIMARY KEY,
+        message_id TEXT NOT NULL UNIQUE,
+        conversation_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        role TEXT,
+        model TEXT,
+        created_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_meta_conversation ON messages_meta(conversation_id)",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, owner, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversation_tags (
+        conversation_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        tag TEXT NOT NULL,
+        PRIMARY KEY (conversation_id, tag)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_tags_user ON conversation_tags(user_id, tag)",
+    "CREATE TABLE IF NOT EXISTS index_state (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+# Marcadores de resaltado para los snippets
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+SNIPPET_TOKENS = 24
+# Candidatos rankeados por consulta: las coincidencias más recientes
+DEFAULT_MAX_CANDIDATES = 2000
+# Máximo de términos por consulta
+MAX_QUERY_TERMS = 16
+
+_TERM_RE = re.compile(r"\w+\*?", re.UNICODE)
+
+
+def owner_token(user_id: str) -> str:
+    """Token de propietario: un único término alfanumérico por usuario"""
+    return "u" + hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:20]
+
+
+def build_match_query(query: str, user_id: str) -> Optional[str]:
+    """
+    Traducir la consulta del usuario a sintaxis FTS5.
+
+    Cada término se cita (sin operadores inyectables); `term*` se mantiene
+    como búsqueda por prefijo. Todos los términos son obligatorios.
+    """
+    terms = []
+    for match in _TERM_RE.findall(query or "")[:MAX_QUERY_TERMS]:
+        prefix = match.endswith("*")
+        word = match.rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    if not terms:
+        return None
+    return f"owner:{owner_token(user_id)} AND content:({' '.join(terms)})"
+
+
+def _to_epoch(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    return value.timestamp() if value.tzinfo else (value - datetime(1970, 1, 1)).total_seconds()
+
+
+class SearchShard:
+    """Un archivo SQLite del índice"""
+
+    def __init__(self, path: str, max_candidates: int = DEFAULT_MAX_CANDIDATES):
+        self.path = path
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._writer = self._connect()
+        for statement in SCHEMA:
+            self._writer.execute(statement)
+        # La columna owner solo filtra: no participa en el ranking
+        self._writer.execute(
+            "INSERT INTO messages_fts(messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')"
+        )
+        self._writer.commit()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _reader(self) -> sqlite3.Connection:
+        # WAL: una conexión de lectura por hilo, sin bloquear al writer
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def add_messages(self, messages: Iterable[Dict[str, Any]]) -> int:
+        """Indexar mensajes; los ya indexados se ignoran"""
+        added = 0
+        with self._lock:
+            cursor = self._writer.cursor()
+            for message in messages:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO messages_meta"
+                    "(message_id, conversation_id, user_id, role, model, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        message["id"], message["conversation_id"], message["user_id"],
+                        message.get("role"), message.get("model_used"),
+                        _to_epoch(message["created_at"])
+                    )
+                )
+                if cursor.rowcount:
+                    cursor.execute(
+                        "INSERT INTO messages_fts(rowid, content, owner) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, message.get("content") or "", owner_token(message["user_id"]))
+                    )
+                    added += 1
+            self._writer.commit()
+        return added
+
+    def set_conversation_tags(self, conversation_id: str, user_id: str, tags: List[str]):
+        """Reemplazar las etiquetas de una conversación"""
+        with self._lock:
+            self._writer.execute("DELETE FROM conversation_tags WHERE conversation_id = ?", (conversation_id,))
+            self._writer.executemany(
+                "INSERT OR IGNORE INTO conversation_tags(conversation_id, user_id, tag) VALUES (?, ?, ?)",
+                [(conversation_id, user_id, tag) for tag in tags]
+            )
+            self._writer.commit()
+
+    def remove_conversation(self, conversation_id: str) -> int:
+        """Eliminar del índice los mensajes de una conversación"""
+        with self._lock:
+            rowids = [row[0] for row in self._writer.execute(
+                "SELECT rowid FROM messages_meta WHERE conversation_id = ?", (conversation_id,)
+            )]
+            self._writer.executemany("DELETE FROM messages_fts WHERE rowid = ?", [(r,) for r in rowids])
+            self._writer.execute("DELETE FROM messages_meta WHERE conversation_id = ?", (conversation_id,))
+            self._writer.execute("DELETE FROM conversation_tags WHERE conversation_id = ?", (conversation_id,))
+            self._writer.commit()
+        return len(rowids)
+
+    def search(
+        self,
+        match: str,
+        user_id: str,
+        limit: int,
+        offset: int = 0,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        model: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        conversation_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Buscar con ranking BM25 y snippets resaltados.
+
+        Un solo recorrido de la posting list en orden inverso (`rowid DESC`)
+        toma las `max_candidates` coincidencias más recientes que cumplen los
+        filtros; BM25 ordena solo esas y los snippets se calculan solo para
+        la página devuelta. La propiedad la garantiza el token de
+        propietario del MATCH: `messages_meta` solo se une si hay filtros.
+        """
+        filters: List[str] = []
+        params: List[Any] = [match]
+        if date_from is not None:
+            filters.append("AND m.created_at >= ?")
+            params.append(_to_epoch(date_from))
+        if date_to is not None:
+            filters.append("AND m.created_at < ?")
+            params.append(_to_epoch(date_to))
+        if model:
+            filters.append("AND m.model = ?")
+            params.append(model)
+        if conversation_id:
+            filters.append("AND m.conversation_id = ?")
+            params.append(conversation_id)
+        for tag in tags or []:
+            filters.append(
+                "AND m.conversation_id IN "
+                "(SELECT conversation_id FROM conversation_tags WHERE user_id = ? AND tag = ?)"
+            )
+            params.extend([user_id, tag])
+
+        sql = [
+            "WITH candidates AS (",
+            "SELECT messages_fts.rowid AS id, rank AS score FROM messages_fts",
+            "JOIN messages_meta m ON m.rowid = messages_fts.rowid" if filters else "",
+            "WHERE messages_fts MATCH ?",
+            *filters,
+            "ORDER BY messages_fts.rowid DESC LIMIT ?",
+            "), page AS (SELECT id, score FROM candidates ORDER BY score LIMIT ? OFFSET ?)",
+            "SELECT m.message_id, m.conversation_id, m.role, m.model, m.created_at, page.score,",
+            f"snippet(messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', {SNIPPET_TOKENS})",
+            "FROM page JOIN messages_fts ON messages_fts.rowid = page.id",
+            "JOIN messages_meta m ON m.rowid = page.id",
+            "WHERE messages_fts MATCH ? AND m.user_id = ?",
+            "ORDER BY page.score",
+        ]
+        params.extend([self.max_candidates, limit, offset, match, user_id])
+
+        rows = self._reader().execute(" ".join(sql), params).fetchall()
+        return [
+            {
+                "message_id": message_id,
+                "conversation_id": conversation_id,
+                "role": role,
+                "model_used": model_used,
+                "created_at": datetime.utcfromtimestamp(created_at),
+                "score": -rank,
+                "snippet": snippet
+            }
+            for message_id, conversation_id, role, model_used, created_at, rank, snippet in rows
+        ]
+
+    def get_state(self, key: str) -> Optional[str]:
+        row = self._reader().execute("SELECT value FROM index_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: str):
+        with self._lock:
+            self._writer.execute(
+                "INSERT INTO index_state(key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value)
+            )
+            self._writer.commit()
+
+    def optimize(self):
+        """Fusionar los segmentos FTS5 (mantenimiento)"""
+        with self._lock:
+            self._writer.execute("INSERT INTO messages_fts(messages_fts) VALUES ('optimize')")
+            self._writer.commit()
+
+    def count(self) -> int:
+        return self._reader().execute("SELECT COUNT(*) FROM messages_meta").fetchone()[0]
+
+
+class MessageSearchIndex:
+    """
+    Índice de búsqueda repartido en shards por usuario.
+
+    Los métodos async ejecutan SQLite en hilos (`asyncio.to_thread`) para no
+    bloquear el event loop.
+    """
+
+    def __init__(self, path: str, shards: int = 8, max_candidates: int = DEFAULT_MAX_CANDIDATES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shards = [
+            SearchShard(os.path.join(path, f"messages_{i:02d}.sqlite3"), max_candidates)
+            for i in range(shards)
+        ]
+        self.stats = {"queries": 0, "last_query_ms": 0.0, "indexed": 0}
+
+    def shard_for(self, user_id: str) -> SearchShard:
+        """Shard que contiene los mensajes de un usuario"""
+        digest = hashlib.sha1(user_id.encode("utf-8")).digest()
+        return self.shards[int.from_bytes(digest[:4], "big") % len(self.shards)]
+
+    def _index_batch(self, messages: List[Dict[str, Any]]) -> int:
+        by_shard: Dict[int, List[Dict[str, Any]]] = {}
+        for message in messages:
+            if not message.get("user_id"):
+                continue
+            shard = self.shard_for(message["user_id"])
+            by_shard.setdefault(id(shard), [shard, []])[1].append(message)
+        added = sum(shard.add_messages(batch) for shard, batch in by_shard.values())
+        self.stats["indexed"] += added
+        return added
+
+    async def index_messages(self, messages: List[Dict[str, Any]]) -> int:
+        """Indexar un lote de mensajes (idempotente por `id`)"""
+        return await asyncio.to_thread(self._index_batch, messages)
+
+    async def set_conversation_tags(self, conversation_id: str, user_id: str, tags: List[str]):
+        """Actualizar las etiquetas usadas como filtro"""
+        await asyncio.to_thread(
+            self.shard_for(user_id).set_conversation_tags, conversation_id, user_id, tags
+        )
+
+    async def remove_conversation(self, conversation_id: str, user_id: str) -> int:
+        """Eliminar una conversación del índice"""
+        return await asyncio.to_thread(self.shard_for(user_id).remove_conversation, conversation_id)
+
+    async def search(
+        self,
+        user_id: str,
+        query: str,
+        limit: int = 20,
+        offset: int = 0,
+        **filters
+    ) -> Dict[str, Any]:
+        """Buscar en los mensajes de un usuario"""
+        match = build_match_query(query, user_id)
+        if match is None:
+            return {"results": [], "took_ms": 0.0}
+
+        started = time.perf_counter()
+        results = await asyncio.to_thread(
+            self.shard_for(user_id).search, match, user_id, limit, offset, **filters
+        )
+        took_ms = (time.perf_counter() - started) * 1000
+        self.stats["queries"] += 1
+        self.stats["last_query_ms"] = took_ms
+        return {"results": results, "took_ms": round(took_ms, 2)}
+
+    def get_state(self, key: str) -> Optional[str]:
+        """Leer estado del indexador (checkpoints)"""
+        return self.shards[0].get_state(key)
+
+    def set_state(self, key: str, value: str):
+        """Guardar estado del indexador"""
+        self.shards[0].set_state(key, value)
+
+    def document_count(self) -> int:
+        """Número de mensajes indexados"""
+        return sum(shard.count() for shard in self.shards)
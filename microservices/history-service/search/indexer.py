@@ -0,0 +1,149 @@
+"""
+Indexador incremental de mensajes
+
+Sigue la colección `messages` por `created_at` con dos pasadas:
+
+- fresca: cada `poll_interval` indexa lo posterior al último mensaje visto;
+- barrido: re-lee la ventana `[watermark, ahora - lag)` para recoger
+  inserciones tardías (el buffer de chat-service reintenta y puede insertar
+  mensajes con `created_at` anterior al último visto).
+
+La indexación es idempotente por `id`, así que solapar ventanas es seguro.
+Los checkpoints se guardan en el propio índice.
+"""
+
+from typing import Optional
+from datetime import datetime, timedelta
+import asyncio
+import logging
+
+from shared.history_store import MessageRepository, ConversationRepository
+
+from .index import MessageSearchIndex
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_LAST_SEEN = "messages_last_seen"
+CHECKPOINT_SWEEP = "messages_sweep_watermark"
+CHECKPOINT_TAGS = "conversations_updated_at"
+EPOCH = datetime(1970, 1, 1)
+
+
+class MessageIndexer:
+    """Mantiene el índice de búsqueda al día con MongoDB"""
+
+    def __init__(
+        self,
+        index: MessageSearchIndex,
+        message_repo: MessageRepository = None,
+        conversation_repo: ConversationRepository = None,
+        poll_interval: float = 2.0,
+        lag_seconds: float = 60.0,
+        batch_size: int = 1000
+    ):
+        self.index = index
+        self.message_repo = message_repo or MessageRepository()
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.poll_interval = poll_interval
+        self.lag = timedelta(seconds=lag_seconds)
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"polls": 0, "indexed": 0, "swept": 0, "tag_updates": 0, "errors": 0}
+
+    def _checkpoint(self, key: str) -> datetime:
+        value = self.index.get_state(key)
+        return datetime.fromisoformat(value) if value else EPOCH
+
+    def _save_checkpoint(self, key: str, value: datetime):
+        self.index.set_state(key, value.isoformat())
+
+    async def _index_cursor(self, cursor) -> tuple:
+        indexed, latest, batch = 0, None, []
+        async for message in cursor:
+            batch.append(message)
+            latest = message["created_at"]
+            if len(batch) >= self.batch_size:
+                indexed += await self.index.index_messages(batch)
+                batch = []
+        if batch:
+            indexed += await self.index.index_messages(batch)
+        return indexed, latest
+
+    async def index_new_messages(self) -> int:
+        """Pasada fresca: mensajes posteriores al último visto"""
+        last_seen = self._checkpoint(CHECKPOINT_LAST_SEEN)
+        indexed, latest = await self._index_cursor(
+            self.message_repo.iter_created_between(last_seen, batch_size=self.batch_size)
+        )
+        if latest is not None:
+            self._save_checkpoint(CHECKPOINT_LAST_SEEN, latest)
+        self.stats["indexed"] += indexed
+        return indexed
+
+    async def sweep_late_messages(self) -> int:
+        """Barrido: recoger mensajes insertados tarde dentro de la ventana de lag"""
+        watermark = self._checkpoint(CHECKPOINT_SWEEP)
+        upper = datetime.utcnow() - self.lag
+        if upper <= watermark:
+            return 0
+        # El barrido inicial no re-lee lo que ya cubrió la pasada fresca
+        if watermark == EPOCH:
+            self._save_checkpoint(CHECKPOINT_SWEEP, upper)
+            return 0
+
+        indexed, _ = await self._index_cursor(
+            self.message_repo.iter_created_between(
+                watermark - timedelta(microseconds=1), upper, batch_size=self.batch_size
+            )
+        )
+        self._save_checkpoint(CHECKPOINT_SWEEP, upper)
+        if indexed:
+            logger.info(f"Search index sweep picked up {indexed} late messages")
+        self.stats["swept"] += indexed
+        return indexed
+
+    async def sync_conversation_tags(self) -> int:
+        """Actualizar las etiquetas de conversaciones modificadas"""
+        since = self._checkpoint(CHECKPOINT_TAGS)
+        latest, updated = None, 0
+        async for conversation in self.conversation_repo.iter_updated_since(since, self.batch_size):
+            await self.index.set_conversation_tags(
+                conversation["id"], conversation["user_id"], conversation.get("tags") or []
+            )
+            latest = conversation["updated_at"]
+            updated += 1
+        if latest is not None:
+            self._save_checkpoint(CHECKPOINT_TAGS, latest)
+        self.stats["tag_updates"] += updated
+        return updated
+
+    async def run_once(self):
+        """Una iteración completa del indexador"""
+        await self.index_new_messages()
+        await self.sweep_late_messages()
+        await self.sync_conversation_tags()
+        self.stats["polls"] += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Search indexer iteration failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        """Iniciar la indexación en segundo plano"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener la indexación"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,150 @@
+"""
+Segmentos de archivo en frío
+
+Registros sobre un directorio temporal: lectura tras escritura,
+compactación con mapas ya en caché, CRC inválido, lectura por lotes y
+reintento cuando una compactación borra el segmento entre la consulta y
+la lectura.
+"""
+
+from datetime import datetime
+import asyncio
+
+import pytest
+
+from archive.segments import SegmentStore, SegmentCorruptedError, RECORD_HEADER
+
+
+def _messages(conversation_id: str, count: int = 3) -> list:
+    return [
+        {
+            "id": f"{conversation_id}-{n}",
+            "conversation_id": conversation_id,
+            "role": "user" if n % 2 == 0 else "assistant",
+            "content": f"message {n} of {conversation_id} " * 20,
+            "created_at": datetime(2024, 1, 1, 12, n)
+        }
+        for n in range(count)
+    ]
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Segmentos pequeños: cada registro abre uno nuevo
+    store = SegmentStore(str(tmp_path), max_segment_bytes=256)
+    yield store
+    store.close()
+
+
+def test_put_then_read(store):
+    store.put("c1", _messages("c1"))
+    store.put("c2", _messages("c2", 5))
+
+    assert store.read("c1") == _messages("c1")
+    assert store.read("c2") == _messages("c2", 5)
+    assert store.read("missing") is None
+
+    # Un registro nuevo reemplaza al anterior
+    store.put("c1", _messages("c1", 1))
+    assert store.read("c1") == _messages("c1", 1)
+
+
+def test_read_remaps_growing_active_segment(tmp_path):
+    store = SegmentStore(str(tmp_path))
+    try:
+        store.put("c1", _messages("c1"))
+        assert store.read("c1") == _messages("c1")
+        # El mapa en caché del segmento activo no cubre el registro nuevo
+        store.put("c2", _messages("c2"))
+        assert store.read("c2") == _messages("c2")
+        assert store.list_segments() == [1]
+    finally:
+        store.close()
+
+
+def test_compact_with_cached_maps(store):
+    for conversation_id in ("c1", "c2", "c3"):
+        store.put(conversation_id, _messages(conversation_id))
+    # Mapear los segmentos antes de compactar
+    assert store.read("c1") == _messages("c1")
+    assert store.read("c2") == _messages("c2")
+    store.drop("c2")
+    assert store.list_segments() == [1, 2, 3]
+
+    report = store.compact(min_live_ratio=1.1)
+
+    # Los segmentos cerrados se reescriben en el activo aunque estuvieran mapeados
+    assert report["records_moved"] >= 1
+    assert not {1, 2} & set(store.list_segments())
+    assert store.locate("c1")["segment"] > 3
+    assert store.read("c1") == _messages("c1")
+    assert store.read("c2") is None
+    assert store.read("c3") == _messages("c3")
+    assert store.get_stats()["conversations"] == 2
+
+
+def test_crc_mismatch_raises(store):
+    store.put("c1", _messages("c1"))
+    location = store.locate("c1")
+    path = store._segment_path(location["segment"])
+    with open(path, "r+b") as f:
+        f.seek(location["offset"] + RECORD_HEADER.size + 10)
+        byte = f.read(1)
+        f.seek(-1, 1)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    with pytest.raises(SegmentCorruptedError):
+        store.read("c1")
+
+
+def test_read_retries_when_compaction_removes_segment(store, monkeypatch):
+    store.put("c1", _messages("c1"))
+    store.put("c2", _messages("c2"))
+    stale = store.locate("c1")
+    store.compact(min_live_ratio=1.1)
+    assert stale["segment"] not in store.list_segments()
+
+    # La primera consulta devuelve la ubicación previa a la compactación
+    locate = store.locate
+    calls = []
+
+    def stale_locate(conversation_id):
+        calls.append(conversation_id)
+        return stale if len(calls) == 1 else locate(conversation_id)
+
+    monkeypatch.setattr(store, "locate", stale_locate)
+
+    assert store.read("c1") == _messages("c1")
+    assert len(calls) == 2
+
+
+def test_iter_batches_streams_the_record(store):
+    store.put("c1", _messages("c1", 7))
+
+    batches = list(store.iter_batches("c1", batch_size=3))
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [document for batch in batches for document in batch] == _messages("c1", 7)
+    assert list(store.iter_batches("missing")) == []
+
+
+def test_archiver_reads_archived_messages_in_batches(store, monkeypatch):
+    from archive.archiver import ConversationArchiver
+
+    class HotMessages:
+        async def iter_for_conversation(self, conversation_id, user_id=None):
+            yield {"id": "c1-hot", "content": "hot"}
+
+    archived = [{**message, "user_id": "u1" if n != 1 else "u2"} for n, message in enumerate(_messages("c1", 5))]
+    store.put("c1", archived)
+    # La lectura completa del registro no debe usarse
+    monkeypatch.setattr(store, "read", lambda conversation_id: pytest.fail("read() loads the whole record"))
+    archiver = ConversationArchiver(store, conversation_repo=object(), message_repo=HotMessages(), read_batch_size=2)
+
+    async def collect():
+        return [message async for message in archiver.iter_messages("c1", user_id="u1")]
+
+    messages = asyncio.run(collect())
+
+    assert [message["id"] for message in messages] == ["c1-0", "c1-2", "c1-3", "c1-4", "c1-hot"]
+    assert messages[0]["content"] == archived[0]["content"]
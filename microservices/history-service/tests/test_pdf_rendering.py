@@ -0,0 +1,88 @@
+"""
+PdfRenderer: concurrencia acotada desde el volcado, pool roto y limpieza
+"""
+
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+import asyncio
+import os
+import time
+
+import pytest
+
+import shared.pdf_rendering as pdf_rendering
+from shared.pdf_rendering import PdfRenderer
+
+
+def test_semaphore_covers_message_spool(tmp_path, monkeypatch):
+    renderer = PdfRenderer(max_concurrency=1, output_dir=str(tmp_path))
+    spooling = []
+
+    async def fake_execute(function, conversation, spool_path, output_path):
+        await asyncio.sleep(0.05)
+        return {"path": output_path, "pages": 1}
+
+    monkeypatch.setattr(renderer, "_execute", fake_execute)
+
+    async def messages(name):
+        spooling.append(name)
+        # Solo un export puede estar leyendo mensajes o renderizando a la vez
+        assert len(spooling) - len(finished) == 1
+        yield {"role": "user", "content": name, "created_at": datetime(2024, 1, 1)}
+
+    finished = []
+
+    async def export(name):
+        await renderer.render_conversation({"id": name}, messages(name))
+        finished.append(name)
+
+    async def scenario():
+        await asyncio.gather(*(export(f"c{i}") for i in range(3)))
+
+    asyncio.run(scenario())
+    assert sorted(finished) == ["c0", "c1", "c2"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".ndjson")]
+
+
+def _crash():
+    os._exit(1)
+
+
+def test_broken_pool_is_replaced(tmp_path):
+    renderer = PdfRenderer(max_workers=1, output_dir=str(tmp_path))
+    # Sin reportlab `_worker_init` falla; con reportlab el worker muere en `_crash`
+
+    async def scenario():
+        async with renderer._semaphore:
+            with pytest.raises(BrokenProcessPool):
+                await renderer._execute(_crash)
+        broken = renderer._executor
+        await renderer.shutdown()
+        return broken
+
+    broken = asyncio.run(scenario())
+    assert broken is None
+    assert renderer.stats["pool_restarts"] == 1
+    assert renderer.stats["failed"] == 1
+
+
+def test_cleanup_removes_expired_jobs_and_leftovers(tmp_path):
+    renderer = PdfRenderer(output_dir=str(tmp_path), job_ttl_seconds=60)
+    expired = tmp_path / f"conversation_c1_{'a' * 32}.pdf"
+    leftover = tmp_path / f"messages_{'b' * 32}.ndjson"
+    recent = tmp_path / f"invoice_i1_{'c' * 32}.pdf"
+    foreign = tmp_path / "conversation_notes.pdf"
+    for path in (expired, leftover, recent, foreign):
+        path.write_bytes(b"%PDF")
+    old = time.time() - 120
+    for path in (expired, leftover, foreign):
+        os.utime(path, (old, old))
+    renderer._jobs["job-1"] = {
+        "id": "job-1", "path": str(expired), "completed_at": datetime.utcnow() - timedelta(seconds=120)
+    }
+
+    renderer._cleanup_expired_jobs()
+    renderer._cleanup_stale_files()
+
+    assert renderer.get_job("job-1") is None
+    assert sorted(os.listdir(tmp_path)) == sorted([recent.name, foreign.name])
@@ -0,0 +1,62 @@
+"""
+Filtros y candidatos del índice de búsqueda
+
+Con `max_candidates` pequeño, los filtros deben aplicarse al elegir las
+coincidencias candidatas, no después.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from search.index import SearchShard, build_match_query
+
+START = datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def shard(tmp_path):
+    shard = SearchShard(str(tmp_path / "messages.sqlite3"), max_candidates=10)
+    shard.add_messages([
+        {
+            "id": f"m{day}",
+            "conversation_id": "c-old" if day < 15 else "c-new",
+            "user_id": "alice",
+            "role": "assistant",
+            "model_used": "gpt-4" if day % 3 == 0 else "gpt-3.5-turbo",
+            "content": f"deploy notes for day {day}",
+            "created_at": START + timedelta(days=day)
+        }
+        for day in range(30)
+    ])
+    shard.set_conversation_tags("c-old", "alice", ["ops"])
+    return shard
+
+
+def _search(shard, user_id="alice", **filters):
+    return shard.search(build_match_query("deploy", user_id), user_id, limit=50, **filters)
+
+
+def test_unfiltered_search_ranks_most_recent_candidates(shard):
+    results = _search(shard)
+
+    assert len(results) == 10
+    assert {r["message_id"] for r in results} == {f"m{day}" for day in range(20, 30)}
+
+
+def test_date_filter_outside_recent_candidates(shard):
+    results = _search(shard, date_to=START + timedelta(days=5))
+
+    assert {r["message_id"] for r in results} == {f"m{day}" for day in range(5)}
+
+
+def test_model_conversation_and_tag_filters(shard):
+    assert {r["model_used"] for r in _search(shard, model="gpt-4")} == {"gpt-4"}
+    assert len(_search(shard, model="gpt-4")) == 10
+
+    old = _search(shard, conversation_id="c-old")
+    assert len(old) == 10
+    assert {r["conversation_id"] for r in old} == {"c-old"}
+
+    assert {r["conversation_id"] for r in _search(shard, tags=["ops"])} == {"c-old"}
+
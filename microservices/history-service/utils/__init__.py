@@ -0,0 +1,3 @@
+"""
+History Service Utils
+"""
@@ -0,0 +1,124 @@
+"""
+Benchmark de escrituras masivas frente a escrituras por documento
+
+Inserta, actualiza, hace upsert y borra `--documents` documentos sintéticos
+en una colección temporal, una vez con una operación por documento y otra
+con los métodos masivos de `BaseRepository` (`insert_many`/`bulk_write` no
+ordenados), y compara tiempos. La colección se elimina al terminar.
+
+Necesita el MongoDB configurado en `MONGODB_URI`.
+
+Uso (desde microservices/history-service):
+    python -m utils.bulk_benchmark [--documents 10000]
+"""
+
+from datetime import datetime
+import argparse
+import asyncio
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from shared.database import BaseRepository, get_database_manager
+
+COLLECTION = "benchmark_bulk_writes"
+CONTENT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4
+
+
+def _synthetic_documents(total: int, prefix: str) -> list:
+    now = datetime.utcnow()
+    return [
+        {
+            "id": f"{prefix}-{i}",
+            "conversation_id": f"conv-{i // 100}",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": CONTENT,
+            "tokens_used": 120,
+            "created_at": now
+        }
+        for i in range(total)
+    ]
+
+
+async def _single(repository: BaseRepository, documents: list):
+    collection = repository.get_collection()
+    timings = {}
+
+    started = time.perf_counter()
+    for doc in documents:
+        await repository.create(dict(doc))
+    timings["insert"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for doc in documents:
+        await repository.update_by_id(doc["id"], {"tokens_used": 240})
+    timings["update"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for doc in documents:
+        await collection.update_one(
+            {"id": doc["id"]},
+            {"$set": {"tokens_used": 360, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+    timings["upsert"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for doc in documents:
+        await repository.delete_by_id(doc["id"])
+    timings["delete"] = time.perf_counter() - started
+    return timings
+
+
+async def _bulk(repository: BaseRepository, documents: list):
+    ids = [doc["id"] for doc in documents]
+    timings = {}
+
+    started = time.perf_counter()
+    report = await repository.create_many([dict(doc) for doc in documents])
+    timings["insert"] = time.perf_counter() - started
+    assert not report["failed"], report["failed"][:3]
+
+    started = time.perf_counter()
+    await repository.update_many_by_ids({id: {"tokens_used": 240} for id in ids})
+    timings["update"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await repository.upsert_many([{**doc, "tokens_used": 360} for doc in documents])
+    timings["upsert"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await repository.delete_many_by_ids(ids)
+    timings["delete"] = time.perf_counter() - started
+    return timings
+
+
+async def main(total: int):
+    db_manager = get_database_manager()
+    await db_manager.connect()
+    repository = BaseRepository(COLLECTION)
+    try:
+        await repository.get_collection().create_index("id", unique=True)
+        single = await _single(repository, _synthetic_documents(total, "single"))
+        bulk = await _bulk(repository, _synthetic_documents(total, "bulk"))
+    finally:
+        await repository.get_collection().drop()
+        await db_manager.disconnect()
+
+    print(f"documents={total}")
+    print(f"{'operation':>10} {'single s':>10} {'bulk s':>10} {'speedup':>9} {'bulk docs/s':>12}")
+    for operation in single:
+        print(
+            f"{operation:>10} {single[operation]:>10.2f} {bulk[operation]:>10.2f} "
+            f"{single[operation] / bulk[operation]:>8.1f}x {total / bulk[operation]:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk vs single-document write benchmark")
+    parser.add_argument("--documents", type=int, default=10000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.documents))
@@ -0,0 +1,98 @@
+"""
+Benchmark de memoria del motor de exportación
+
+Genera conversaciones sintéticas en streaming (sin MongoDB) y mide el pico
+de memoria con `tracemalloc` para distintos tamaños de export. El pico debe
+mantenerse constante al crecer el número de mensajes.
+
+Uso (desde microservices/history-service):
+    python -m utils.export_benchmark [--messages 10,10000,1000000] [--format ndjson] [--gzip]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from .export_engine import ExportEngine, EXPORT_FORMATS
+
+MESSAGES_PER_CONVERSATION = 1000
+CONTENT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8
+
+
+async def _synthetic_conversations(total_messages: int):
+    conversations = max(1, -(-total_messages // MESSAGES_PER_CONVERSATION))
+    started = datetime(2024, 1, 1)
+    for i in range(conversations):
+        yield {
+            "id": f"conv-{i}",
+            "title": f"Conversation {i}",
+            "message_count": min(MESSAGES_PER_CONVERSATION, total_messages - i * MESSAGES_PER_CONVERSATION),
+            "created_at": started + timedelta(hours=i)
+        }
+
+
+def _synthetic_messages(total_messages: int):
+    async def messages_for(conversation_id: str):
+        index = int(conversation_id.split("-")[1])
+        count = min(MESSAGES_PER_CONVERSATION, total_messages - index * MESSAGES_PER_CONVERSATION)
+        created_at = datetime(2024, 1, 1) + timedelta(hours=index)
+        for n in range(count):
+            yield {
+                "id": f"{conversation_id}-{n}",
+                "role": "user" if n % 2 == 0 else "assistant",
+                "content": CONTENT,
+                "model_used": None if n % 2 == 0 else "gpt-3.5-turbo",
+                "tokens_used": 120,
+                "created_at": created_at + timedelta(seconds=n)
+            }
+    return messages_for
+
+
+async def run_export(total_messages: int, format: str, compress: bool) -> dict:
+    """Exportar `total_messages` mensajes sintéticos y medir memoria y tiempo"""
+    engine = ExportEngine(
+        _synthetic_conversations(total_messages),
+        _synthetic_messages(total_messages)
+    )
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    async for _ in engine.stream(format, compress=compress):
+        pass
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "messages": engine.stats["messages"],
+        "output_mb": engine.stats["bytes"] / (1024 * 1024),
+        "peak_kb": peak / 1024,
+        "seconds": elapsed
+    }
+
+
+async def main(sizes, format: str, compress: bool):
+    print(f"format={format} gzip={compress}")
+    print(f"{'messages':>12} {'output MB':>12} {'peak KB':>10} {'seconds':>9}")
+    for size in sizes:
+        result = await run_export(size, format, compress)
+        print(
+            f"{result['messages']:>12} {result['output_mb']:>12.1f} "
+            f"{result['peak_kb']:>10.1f} {result['seconds']:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export engine memory benchmark")
+    parser.add_argument("--messages", default="10,10000,1000000")
+    parser.add_argument("--format", default="ndjson", choices=sorted(EXPORT_FORMATS))
+    parser.add_argument("--gzip", action="store_true")
+    args = parser.parse_args()
+
+    asyncio.run(main(
+        [int(size) for size in args.messages.split(",")],
+        args.format,
+        args.gzip
+    ))
@@ -0,0 +1,147 @@
+"""
+Motor de exportación en streaming
+
+Serializa conversaciones y mensajes a JSON, NDJSON o TXT a medida que llegan
+del cursor de MongoDB, opcionalmente comprimidos con gzip. Solo se mantiene
+en memoria el lote actual del cursor y un buffer de salida de tamaño fijo.
+"""
+
+from typing import AsyncIterator, AsyncIterable, Callable, Dict, Any, Optional
+from datetime import datetime
+import json
+import zlib
+
+# Formatos soportados: extensión -> media type
+EXPORT_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "txt": "text/plain; charset=utf-8",
+}
+
+# Tamaño objetivo de cada chunk HTTP
+OUTPUT_CHUNK_BYTES = 64 * 1024
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(document: Dict[str, Any]) -> str:
+    return json.dumps(document, default=_json_default, ensure_ascii=False)
+
+
+class ExportEngine:
+    """
+    Exportador incremental de conversaciones.
+
+    `conversations` es cualquier iterable async de documentos y
+    `messages_for(conversation_id)` devuelve el iterable async de sus
+    mensajes (normalmente cursores de Motor).
+    """
+
+    def __init__(
+        self,
+        conversations: AsyncIterable[Dict[str, Any]],
+        messages_for: Callable[[str], AsyncIterable[Dict[str, Any]]],
+        chunk_bytes: int = OUTPUT_CHUNK_BYTES
+    ):
+        self.conversations = conversations
+        self.messages_for = messages_for
+        self.chunk_bytes = chunk_bytes
+        self.stats = {"conversations": 0, "messages": 0, "bytes": 0}
+
+    async def stream(self, format: str, compress: bool = False) -> AsyncIterator[bytes]:
+        """Generar el export en chunks de bytes"""
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format '{format}'")
+
+        pieces = getattr(self, f"_render_{format}")()
+        chunks = self._coalesce(pieces)
+        if compress:
+            chunks = gzip_stream(chunks)
+
+        async for chunk in chunks:
+            self.stats["bytes"] += len(chunk)
+            yield chunk
+
+    async def _coalesce(self, pieces: AsyncIterator[str]) -> AsyncIterator[bytes]:
+        # Agrupar fragmentos pequeños para no emitir un chunk HTTP por mensaje
+        buffer, size = [], 0
+        async for piece in pieces:
+            data = piece.encode("utf-8")
+            buffer.append(data)
+            size += len(data)
+            if size >= self.chunk_bytes:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield b"".join(buffer)
+
+    async def _iter_conversations(self):
+        async for conversation in self.conversations:
+            self.stats["conversations"] += 1
+            yield conversation
+
+    async def _iter_messages(self, conversation_id: str):
+        async for message in self.messages_for(conversation_id):
+            self.stats["messages"] += 1
+            yield message
+
+    async def _render_json(self) -> AsyncIterator[str]:
+        exported_at = datetime.utcnow().isoformat()
+        yield f'{{"export_info": {{"format": "json", "exported_at": "{exported_at}"}}, "conversations": ['
+        first_conversation = True
+        async for conversation in self._iter_conversations():
+            header = _dumps({**conversation, "messages": []})
+            # Abrir la lista de mensajes y completarla en streaming
+            yield ("" if first_conversation else ", ") + header[:-2]
+            first_conversation = False
+            first_message = True
+            async for message in self._iter_messages(conversation["id"]):
+                yield ("" if first_message else ", ") + _dumps(message)
+                first_message = False
+            yield "]}"
+        yield "]}\n"
+
+    async def _render_ndjson(self) -> AsyncIterator[str]:
+        async for conversation in self._iter_conversations():
+            yield _dumps({"type": "conversation", **conversation}) + "\n"
+            async for message in self._iter_messages(conversation["id"]):
+                yield _dumps({"type": "message", "conversation_id": conversation["id"], **message}) + "\n"
+
+    async def _render_txt(self) -> AsyncIterator[str]:
+        async for conversation in self._iter_conversations():
+            title = conversation.get("title") or conversation["id"]
+            yield f"{'=' * 72}\n{title}\n"
+            yield f"Conversation: {conversation['id']}  Created: {_format_date(conversation.get('created_at'))}\n"
+            yield f"{'=' * 72}\n\n"
+            async for message in self._iter_messages(conversation["id"]):
+                model = f" ({message['model_used']})" if message.get("model_used") else ""
+                yield (
+                    f"[{_format_date(message.get('created_at'))}] "
+                    f"{message.get('role', '').upper()}{model}:\n{message.get('content', '')}\n\n"
+                )
+
+
+def _format_date(value: Optional[datetime]) -> str:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value) if value else "-"
+
+
+async def gzip_stream(chunks: AsyncIterable[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """Comprimir un stream de bytes con gzip sin acumularlo en memoria"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_filename(user_id: str, format: str, compress: bool = False) -> str:
+    """Nombre de archivo sugerido para la descarga"""
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    return f"{user_id}_{timestamp}.{format}" + (".gz" if compress else "")
@@ -0,0 +1,120 @@
+"""
+Benchmark de lecturas proyectadas frente a documentos completos
+
+Inserta `--documents` conversaciones sintéticas (con `metadata` pesada) en
+una colección temporal y las lee con `find_many` de cuatro formas:
+documento completo, proyección `summary` como dict, la misma proyección
+decodificada a un registro con `__slots__` y a un modelo pydantic con
+`model_construct`. Mide tiempo medio por lectura y memoria retenida por
+los resultados. La colección se elimina al terminar.
+
+Necesita el MongoDB configurado en `MONGODB_URI`.
+
+Uso (desde microservices/history-service):
+    python -m utils.projection_benchmark [--documents 10000] [--rounds 5]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import sys
+import os
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+
+from shared.database import BaseRepository, DocumentRecord, get_database_manager
+from shared.history_store import ConversationRepository
+from shared.models import ConversationBase
+
+COLLECTION = "benchmark_projections"
+METADATA = {f"key_{i}": "value " * 20 for i in range(20)}
+
+
+class ConversationSummaryRecord(DocumentRecord):
+    __slots__ = tuple(
+        field for field, include in ConversationRepository.projections["summary"].items() if include
+    )
+
+
+class _ScratchRepository(BaseRepository):
+    projections = ConversationRepository.projections
+
+
+def _synthetic_conversations(total: int) -> list:
+    started = datetime(2024, 1, 1)
+    return [
+        {
+            "id": f"conv-{i}",
+            "user_id": f"user-{i % 100}",
+            "title": f"Conversation {i}",
+            "tags": ["work", "ideas"],
+            "category": "general",
+            "is_favorite": i % 7 == 0,
+            "is_archived": False,
+            "message_count": 40,
+            "total_tokens": 4800,
+            "models_used": ["gpt-3.5-turbo"],
+            "metadata": METADATA,
+            "last_message_at": started + timedelta(minutes=i),
+            "created_at": started + timedelta(minutes=i),
+            "updated_at": started + timedelta(minutes=i)
+        }
+        for i in range(total)
+    ]
+
+
+async def _measure(repository: BaseRepository, total: int, rounds: int, projection, as_type) -> dict:
+    elapsed = 0.0
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await repository.find_many(limit=total, projection=projection, as_type=as_type)
+        elapsed += time.perf_counter() - started
+
+    tracemalloc.start()
+    results = await repository.find_many(limit=total, projection=projection, as_type=as_type)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+
+    return {"seconds": elapsed / rounds, "retained_kb": retained / 1024}
+
+
+async def main(total: int, rounds: int):
+    db_manager = get_database_manager()
+    await db_manager.connect()
+    repository = _ScratchRepository(COLLECTION)
+    variants = [
+        ("full dict", None, None),
+        ("summary dict", "summary", None),
+        ("summary __slots__", "summary", ConversationSummaryRecord),
+        ("summary pydantic", "summary", ConversationBase),
+    ]
+    try:
+        await repository.create_many(_synthetic_conversations(total))
+        results = [
+            (name, await _measure(repository, total, rounds, projection, as_type))
+            for name, projection, as_type in variants
+        ]
+    finally:
+        await repository.get_collection().drop()
+        await db_manager.disconnect()
+
+    baseline = results[0][1]
+    print(f"documents={total} rounds={rounds}")
+    print(f"{'read':>18} {'seconds':>9} {'retained KB':>12} {'vs full':>8}")
+    for name, result in results:
+        print(
+            f"{name:>18} {result['seconds']:>9.3f} {result['retained_kb']:>12.1f} "
+            f"{result['retained_kb'] / baseline['retained_kb']:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Projected vs full document read benchmark")
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.documents, args.rounds))
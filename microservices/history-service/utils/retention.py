@@ -0,0 +1,178 @@
+"""
+Purga de retención por lotes
+
+Elimina las conversaciones con `retention_until` vencido y sus mensajes en
+lotes acotados, con un límite de borrados por segundo y write concern
+`majority` para no adelantarse a la replicación. El progreso se guarda en
+`_schema_meta`: si el proceso se reinicia, la conversación a medio purgar se
+termina primero y los totales se conservan.
+"""
+
+from typing import Optional, Dict, Any, Callable, Awaitable
+from datetime import datetime
+import asyncio
+import logging
+import time
+
+from shared.database import get_database_manager
+from shared.history_store import ConversationRepository, MessageRepository
+
+logger = logging.getLogger(__name__)
+
+RETENTION_STATE_COLLECTION = "_schema_meta"
+RETENTION_STATE_ID = "retention"
+
+
+class RetentionWorker:
+    """Worker de purga de historial vencido"""
+
+    def __init__(
+        self,
+        conversation_repo: ConversationRepository = None,
+        message_repo: MessageRepository = None,
+        batch_size: int = 500,
+        max_deletes_per_second: float = 500.0,
+        interval_seconds: float = 3600.0,
+        on_conversation_purged: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+    ):
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.message_repo = message_repo or MessageRepository()
+        self.batch_size = batch_size
+        self.max_deletes_per_second = max_deletes_per_second
+        self.interval_seconds = interval_seconds
+        self.on_conversation_purged = on_conversation_purged
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "runs": 0,
+            "conversations_deleted": 0,
+            "messages_deleted": 0,
+            "bytes_reclaimed": 0,
+            "last_run": None,
+            "errors": 0
+        }
+
+    def _state_collection(self):
+        return get_database_manager().get_collection(RETENTION_STATE_COLLECTION)
+
+    async def _load_state(self) -> Dict[str, Any]:
+        return await self._state_collection().find_one({"_id": RETENTION_STATE_ID}) or {}
+
+    async def _save_current(self, conversation: Optional[Dict[str, Any]]):
+        await self._state_collection().update_one(
+            {"_id": RETENTION_STATE_ID},
+            {"$set": {"current": conversation, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def _record_progress(self, deleted: Dict[str, int]):
+        await self._state_collection().update_one(
+            {"_id": RETENTION_STATE_ID},
+            {
+                "$inc": {
+                    "totals.conversations_deleted": deleted["conversations"],
+                    "totals.messages_deleted": deleted["messages"],
+                    "totals.bytes_reclaimed": deleted["bytes"]
+                },
+                "$set": {"current": None, "updated_at": datetime.utcnow()}
+            },
+            upsert=True
+        )
+
+    async def _throttle(self, deleted: int, started: float):
+        # Límite de borrados por segundo: esperar lo que falte para el lote
+        if self.max_deletes_per_second <= 0 or deleted == 0:
+            return
+        remaining = deleted / self.max_deletes_per_second - (time.perf_counter() - started)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+    async def purge_conversation(self, conversation: Dict[str, Any]) -> Dict[str, int]:
+        """Borrar los mensajes de una conversación por lotes y luego la conversación"""
+        await self._save_current(conversation)
+        totals = {"conversations": 0, "messages": 0, "bytes": 0}
+
+        while True:
+            started = time.perf_counter()
+            batch = await self.message_repo.purge_batch(conversation["id"], self.batch_size)
+            if batch["deleted"] == 0:
+                break
+            totals["messages"] += batch["deleted"]
+            totals["bytes"] += batch["bytes"]
+            await self._throttle(batch["deleted"], started)
+
+        result = await self.conversation_repo.purge(conversation["id"])
+        totals["conversations"] += result["deleted"]
+        totals["bytes"] += result["bytes"]
+
+        await self._record_progress(totals)
+        if self.on_conversation_purged is not None:
+            await self.on_conversation_purged(conversation)
+
+        self.stats["conversations_deleted"] += totals["conversations"]
+        self.stats["messages_deleted"] += totals["messages"]
+        self.stats["bytes_reclaimed"] += totals["bytes"]
+        return totals
+
+    async def run_once(self) -> Dict[str, int]:
+        """Purgar todo lo vencido hasta ahora"""
+        now = datetime.utcnow()
+        report = {"conversations": 0, "messages": 0, "bytes": 0}
+
+        def add(totals: Dict[str, int]):
+            for key in report:
+                report[key] += totals[key]
+
+        # Reanudar la conversación que quedó a medias
+        state = await self._load_state()
+        if state.get("current"):
+            logger.info(f"Resuming retention purge of conversation {state['current']['id']}")
+            add(await self.purge_conversation(state["current"]))
+
+        while True:
+            expired = await self.conversation_repo.find_expired(now, self.batch_size)
+            if not expired:
+                break
+            for conversation in expired:
+                add(await self.purge_conversation(conversation))
+
+        self.stats["runs"] += 1
+        self.stats["last_run"] = now
+        if report["conversations"] or report["messages"]:
+            logger.info(
+                f"Retention purge: {report['conversations']} conversations, "
+                f"{report['messages']} messages, {report['bytes'] / (1024 * 1024):.1f} MB reclaimed"
+            )
+        return report
+
+    async def report(self) -> Dict[str, Any]:
+        """Totales acumulados (persistidos) y del proceso actual"""
+        state = await self._load_state()
+        return {
+            "totals": state.get("totals", {}),
+            "in_progress": state.get("current"),
+            "process": self.stats
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"Retention purge failed: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        """Iniciar la purga periódica"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener la purga (el checkpoint permite reanudar)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -9,9 +9,12 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from functools import wraps
 import logging
+import uuid
 
 from .exceptions import InvalidTokenException, ExpiredTokenException, InsufficientPermissionsException
 from .config import get_settings
+from .token_revocation import get_revocation_list
+from .token_claims import user_from_claims, encode_permissions, has_permissions, PLAN_CODES
 
 logger = logging.getLogger(__name__)
 security = HTTPBearer()
@@ -45,6 +48,11 @@ class AuthMiddleware:
             exp = payload.get("exp")
             if exp and datetime.utcnow() > datetime.fromtimestamp(exp):
                 raise ExpiredTokenException("Token has expired")
+            
+            # Verificar revocación (en memoria salvo positivo del filtro de Bloom)
+            jti = payload.get("jti")
+            if jti and await get_revocation_list().is_revoked(jti):
+                raise InvalidTokenException("Token has been revoked")
                 
             return payload
             
@@ -58,15 +66,8 @@ class AuthMiddleware:
         self, 
         token_payload: Dict[str, Any] = Depends(verify_token)
     ) -> Dict[str, Any]:
-        """Obtener información del usuario actual"""
-        return {
-            "user_id": token_payload.get("sub"),
-            "email": token_payload.get("email"),
-            "name": token_payload.get("name"),
-            "role": token_payload.get("role", "free"),
-            "permissions": token_payload.get("permissions", []),
-            "subscription_status": token_payload.get("subscription_status", "free"),
-        }
+        """Obtener información del usuario actual (claims compactos o del formato anterior)"""
+        return user_from_claims(token_payload)
 
     def create_access_token(
         self, 
@@ -83,7 +84,7 @@ class AuthMiddleware:
                 minutes=self.settings.ACCESS_TOKEN_EXPIRE_MINUTES
             )
         
-        to_encode.update({"exp": expire})
+        to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
         encoded_jwt = jwt.encode(to_encode, self.secret_key, algorithm=self.algorithm)
         return encoded_jwt
 
@@ -91,7 +92,7 @@ class AuthMiddleware:
         """Crear token de refresh"""
         to_encode = data.copy()
         expire = datetime.utcnow() + timedelta(days=self.settings.REFRESH_TOKEN_EXPIRE_DAYS)
-        to_encode.update({"exp": expire, "type": "refresh"})
+        to_encode.update({"exp": expire, "type": "refresh", "jti": uuid.uuid4().hex})
         encoded_jwt = jwt.encode(to_encode, self.secret_key, algorithm=self.algorithm)
         return encoded_jwt
 
@@ -120,6 +121,8 @@ async def get_current_active_user(
 # Decoradores para permisos
 def require_permissions(required_permissions: list):
     """Decorador para requerir permisos específicos"""
+    required_mask = encode_permissions(required_permissions)
+    
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
@@ -128,14 +131,15 @@ def require_permissions(required_permissions: list):
             if not current_user:
                 raise InvalidTokenException("Authentication required")
             
-            user_permissions = current_user.get("permissions", [])
+            user_mask = current_user.get("permission_mask")
+            if user_mask is None:
+                user_mask = encode_permissions(current_user.get("permissions", []))
             
-            # Verificar permisos
-            for permission in required_permissions:
-                if permission not in user_permissions and "*" not in user_permissions:
-                    raise InsufficientPermissionsException(
-                        f"Permission {permission} required"
-                    )
+            # Verificar permisos con operaciones de bits
+            if not has_permissions(user_mask, required_mask):
+                raise InsufficientPermissionsException(
+                    f"Permissions {', '.join(required_permissions)} required"
+                )
             
             return await func(*args, **kwargs)
         return wrapper
@@ -144,7 +148,7 @@ def require_permissions(required_permissions: list):
 
 def require_subscription(min_plan: str):
     """Decorador para requerir nivel mínimo de suscripción"""
-    plan_hierarchy = {"free": 0, "premium": 1, "enterprise": 2, "admin": 3}
+    min_code = PLAN_CODES.get(min_plan, 0)
     
     def decorator(func):
         @wraps(func)
@@ -153,9 +157,11 @@ def require_subscription(min_plan: str):
             if not current_user:
                 raise InvalidTokenException("Authentication required")
                 
-            user_plan = current_user.get("role", "free")
+            plan_code = current_user.get("plan_code")
+            if plan_code is None:
+                plan_code = PLAN_CODES.get(current_user.get("role", "free"), 0)
             
-            if plan_hierarchy.get(user_plan, 0) < plan_hierarchy.get(min_plan, 0):
+            if plan_code < min_code:
                 raise InsufficientPermissionsException(
                     f"Subscription plan {min_plan} or higher required"
                 )
@@ -0,0 +1,301 @@
+"""
+Almacenamiento direccionado por contenido de textos repetidos o grandes
+
+Los system prompts (que se repiten en cada request) y los mensajes muy
+grandes se guardan una sola vez en la colección `blobs`, con el SHA-256 del
+texto como `id` y un contador de referencias. El mensaje conserva solo el
+digest en `blob_refs` (ruta del campo -> digest):
+
+    {"content": "", "blob_refs": {"content": "<sha256>"}}
+    {"metadata": {}, "blob_refs": {"metadata.system_prompt": "<sha256>"}}
+
+Los blobs se comprimen con el mismo codec que el contenido de los mensajes.
+Un LRU en proceso, acotado por bytes, evita releer los blobs calientes.
+"""
+
+from typing import Optional, Dict, Any, List, Iterable
+from collections import OrderedDict, Counter
+from datetime import datetime
+from pymongo import UpdateOne
+import hashlib
+import logging
+
+from .config import get_settings
+from .content_codec import get_content_codec
+from .database import BaseRepository, ReadConsistency
+
+logger = logging.getLogger(__name__)
+
+BLOB_REFS_FIELD = "blob_refs"
+
+
+def blob_digest(text: str) -> str:
+    """Digest SHA-256 (hex) de un texto"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _get_path(document: Dict[str, Any], path: str) -> Any:
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _set_path(document: Dict[str, Any], path: str, value: Any):
+    *parents, key = path.split(".")
+    for parent in parents:
+        document = document.setdefault(parent, {})
+    document[key] = value
+
+
+def blob_refs_of(documents: Iterable[Dict[str, Any]]) -> Counter:
+    """Referencias por digest de una lista de documentos"""
+    counts = Counter()
+    for document in documents:
+        counts.update((document.get(BLOB_REFS_FIELD) or {}).values())
+    return counts
+
+
+class BlobRepository(BaseRepository):
+    """Repositorio de blobs con contador de referencias"""
+
+    read_consistency = {
+        **BaseRepository.read_consistency,
+        "get_storage_stats": ReadConsistency.ANALYTICS,
+    }
+
+    def __init__(self):
+        super().__init__("blobs")
+
+    async def acquire(self, blobs: Dict[str, str], counts: Dict[str, int]) -> Dict[str, Any]:
+        """Crear los blobs que no existan e incrementar sus referencias"""
+        codec = get_content_codec()
+        now = datetime.utcnow()
+        operations = []
+        for digest, text in blobs.items():
+            document = codec.encode_document({"content": text})
+            document.update({"id": digest, "size": len(text.encode("utf-8")), "created_at": now})
+            operations.append((
+                digest,
+                UpdateOne(
+                    {"id": digest},
+                    {"$setOnInsert": document, "$inc": {"refcount": counts[digest]}},
+                    upsert=True
+                ),
+                document
+            ))
+        return await self._bulk_write(operations)
+
+    async def release(self, counts: Dict[str, int]) -> int:
+        """
+        Decrementar referencias y borrar los blobs que lleguen a cero.
+
+        El borrado filtra por `refcount <= 0` en el propio documento, así que
+        un `acquire` concurrente nunca pierde su blob.
+        """
+        if not counts:
+            return 0
+        await self._bulk_write([
+            (digest, UpdateOne({"id": digest}, {"$inc": {"refcount": -count}}), {"id": digest})
+            for digest, count in counts.items()
+        ])
+        result = await self.get_collection().delete_many(
+            {"id": {"$in": list(counts)}, "refcount": {"$lte": 0}}
+        )
+        return result.deleted_count
+
+    async def get_many(self, digests: List[str]) -> Dict[str, str]:
+        """Textos de los blobs pedidos, ya descomprimidos"""
+        codec = get_content_codec()
+        cursor = self.get_collection().find(
+            {"id": {"$in": digests}}, {"_id": 0, "refcount": 0, "created_at": 0}
+        )
+        return {
+            document["id"]: codec.decode_document(document)["content"]
+            async for document in cursor
+        }
+
+    async def get_storage_stats(self) -> Dict[str, Any]:
+        """Bytes que ocuparían las referencias en línea frente a lo almacenado"""
+        collection = self.get_read_collection("get_storage_stats")
+        stats = await collection.aggregate([
+            {"$group": {
+                "_id": None,
+                "blobs": {"$sum": 1},
+                "references": {"$sum": "$refcount"},
+                "stored_bytes": {"$sum": {"$bsonSize": "$$ROOT"}},
+                "logical_bytes": {"$sum": {"$multiply": ["$size", "$refcount"]}}
+            }}
+        ]).to_list(1)
+        if not stats:
+            return {"blobs": 0, "references": 0, "stored_bytes": 0, "logical_bytes": 0,
+                    "saved_bytes": 0, "dedupe_ratio": None}
+
+        result = stats[0]
+        result.pop("_id")
+        result["saved_bytes"] = result["logical_bytes"] - result["stored_bytes"]
+        result["dedupe_ratio"] = round(result["references"] / result["blobs"], 2) if result["blobs"] else None
+        return result
+
+
+class BlobCache:
+    """LRU en proceso acotado por bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, digest: str) -> Optional[str]:
+        text = self._items.get(digest)
+        if text is None:
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(digest)
+        self.stats["hits"] += 1
+        return text
+
+    def put(self, digest: str, text: str):
+        if digest in self._items:
+            self._items.move_to_end(digest)
+            return
+        size = len(text)
+        if size > self.max_bytes:
+            return
+        self._items[digest] = text
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
+            self.stats["evictions"] += 1
+
+
+class BlobStore:
+    """Externaliza y resuelve los campos de mensaje guardados como blobs"""
+
+    def __init__(
+        self,
+        repository: BlobRepository = None,
+        min_bytes: int = 256,
+        content_min_bytes: int = 16384,
+        cache_max_bytes: int = 32 * 1024 * 1024
+    ):
+        self.repository = repository or BlobRepository()
+        # Ruta del campo -> tamaño mínimo para guardarlo como blob
+        self.fields = {"metadata.system_prompt": min_bytes, "content": content_min_bytes}
+        self.cache = BlobCache(cache_max_bytes)
+        self.stats = {"externalized": 0, "acquire_errors": 0, "released": 0}
+
+    async def externalize(self, documents: List[Dict[str, Any]]) -> int:
+        """
+        Sustituir los campos grandes por su digest (in-place).
+
+        Los documentos que ya tienen `blob_refs` se omiten, así que reintentar
+        con los mismos documentos no cuenta dos veces las referencias.
+        """
+        pending = []
+        blobs: Dict[str, str] = {}
+        counts = Counter()
+        for document in documents:
+            if BLOB_REFS_FIELD in document:
+                continue
+            refs = {}
+            for path, min_bytes in self.fields.items():
+                value = _get_path(document, path)
+                if isinstance(value, str) and len(value) >= min_bytes:
+                    digest = blob_digest(value)
+                    blobs[digest] = value
+                    counts[digest] += 1
+                    refs[path] = digest
+            if refs:
+                pending.append((document, refs))
+        if not pending:
+            return 0
+
+        report = await self.repository.acquire(blobs, counts)
+        failed = {failure["id"] for failure in report["failed"]}
+        if failed:
+            self.stats["acquire_errors"] += len(failed)
+            logger.error(f"Failed to store {len(failed)} blobs, keeping those fields inline")
+
+        externalized = 0
+        for document, refs in pending:
+            refs = {path: digest for path, digest in refs.items() if digest not in failed}
+            if not refs:
+                continue
+            for path, digest in refs.items():
+                self.cache.put(digest, blobs[digest])
+                _set_path(document, path, "")
+            document[BLOB_REFS_FIELD] = refs
+            externalized += 1
+        self.stats["externalized"] += externalized
+        return externalized
+
+    async def resolve(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Restituir el texto de los campos externalizados y quitar `blob_refs`"""
+        referenced = [document for document in documents if document.get(BLOB_REFS_FIELD)]
+        if not referenced:
+            for document in documents:
+                document.pop(BLOB_REFS_FIELD, None)
+            return documents
+
+        texts: Dict[str, str] = {}
+        missing = set()
+        for digest in blob_refs_of(referenced):
+            text = self.cache.get(digest)
+            if text is None:
+                missing.add(digest)
+            else:
+                texts[digest] = text
+        if missing:
+            fetched = await self.repository.get_many(list(missing))
+            for digest, text in fetched.items():
+                self.cache.put(digest, text)
+            texts.update(fetched)
+
+        for document in referenced:
+            for path, digest in document.pop(BLOB_REFS_FIELD).items():
+                if digest in texts:
+                    _set_path(document, path, texts[digest])
+                else:
+                    logger.error(f"Blob {digest} referenced by message {document.get('id')} not found")
+        return documents
+
+    async def release_documents(self, documents: Iterable[Dict[str, Any]]) -> int:
+        """Liberar las referencias de documentos eliminados"""
+        counts = blob_refs_of(documents)
+        if not counts:
+            return 0
+        deleted = await self.repository.release(counts)
+        self.stats["released"] += sum(counts.values())
+        return deleted
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas del proceso (externalización y caché)"""
+        return {
+            **self.stats,
+            "cache": {**self.cache.stats, "bytes": self.cache.size, "entries": len(self.cache)}
+        }
+
+
+# Instancia global del almacén de blobs
+_blob_store = None
+
+
+def get_blob_store() -> BlobStore:
+    """Obtener instancia singleton del almacén de blobs"""
+    global _blob_store
+    if _blob_store is None:
+        settings = get_settings()
+        _blob_store = BlobStore(
+            min_bytes=settings.BLOB_MIN_BYTES,
+            content_min_bytes=settings.BLOB_CONTENT_MIN_BYTES,
+            cache_max_bytes=settings.BLOB_CACHE_MAX_BYTES
+        )
+    return _blob_store
@@ -3,7 +3,7 @@ Configuraciones compartidas entre microservicios
 """
 
 from pydantic_settings import BaseSettings
-from typing import List, Optional
+from typing import List, Optional, Dict
 import os
 
 
@@ -15,12 +15,123 @@ class SharedSettings(BaseSettings):
     JWT_ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     REFRESH_TOKEN_EXPIRE_DAYS: int = 7
+    # Claims compactos (bitmask de permisos + plan como entero). Activar solo
+    # cuando todos los servicios entiendan el formato (ver README de auth-service)
+    JWT_COMPACT_CLAIMS: bool = False
+    JWT_INCLUDE_PII: bool = False  # email y name en el token
+    # Revocación de tokens: jti en Redis + filtro de Bloom local (ver shared/token_revocation.py)
+    TOKEN_REVOCATION_CHANNEL: str = "auth:revoked"
+    TOKEN_REVOCATION_BLOOM_CAPACITY: int = 100000
+    TOKEN_REVOCATION_BLOOM_ERROR_RATE: float = 0.001
+    TOKEN_REVOCATION_RESYNC_SECONDS: float = 300.0
     
     # Database
     MONGODB_URI: str
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 0
+    MONGODB_MAX_CONNECTING: int = 2
+    MONGODB_MAX_IDLE_TIME_MS: Optional[int] = None
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None
+    MONGODB_CONNECT_TIMEOUT_MS: int = 20000
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 30000
+    MONGODB_COMPRESSORS: Optional[str] = None  # p.ej. "zstd,snappy,zlib"
+    MONGODB_ZLIB_COMPRESSION_LEVEL: int = -1
+    MONGODB_MONITORING_ENABLED: bool = True
+    MONGODB_MAX_STALENESS_SECONDS: int = 90  # mínimo 90; -1 = sin límite
+    MONGODB_USE_ANALYTICS_NODES: bool = False
+    DB_AUTO_CREATE_INDEXES: bool = True
+    DB_SLOW_QUERY_MS: float = 100.0  # 0 = desactivar slow-query log
+    DB_EXPLAIN_SLOW_QUERIES: bool = False
+    WRITE_BEHIND_FLUSH_INTERVAL_SECONDS: float = 5.0
+    WRITE_BEHIND_MAX_BATCH_SIZE: int = 500
+    WRITE_BEHIND_MAX_ATTEMPTS: int = 5  # flushes fallidos antes de descartar
+    MESSAGE_BUFFER_FLUSH_INTERVAL_SECONDS: float = 1.0
+    MESSAGE_BUFFER_MAX_BATCH_SIZE: int = 500
+    DB_BATCH_WINDOW_MS: float = 0.0  # 0 = agrupar solo dentro del mismo tick
     
     # Redis
     REDIS_URL: Optional[str] = None
+    REDIS_MAX_CONNECTIONS: int = 20  # total, repartido entre las bases de datos en uso
+    REDIS_POOL_TIMEOUT_SECONDS: float = 5.0
+    REDIS_SOCKET_TIMEOUT_SECONDS: float = 2.0
+    REDIS_RETRY_ON_TIMEOUT: bool = True
+    REDIS_USE_DATABASES: bool = True  # False = todo en DB 0 (Redis Cloud / Cluster)
+    ENABLE_PIPELINE: bool = True
+    PIPELINE_SIZE: int = 100
+    COMPRESSION_THRESHOLD: int = 1024  # bytes
+    # TTL por defecto de cada namespace (segundos)
+    SESSION_TTL: int = 86400
+    LLM_CACHE_TTL: int = 604800
+    RATE_LIMIT_TTL: int = 3600
+    ANALYTICS_TTL: int = 2592000
+    TEMP_DATA_TTL: int = 86400
+    USER_CACHE_TTL: int = 3600
+    # Caché en dos niveles: L1 en proceso + Redis, invalidación por pub/sub
+    CACHE_L1_MAX_BYTES: int = 64 * 1024 * 1024
+    CACHE_INVALIDATION_CHANNEL: str = "cache:invalidate"
+    CACHE_L1_CONSISTENCY: Dict[str, str] = {}  # p.ej. {"user": "none"}; ver shared/tiered_cache.py
+    # Protección contra estampidas en get_or_load (XFetch + stale-while-revalidate + lock)
+    CACHE_XFETCH_BETA: float = 1.0  # >1 refresca antes, 0 desactiva el refresco anticipado
+    CACHE_STALE_TTL_SECONDS: int = 60
+    CACHE_LOCK_TTL_SECONDS: float = 10.0
+    CACHE_LOCK_POLL_INTERVAL_SECONDS: float = 0.05
+    
+    # Compresión de contenido de mensajes (zstd + diccionario)
+    CONTENT_COMPRESSION_ENABLED: bool = True
+    CONTENT_COMPRESSION_MIN_BYTES: int = 256
+    CONTENT_COMPRESSION_LEVEL: int = 3
+    CONTENT_DICT_VERSION: Optional[int] = None  # None = la versión más reciente
+    
+    # Blobs direccionados por contenido (system prompts y mensajes grandes)
+    BLOB_MIN_BYTES: int = 256
+    BLOB_CONTENT_MIN_BYTES: int = 16384
+    BLOB_CACHE_MAX_BYTES: int = 32 * 1024 * 1024
+    BLOB_STATS_CACHE_TTL_SECONDS: int = 300  # agregado global de /stats (history-service)
+    
+    # Búsqueda de mensajes (history-service)
+    SEARCH_INDEX_PATH: str = "./data/search_index"
+    SEARCH_INDEX_SHARDS: int = 8
+    SEARCH_INDEX_POLL_INTERVAL_SECONDS: float = 2.0
+    SEARCH_INDEX_LAG_SECONDS: float = 60.0  # margen para inserciones tardías del buffer
+    SEARCH_MAX_CANDIDATES: int = 2000
+    
+    # Retención de historial
+    RETENTION_ENABLED: bool = True
+    RETENTION_INTERVAL_SECONDS: float = 3600.0
+    RETENTION_BATCH_SIZE: int = 500
+    RETENTION_MAX_DELETES_PER_SECOND: float = 500.0
+    RETENTION_USE_TTL_INDEXES: bool = False  # TTL de MongoDB sobre messages.expire_at
+    
+    # Archivo en frío de conversaciones antiguas (history-service)
+    ARCHIVE_ENABLED: bool = True
+    ARCHIVE_PATH: str = "./data/archive"
+    ARCHIVE_INTERVAL_SECONDS: float = 3600.0
+    ARCHIVE_BATCH_SIZE: int = 100
+    ARCHIVE_SEGMENT_MAX_BYTES: int = 256 * 1024 * 1024
+    ARCHIVE_COMPACTION_MIN_LIVE_RATIO: float = 0.5
+    
+    # Contexto de conversación (chat-service)
+    CONTEXT_CACHE_MAX_CONVERSATIONS: int = 10000
+    CONTEXT_WINDOW_MAX_TOKENS: int = 32000
+    CONTEXT_MAX_PROMPT_TOKENS: Optional[int] = None  # None = ventana completa del modelo
+    CONTEXT_LOAD_MAX_MESSAGES: int = 200
+    CONTEXT_REDIS_ENABLED: bool = False
+    CONTEXT_REDIS_TTL_SECONDS: int = 3600
+    # Resumen de los turnos antiguos cuando la ventana supera el umbral
+    CONTEXT_SUMMARY_ENABLED: bool = False
+    CONTEXT_SUMMARY_THRESHOLD_TOKENS: int = 6000
+    CONTEXT_SUMMARY_KEEP_RECENT_TOKENS: int = 2000
+    CONTEXT_SUMMARY_MAX_TOKENS: int = 500
+    CONTEXT_SUMMARY_MODEL: Optional[str] = None  # None = el más barato disponible
+    CONTEXT_SUMMARY_MAX_CONCURRENCY: int = 4
+    
+    # PDF rendering
+    PDF_RENDER_WORKERS: int = 2
+    PDF_RENDER_MAX_CONCURRENCY: int = 4
+    PDF_SYNC_MAX_MESSAGES: int = 500  # por encima se genera como job
+    PDF_JOB_TTL_SECONDS: int = 3600
+    PDF_OUTPUT_DIR: Optional[str] = None  # None = directorio temporal del sistema
+    PDF_FONT_PATH: Optional[str] = None  # TTF con soporte Unicode
     
     # Logging
     LOG_LEVEL: str = "INFO"
@@ -64,6 +175,8 @@ class SubscriptionPlans:
         "price": 0.00,
         "requests_per_hour": 50,
         "tokens_per_day": 10000,
+        "retention_days": 30,
+        "archive_after_days": 14,
         "models": [LLMProviders.DEEPSEEK, LLMProviders.GEMINI]
     }
     
@@ -72,6 +185,8 @@ class SubscriptionPlans:
         "price": 19.99,
         "requests_per_hour": 500,
         "tokens_per_day": 100000,
+        "retention_days": 365,
+        "archive_after_days": 30,
         "models": ["*"]
     }
     
@@ -80,6 +195,8 @@ class SubscriptionPlans:
         "price": 99.99,
         "requests_per_hour": 5000,
         "tokens_per_day": 1000000,
+        "retention_days": None,  # sin límite
+        "archive_after_days": 90,
         "models": ["*"]
     }
 
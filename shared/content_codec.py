@@ -0,0 +1,347 @@
+"""
+Compresión de `Message.content` con zstd y diccionario
+
+El contenido de los mensajes (markdown, bloques de código, frases repetidas)
+comprime mucho mejor con un diccionario entrenado sobre mensajes reales. Los
+diccionarios se guardan versionados en la colección `compression_dictionaries`;
+cada documento comprimido guarda la versión usada (`content_dict_id`) para
+poder reentrenar sin reescribir lo ya almacenado.
+
+Formato almacenado de un mensaje comprimido:
+    content: bytes (frame zstd)
+    content_encoding: "zstd"
+    content_dict_id: versión del diccionario o None (zstd sin diccionario)
+    content_size: tamaño original en bytes
+
+Los mensajes por debajo del umbral se guardan como texto sin cambios.
+zstandard es opcional: sin él no se comprime y los documentos comprimidos
+no se pueden leer.
+
+Uso (entrenamiento offline y benchmark):
+    python -m shared.content_codec train [--sample 20000] [--dict-size 112640]
+    python -m shared.content_codec bench [--input export.ndjson] [--sample 5000]
+"""
+
+from typing import Optional, Dict, Any, List
+from datetime import datetime
+import threading
+import logging
+
+try:
+    import zstandard as zstd
+except ImportError:  # pragma: no cover - dependencia opcional
+    zstd = None
+
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+DICTIONARIES_COLLECTION = "compression_dictionaries"
+CONTENT_ENCODING = "zstd"
+# Campos de almacenamiento que no deben salir en las respuestas
+STORAGE_FIELDS = ("content_encoding", "content_dict_id", "content_size")
+
+
+class ContentCodecError(Exception):
+    """Contenido almacenado que no se puede decodificar"""
+    pass
+
+
+class ContentCodec:
+    """
+    Codificador/decodificador de contenido de mensajes.
+
+    Compresores y descompresores se crean una vez por hilo y versión de
+    diccionario (precomputado para el nivel): los objetos de zstandard no
+    son thread-safe.
+    """
+
+    def __init__(self, min_bytes: int = 256, level: int = 3, enabled: bool = True):
+        self.min_bytes = min_bytes
+        self.level = level
+        self.enabled = enabled and zstd is not None
+        self.active_dict_id: Optional[int] = None
+        self._dictionaries: Dict[int, Any] = {}
+        self._local = threading.local()
+        self.stats = {"compressed": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0, "decompressed": 0}
+
+    def add_dictionary(self, dict_id: int, data: bytes, activate: bool = True):
+        """Registrar una versión de diccionario"""
+        if zstd is None:
+            return
+        dictionary = zstd.ZstdCompressionDict(data)
+        dictionary.precompute_compress(level=self.level)
+        self._dictionaries[dict_id] = dictionary
+        if activate and (self.active_dict_id is None or dict_id > self.active_dict_id):
+            self.active_dict_id = dict_id
+
+    async def load_dictionaries(self, db, pinned_version: Optional[int] = None):
+        """Cargar todas las versiones (las antiguas hacen falta para leer)"""
+        if zstd is None:
+            logger.warning("zstandard not installed: message content compression disabled")
+            return
+        async for document in db[DICTIONARIES_COLLECTION].find({}):
+            self.add_dictionary(document["_id"], bytes(document["data"]), activate=pinned_version is None)
+        if pinned_version is not None:
+            if pinned_version not in self._dictionaries:
+                raise ContentCodecError(f"Compression dictionary v{pinned_version} not found")
+            self.active_dict_id = pinned_version
+        logger.info(
+            f"Loaded {len(self._dictionaries)} compression dictionaries "
+            f"(active: {self.active_dict_id})"
+        )
+
+    def _thread_cache(self, name: str) -> Dict[Optional[int], Any]:
+        cache = getattr(self._local, name, None)
+        if cache is None:
+            cache = {}
+            setattr(self._local, name, cache)
+        return cache
+
+    def _compressor(self, dict_id: Optional[int]):
+        cache = self._thread_cache("compressors")
+        compressor = cache.get(dict_id)
+        if compressor is None:
+            dictionary = self._dictionaries.get(dict_id) if dict_id is not None else None
+            compressor = zstd.ZstdCompressor(level=self.level, dict_data=dictionary)
+            cache[dict_id] = compressor
+        return compressor
+
+    def _decompressor(self, dict_id: Optional[int]):
+        cache = self._thread_cache("decompressors")
+        decompressor = cache.get(dict_id)
+        if decompressor is None:
+            if dict_id is not None and dict_id not in self._dictionaries:
+                raise ContentCodecError(f"Compression dictionary v{dict_id} not loaded")
+            dictionary = self._dictionaries.get(dict_id) if dict_id is not None else None
+            decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+            cache[dict_id] = decompressor
+        return decompressor
+
+    def encode_document(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """Comprimir `content` en el documento (in-place) si compensa"""
+        content = document.get("content")
+        if not self.enabled or not isinstance(content, str):
+            return document
+
+        raw = content.encode("utf-8")
+        if len(raw) < self.min_bytes:
+            self.stats["skipped"] += 1
+            return document
+
+        dict_id = self.active_dict_id
+        compressed = self._compressor(dict_id).compress(raw)
+        if len(compressed) >= len(raw):
+            self.stats["skipped"] += 1
+            return document
+
+        document["content"] = compressed
+        document["content_encoding"] = CONTENT_ENCODING
+        document["content_dict_id"] = dict_id
+        document["content_size"] = len(raw)
+        self.stats["compressed"] += 1
+        self.stats["bytes_in"] += len(raw)
+        self.stats["bytes_out"] += len(compressed)
+        return document
+
+    def encode_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Comprimir un lote (apto para `asyncio.to_thread`)"""
+        for document in documents:
+            self.encode_document(document)
+        return documents
+
+    def decode_document(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """Descomprimir `content` si está codificado y quitar campos de almacenamiento"""
+        if document.get("content_encoding") == CONTENT_ENCODING:
+            if zstd is None:
+                raise ContentCodecError("zstandard is required to read compressed messages")
+            raw = self._decompressor(document.get("content_dict_id")).decompress(
+                bytes(document["content"]), max_output_size=document.get("content_size", 0)
+            )
+            document["content"] = raw.decode("utf-8")
+            self.stats["decompressed"] += 1
+        for field in STORAGE_FIELDS:
+            document.pop(field, None)
+        return document
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Estadísticas de compresión del proceso"""
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "active_dict_id": self.active_dict_id,
+            "loaded_dictionaries": sorted(self._dictionaries),
+            "ratio": round(self.stats["bytes_in"] / self.stats["bytes_out"], 2) if self.stats["bytes_out"] else None
+        }
+
+
+# Instancia global del codec
+_content_codec = None
+
+
+def get_content_codec() -> ContentCodec:
+    """Obtener instancia singleton del codec de contenido"""
+    global _content_codec
+    if _content_codec is None:
+        settings = get_settings()
+        _content_codec = ContentCodec(
+            min_bytes=settings.CONTENT_COMPRESSION_MIN_BYTES,
+            level=settings.CONTENT_COMPRESSION_LEVEL,
+            enabled=settings.CONTENT_COMPRESSION_ENABLED
+        )
+    return _content_codec
+
+
+async def init_content_codec(db) -> ContentCodec:
+    """Cargar los diccionarios en el codec global"""
+    codec = get_content_codec()
+    await codec.load_dictionaries(db, get_settings().CONTENT_DICT_VERSION)
+    return codec
+
+
+# ---------------------------------------------------------------------------
+# CLI: entrenamiento y benchmark
+# ---------------------------------------------------------------------------
+
+async def _sample_contents(db, size: int) -> List[bytes]:
+    codec = ContentCodec(enabled=False)
+    await codec.load_dictionaries(db)
+    samples = []
+    pipeline = [
+        {"$sample": {"size": size}},
+        {"$project": {"_id": 0, "content": 1, "content_encoding": 1, "content_dict_id": 1, "content_size": 1}}
+    ]
+    async for document in db["messages"].aggregate(pipeline):
+        content = codec.decode_document(document).get("content")
+        if content:
+            samples.append(content.encode("utf-8"))
+    return samples
+
+
+def _read_ndjson(path: str, limit: int) -> List[bytes]:
+    import json
+
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("content"):
+                samples.append(record["content"].encode("utf-8"))
+                if len(samples) >= limit:
+                    break
+    return samples
+
+
+async def _train(db, sample_size: int, dict_size: int) -> int:
+    samples = await _sample_contents(db, sample_size)
+    if len(samples) < 100:
+        raise ContentCodecError(f"Not enough messages to train a dictionary ({len(samples)})")
+
+    dictionary = zstd.train_dictionary(dict_size, samples)
+    latest = await db[DICTIONARIES_COLLECTION].find_one({}, sort=[("_id", -1)])
+    version = (latest["_id"] + 1) if latest else 1
+    await db[DICTIONARIES_COLLECTION].insert_one({
+        "_id": version,
+        "data": dictionary.as_bytes(),
+        "dict_size": len(dictionary.as_bytes()),
+        "sample_size": len(samples),
+        "created_at": datetime.utcnow()
+    })
+    return version
+
+
+def benchmark(samples: List[bytes], dictionary_data: Optional[bytes] = None, level: int = 3) -> List[Dict[str, Any]]:
+    """Comparar gzip, zstd y zstd+diccionario mensaje a mensaje"""
+    import gzip
+    import time
+
+    # Entrenar con la mitad de la muestra y medir con la otra mitad
+    if dictionary_data is None:
+        half = len(samples) // 2
+        dictionary_data = zstd.train_dictionary(112640, samples[:half]).as_bytes()
+        samples = samples[half:]
+    dictionary = zstd.ZstdCompressionDict(dictionary_data)
+    dictionary.precompute_compress(level=level)
+
+    codecs = {
+        "gzip-6": (lambda data: gzip.compress(data, 6), gzip.decompress),
+        f"zstd-{level}": (
+            zstd.ZstdCompressor(level=level).compress,
+            zstd.ZstdDecompressor().decompress
+        ),
+        f"zstd-{level}+dict": (
+            zstd.ZstdCompressor(level=level, dict_data=dictionary).compress,
+            zstd.ZstdDecompressor(dict_data=dictionary).decompress
+        ),
+    }
+
+    total = sum(len(sample) for sample in samples)
+    results = []
+    for name, (compress, decompress) in codecs.items():
+        started = time.perf_counter()
+        compressed = [compress(sample) for sample in samples]
+        compress_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        for frame in compressed:
+            decompress(frame)
+        decompress_seconds = time.perf_counter() - started
+        size = sum(len(frame) for frame in compressed)
+        results.append({
+            "codec": name,
+            "ratio": total / size,
+            "compress_mb_s": total / (1024 * 1024) / compress_seconds,
+            "decompress_mb_s": total / (1024 * 1024) / decompress_seconds
+        })
+    return results
+
+
+async def _main(argv: List[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Message content compression tools")
+    parser.add_argument("command", choices=["train", "bench"])
+    parser.add_argument("--sample", type=int, default=20000)
+    parser.add_argument("--dict-size", type=int, default=112640)
+    parser.add_argument("--input", help="NDJSON con campo content (p.ej. GET /export?format=ndjson)")
+    args = parser.parse_args(argv)
+
+    if zstd is None:
+        print("zstandard is not installed")
+        return 1
+
+    if args.command == "bench" and args.input:
+        samples = _read_ndjson(args.input, args.sample)
+        db_manager = None
+    else:
+        from .database import get_database_manager
+
+        db_manager = get_database_manager()
+        await db_manager.connect()
+    try:
+        if args.command == "train":
+            version = await _train(db_manager.db, args.sample, args.dict_size)
+            print(f"Trained compression dictionary v{version}")
+            return 0
+
+        if db_manager is not None:
+            samples = await _sample_contents(db_manager.db, args.sample)
+    finally:
+        if db_manager is not None:
+            await db_manager.disconnect()
+
+    print(f"{len(samples)} messages, {sum(map(len, samples)) / 1024:.0f} KB")
+    print(f"{'codec':<16} {'ratio':>7} {'comp MB/s':>10} {'decomp MB/s':>12}")
+    for result in benchmark(samples):
+        print(
+            f"{result['codec']:<16} {result['ratio']:>7.2f} "
+            f"{result['compress_mb_s']:>10.1f} {result['decompress_mb_s']:>12.1f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
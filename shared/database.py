@@ -3,32 +3,108 @@ Utilidades para base de datos MongoDB
 """
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo.errors import PyMongoError
-from typing import Optional, Dict, Any
+from pymongo import UpdateOne, DeleteOne
+from pymongo.read_preferences import Primary, SecondaryPreferred
+from pymongo.read_concern import ReadConcern
+from pymongo.errors import PyMongoError, BulkWriteError, ConnectionFailure, ExecutionTimeout, WTimeoutError
+from bson import ObjectId, json_util, encode as bson_encode
+from typing import Optional, Dict, Any, Tuple, List, Callable, Awaitable, Iterable
+import asyncio
+import base64
+import copy
 import logging
 from datetime import datetime
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
-from .exceptions import DatabaseConnectionException
+from .exceptions import DatabaseConnectionException, ValidationException
 from .config import get_settings
+from .db_monitoring import (
+    get_pool_listener, get_command_listener, get_repository_metrics,
+    instrument_class, SlowQueryExplainer
+)
+from .indexes import ensure_indexes, get_index_declarations
 
 logger = logging.getLogger(__name__)
 
 
+class ReadConsistency:
+    """Perfiles de consistencia de lectura para repositorios"""
+    # Leer lo último escrito: login, refresh, lecturas previas a escrituras
+    PRIMARY = "primary"
+    # Listados e historial: toleran datos con `max_staleness` de retraso
+    SECONDARY_PREFERRED = "secondary_preferred"
+    # Agregaciones y estadísticas: nodos de analytics si existen
+    ANALYTICS = "analytics"
+
+
 class DatabaseManager:
     """Manager para conexiones de base de datos MongoDB"""
     
-    def __init__(self, mongodb_uri: str, database_name: str):
+    def __init__(
+        self,
+        mongodb_uri: str,
+        database_name: str,
+        client_options: Optional[Dict[str, Any]] = None,
+        enable_monitoring: bool = True,
+        slow_query_ms: Optional[float] = None,
+        explain_slow_queries: bool = False,
+        max_staleness_seconds: int = -1,
+        analytics_tag_sets: Optional[List[Dict[str, str]]] = None
+    ):
         self.mongodb_uri = mongodb_uri
         self.database_name = database_name
+        self.client_options = client_options or {}
+        self.enable_monitoring = enable_monitoring
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow_queries = explain_slow_queries
+        self.explainer: Optional[SlowQueryExplainer] = None
         self.client: Optional[AsyncIOMotorClient] = None
         self.db: Optional[AsyncIOMotorDatabase] = None
+        self.read_profiles = self._build_read_profiles(max_staleness_seconds, analytics_tag_sets)
+        self._collections: Dict[Tuple[str, Optional[str]], Any] = {}
+    
+    @staticmethod
+    def _build_read_profiles(
+        max_staleness_seconds: int,
+        analytics_tag_sets: Optional[List[Dict[str, str]]]
+    ) -> Dict[str, Dict[str, Any]]:
+        local = ReadConcern("local")
+        return {
+            ReadConsistency.PRIMARY: {
+                "read_preference": Primary(),
+                "read_concern": local
+            },
+            ReadConsistency.SECONDARY_PREFERRED: {
+                "read_preference": SecondaryPreferred(max_staleness=max_staleness_seconds),
+                "read_concern": local
+            },
+            ReadConsistency.ANALYTICS: {
+                # El tag set vacío final permite caer a cualquier secundario
+                "read_preference": SecondaryPreferred(
+                    tag_sets=(analytics_tag_sets + [{}]) if analytics_tag_sets else None,
+                    max_staleness=max_staleness_seconds
+                ),
+                "read_concern": local
+            },
+        }
     
     async def connect(self):
         """Conectar a MongoDB"""
         try:
-            self.client = AsyncIOMotorClient(self.mongodb_uri)
+            options = dict(self.client_options)
+            if self.enable_monitoring:
+                command_listener = get_command_listener()
+                command_listener.slow_threshold_ms = self.slow_query_ms
+                if self.explain_slow_queries and self.slow_query_ms is not None:
+                    self.explainer = SlowQueryExplainer(lambda: self.client)
+                    self.explainer.start()
+                    command_listener.on_slow = self.explainer.submit
+                options["event_listeners"] = [get_pool_listener(), command_listener]
+            
+            self.client = AsyncIOMotorClient(self.mongodb_uri, **options)
             self.db = self.client[self.database_name]
+            self._collections.clear()
             
             # Test de conectividad
             await self.client.admin.command('ping')
@@ -40,6 +116,10 @@ class DatabaseManager:
     
     async def disconnect(self):
         """Desconectar de MongoDB"""
+        if self.explainer is not None:
+            get_command_listener().on_slow = None
+            await self.explainer.stop()
+            self.explainer = None
         if self.client:
             self.client.close()
             logger.info("Disconnected from MongoDB")
@@ -50,12 +130,19 @@ class DatabaseManager:
             result = await self.client.admin.command('ping')
             server_info = await self.client.server_info()
             
-            return {
+            health = {
                 "status": "healthy",
                 "database": self.database_name,
                 "mongodb_version": server_info.get("version"),
-                "ping_result": result
+                "ping_result": result,
+                "compressors": self.client_options.get("compressors")
             }
+            if self.enable_monitoring:
+                health["pool"] = get_pool_listener().snapshot(
+                    self.client_options.get("maxPoolSize")
+                )
+                health["commands"] = get_command_listener().snapshot()
+            return health
         except Exception as e:
             logger.error(f"Database health check failed: {e}")
             return {
@@ -63,11 +150,18 @@ class DatabaseManager:
                 "error": str(e)
             }
     
-    def get_collection(self, collection_name: str):
-        """Obtener una colección"""
-        if not self.db:
+    def get_collection(self, collection_name: str, consistency: Optional[str] = None):
+        """Obtener una colección, opcionalmente con un perfil de lectura"""
+        if self.db is None:
             raise DatabaseConnectionException("Database not connected")
-        return self.db[collection_name]
+        key = (collection_name, consistency)
+        collection = self._collections.get(key)
+        if collection is None:
+            collection = self.db[collection_name]
+            if consistency is not None:
+                collection = collection.with_options(**self.read_profiles[consistency])
+            self._collections[key] = collection
+        return collection
 
 
 # Singleton global para manejo de base de datos
@@ -81,80 +175,660 @@ def get_database_manager() -> DatabaseManager:
         settings = get_settings()
         _db_manager = DatabaseManager(
             settings.MONGODB_URI,
-            "llm_wrapper"  # Base de datos principal
+            "llm_wrapper",  # Base de datos principal
+            client_options=build_client_options(settings),
+            enable_monitoring=settings.MONGODB_MONITORING_ENABLED,
+            slow_query_ms=settings.DB_SLOW_QUERY_MS if settings.DB_SLOW_QUERY_MS > 0 else None,
+            explain_slow_queries=settings.DB_EXPLAIN_SLOW_QUERIES,
+            max_staleness_seconds=settings.MONGODB_MAX_STALENESS_SECONDS,
+            analytics_tag_sets=[{"nodeType": "ANALYTICS"}] if settings.MONGODB_USE_ANALYTICS_NODES else None
         )
     return _db_manager
 
 
+def build_client_options(settings) -> Dict[str, Any]:
+    """Opciones de pool, timeouts y compresión para AsyncIOMotorClient"""
+    options = {
+        "maxPoolSize": settings.MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGODB_MIN_POOL_SIZE,
+        "maxConnecting": settings.MONGODB_MAX_CONNECTING,
+        "connectTimeoutMS": settings.MONGODB_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+    }
+    if settings.MONGODB_MAX_IDLE_TIME_MS is not None:
+        options["maxIdleTimeMS"] = settings.MONGODB_MAX_IDLE_TIME_MS
+    if settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS is not None:
+        options["waitQueueTimeoutMS"] = settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS
+    if settings.MONGODB_COMPRESSORS:
+        # Orden de preferencia negociado con el servidor, p.ej. "zstd,snappy,zlib"
+        options["compressors"] = settings.MONGODB_COMPRESSORS
+        if "zlib" in settings.MONGODB_COMPRESSORS:
+            options["zlibCompressionLevel"] = settings.MONGODB_ZLIB_COMPRESSION_LEVEL
+    return options
+
+
 @asynccontextmanager
 async def get_database():
     """Context manager para obtener conexión a base de datos"""
     db_manager = get_database_manager()
-    if not db_manager.db:
+    if db_manager.db is None:
         await db_manager.connect()
     yield db_manager.db
 
 
-async def create_indexes(db: AsyncIOMotorDatabase):
-    """Crear índices optimizados para la base de datos"""
-    try:
-        # Índices para usuarios
-        await db.users.create_index("email", unique=True)
-        await db.users.create_index("created_at")
-        await db.users.create_index([("email", 1), ("is_active", 1)])
-        
-        # Índices para conversaciones
-        await db.conversations.create_index([("user_id", 1), ("created_at", -1)])
-        await db.conversations.create_index([("user_id", 1), ("is_favorite", 1)])
-        await db.conversations.create_index([("user_id", 1), ("tags", 1)])
-        await db.conversations.create_index("retention_until")
-        
-        # Índice de texto completo para búsqueda
-        await db.conversations.create_index([
-            ("title", "text"),
-            ("tags", "text")
-        ])
+async def create_indexes(db: AsyncIOMotorDatabase, force: bool = False) -> Dict[str, Any]:
+    """Crear índices declarados en `shared.indexes` (idempotente por fingerprint)"""
+    declarations = get_index_declarations(get_settings().RETENTION_USE_TTL_INDEXES)
+    return await ensure_indexes(db, declarations, force=force)
+
+
+class WriteBehindBuffer:
+    """
+    Buffer write-behind para actualizaciones de baja prioridad.
+    
+    Acumula `$set` sobre documentos (p.ej. `last_login`), combina las
+    actualizaciones repetidas al mismo documento y las envía en un único
+    `bulk_write` por colección, ya sea por intervalo o al alcanzar el
+    tamaño de lote.
+    
+    Un lote fallido se reencola; tras `max_attempts` flushes fallidos sus
+    actualizaciones se descartan (`dropped`) para que una caída prolongada
+    de MongoDB no haga crecer el buffer sin límite.
+    """
+    
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        flush_interval: float = 5.0,
+        max_batch_size: int = 500,
+        max_attempts: int = 5
+    ):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+        # (collection, id) -> campos pendientes de $set
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # (collection, id) -> flushes fallidos de sus campos pendientes
+        self._attempts: Dict[Tuple[str, str], int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._size_triggered: Optional[asyncio.Task] = None
+        self._flush_listeners: List[Callable[[str, List[str]], Awaitable[Any]]] = []
+        self.stats = {
+            "enqueued": 0,
+            "coalesced": 0,
+            "flushed_documents": 0,
+            "flushes": 0,
+            "errors": 0,
+            "dropped": 0
+        }
+    
+    def enqueue(self, collection_name: str, id: str, fields: Dict[str, Any]):
+        """Encolar un $set diferido (no bloquea al llamador)"""
+        key = (collection_name, id)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = dict(fields)
+        else:
+            pending.update(fields)
+            self.stats["coalesced"] += 1
+        self.stats["enqueued"] += 1
         
-        # Índices para mensajes
-        await db.messages.create_index([("conversation_id", 1), ("created_at", 1)])
-        await db.messages.create_index([("conversation_id", 1), ("role", 1)])
+        if len(self._pending) >= self.max_batch_size and self._size_triggered is None:
+            self._size_triggered = asyncio.create_task(self._flush_on_size())
+    
+    def add_flush_listener(self, listener: Callable[[str, List[str]], Awaitable[Any]]):
+        """Registrar `listener(collection, ids)`, llamado tras confirmar cada flush (p.ej. invalidar cachés)"""
+        self._flush_listeners.append(listener)
+    
+    async def _flush_on_size(self):
+        try:
+            await self.flush()
+        finally:
+            self._size_triggered = None
+    
+    async def flush(self) -> int:
+        """Enviar todas las actualizaciones pendientes a MongoDB"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            
+            pending, self._pending = self._pending, {}
+            by_collection: Dict[str, list] = {}
+            ids_by_collection: Dict[str, List[str]] = {}
+            for (collection_name, id), fields in pending.items():
+                by_collection.setdefault(collection_name, []).append(
+                    UpdateOne({"id": id}, {"$set": fields})
+                )
+                ids_by_collection.setdefault(collection_name, []).append(id)
+            
+            flushed = 0
+            for collection_name, operations in by_collection.items():
+                ids = ids_by_collection[collection_name]
+                try:
+                    collection = self.db_manager.get_collection(collection_name)
+                    await collection.bulk_write(operations, ordered=False)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.error(
+                        f"Write-behind flush failed for {collection_name} "
+                        f"({len(operations)} updates), requeued: {e}"
+                    )
+                    self._requeue(collection_name, ids, pending)
+                    continue
+                for id in ids:
+                    self._attempts.pop((collection_name, id), None)
+                flushed += len(operations)
+                await self._notify_flushed(collection_name, ids)
+            
+            self.stats["flushed_documents"] += flushed
+            self.stats["flushes"] += 1
+            return flushed
+    
+    def _requeue(
+        self,
+        collection_name: str,
+        ids: List[str],
+        pending: Dict[Tuple[str, str], Dict[str, Any]]
+    ):
+        # Los $set son idempotentes; lo encolado durante el flush es más reciente y prevalece
+        dropped = 0
+        for id in ids:
+            key = (collection_name, id)
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                # Lo encolado durante el flush se conserva y empieza de cero
+                self._attempts.pop(key, None)
+                dropped += 1
+                continue
+            self._attempts[key] = attempts
+            self._pending[key] = {**pending[key], **self._pending.get(key, {})}
+        if dropped:
+            self.stats["dropped"] += dropped
+            logger.error(
+                f"Write-behind dropped {dropped} updates for {collection_name} "
+                f"after {self.max_attempts} failed flushes"
+            )
+    
+    async def _notify_flushed(self, collection_name: str, ids: List[str]):
+        for listener in self._flush_listeners:
+            try:
+                await listener(collection_name, ids)
+            except Exception as e:
+                logger.error(f"Write-behind flush listener failed for {collection_name}: {e}")
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind periodic flush failed: {e}")
+    
+    def start(self):
+        """Iniciar el flush periódico"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Detener el flush periódico y vaciar el buffer"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._size_triggered is not None:
+            await self._size_triggered
+        await self.flush()
+    
+    def pending_count(self) -> int:
+        """Número de documentos con actualizaciones pendientes"""
+        return len(self._pending)
+
+
+_write_behind_buffer = None
+
+
+def get_write_behind_buffer() -> WriteBehindBuffer:
+    """Obtener instancia singleton del buffer write-behind"""
+    global _write_behind_buffer
+    if _write_behind_buffer is None:
+        settings = get_settings()
+        _write_behind_buffer = WriteBehindBuffer(
+            get_database_manager(),
+            flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL_SECONDS,
+            max_batch_size=settings.WRITE_BEHIND_MAX_BATCH_SIZE,
+            max_attempts=settings.WRITE_BEHIND_MAX_ATTEMPTS
+        )
+    return _write_behind_buffer
+
+
+# Caché de lecturas por ID dentro del alcance de una request:
+# (collection, id) -> {projection_key: documento}
+_loader_scope: ContextVar[Optional[Dict[Tuple[str, str], Dict[str, Any]]]] = ContextVar(
+    "loader_scope", default=None
+)
+
+
+class DocumentRecord:
+    """
+    Registro ligero de solo lectura basado en `__slots__`.
+    
+    Las subclases declaran `__slots__` con los campos que necesitan; se
+    construye directamente desde el documento BSON sin validación.
+    """
+    __slots__ = ()
+    
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "DocumentRecord":
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, document.get(name))
+        return record
+    
+    def get(self, name: str, default: Any = None) -> Any:
+        value = getattr(self, name, None)
+        return default if value is None else value
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def projection_key(projection: Optional[Dict[str, Any]]) -> str:
+    """Clave estable para una proyección (None = documento completo)"""
+    if not projection:
+        return "*"
+    return ",".join(f"{k}:{v}" for k, v in sorted(projection.items()))
+
+
+def decode_document(document: Optional[Dict[str, Any]], as_type: Optional[type] = None) -> Any:
+    """
+    Decodificar un documento al tipo pedido sin copias adicionales.
+    
+    Modelos pydantic se construyen con `model_construct` (sin validación);
+    subclases de `DocumentRecord` con `from_document`.
+    """
+    if document is None or as_type is None:
+        return document
+    if hasattr(as_type, "model_construct"):
+        document.pop("_id", None)
+        return as_type.model_construct(**document)
+    return as_type.from_document(document)
+
+
+@contextmanager
+def loader_scope():
+    """
+    Alcance de deduplicación para `find_by_id` (normalmente una request).
+    
+    Dentro del alcance, cada ID se consulta como máximo una vez por
+    colección; las escrituras del repositorio (individuales, masivas o
+    diferidas) invalidan las entradas de sus IDs.
+    """
+    token = _loader_scope.set({})
+    try:
+        yield
+    finally:
+        _loader_scope.reset(token)
+
+
+class BatchLoader:
+    """
+    Loader estilo DataLoader para búsquedas por ID.
+    
+    Agrupa las llamadas `load(id)` hechas en el mismo tick del event loop
+    (o en una ventana corta) en una sola consulta `{"id": {"$in": [...]}}`
+    y resuelve el future de cada llamador.
+    """
+    
+    def __init__(
+        self,
+        db_manager: DatabaseManager,
+        collection_name: str,
+        window_seconds: float = 0.0,
+        max_batch_size: int = 1000,
+        projection: Optional[Dict[str, Any]] = None,
+        consistency: Optional[str] = None
+    ):
+        self.db_manager = db_manager
+        self.collection_name = collection_name
+        self.consistency = consistency
+        self.projection = projection
+        self.projection_key = projection_key(projection)
+        # El `id` es necesario para repartir resultados entre llamadores
+        if projection and any(v for v in projection.values() if v not in (0, False)):
+            self.projection = {**projection, "id": 1}
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._handle: Optional[asyncio.Handle] = None
+        self.stats = {"loads": 0, "batches": 0, "scope_hits": 0}
+    
+    async def load(self, id: str) -> Optional[Dict[str, Any]]:
+        """Cargar un documento por ID, agrupado con el resto del tick"""
+        self.stats["loads"] += 1
+        scope = _loader_scope.get()
+        scope_key = (self.collection_name, id)
+        if scope is not None and self.projection_key in scope.get(scope_key, {}):
+            self.stats["scope_hits"] += 1
+            return copy.deepcopy(scope[scope_key][self.projection_key])
         
-        # Índices para suscripciones
-        await db.subscriptions.create_index("user_id", unique=True)
-        await db.subscriptions.create_index([("status", 1), ("current_period_end", 1)])
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(id, []).append(future)
         
-        # Índices para transacciones
-        await db.transactions.create_index([("user_id", 1), ("created_at", -1)])
-        await db.transactions.create_index("provider_transaction_id", unique=True)
-        await db.transactions.create_index([("status", 1), ("created_at", -1)])
+        if len(self._pending) >= self.max_batch_size:
+            self._dispatch()
+        elif self._handle is None:
+            if self.window_seconds > 0:
+                self._handle = loop.call_later(self.window_seconds, self._dispatch)
+            else:
+                self._handle = loop.call_soon(self._dispatch)
         
-        logger.info("Database indexes created successfully")
+        document = await future
+        if scope is not None:
+            # El alcance guarda su propia copia: el llamador puede modificar la suya
+            scope.setdefault(scope_key, {})[self.projection_key] = copy.deepcopy(document)
+        return document
+    
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        asyncio.ensure_future(self._fetch(batch))
+    
+    async def _fetch(self, batch: Dict[str, List[asyncio.Future]]):
+        self.stats["batches"] += 1
+        try:
+            collection = self.db_manager.get_collection(self.collection_name, self.consistency)
+            ids = list(batch.keys())
+            documents = await collection.find(
+                {"id": {"$in": ids}}, self.projection
+            ).to_list(length=len(ids))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
         
-    except Exception as e:
-        logger.error(f"Failed to create indexes: {e}")
+        by_id = {doc["id"]: doc for doc in documents}
+        for id, futures in batch.items():
+            document = by_id.get(id)
+            for i, future in enumerate(futures):
+                if future.done():
+                    continue
+                # Cada llamador recibe su propia copia (profunda) si el ID se repitió
+                future.set_result(copy.deepcopy(document) if i else document)
+    
+    def forget(self, id: str):
+        """Invalidar un ID (todas sus proyecciones) en el alcance actual"""
+        scope = _loader_scope.get()
+        if scope is not None:
+            scope.pop((self.collection_name, id), None)
+
+
+_batch_loaders: Dict[str, BatchLoader] = {}
+
+
+def get_batch_loader(
+    collection_name: str,
+    projection: Optional[Dict[str, Any]] = None,
+    consistency: Optional[str] = None
+) -> BatchLoader:
+    """Obtener el loader por lotes de una colección, proyección y consistencia"""
+    key = f"{collection_name}|{projection_key(projection)}|{consistency}"
+    loader = _batch_loaders.get(key)
+    if loader is None:
+        settings = get_settings()
+        loader = BatchLoader(
+            get_database_manager(),
+            collection_name,
+            window_seconds=settings.DB_BATCH_WINDOW_MS / 1000,
+            projection=projection,
+            consistency=consistency
+        )
+        _batch_loaders[key] = loader
+    return loader
+
+
+# Paginación keyset (cursor)
+CURSOR_AFTER = "after"
+CURSOR_BEFORE = "before"
+# Tipos admitidos como clave de orden en un cursor: nunca documentos ni
+# listas, que MongoDB interpretaría como operadores (`{"$ne": null}`).
+# Null se admite: `build_keyset_filter` lo trata aparte
+CURSOR_VALUE_TYPES = (str, int, float, datetime, ObjectId, type(None))
+
+
+def encode_cursor(values: List[Any], direction: str = CURSOR_AFTER) -> str:
+    """Codificar claves de orden en un token opaco de continuación"""
+    raw = json_util.dumps({"v": values, "d": direction})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+    """Decodificar un token de continuación"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = json_util.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if raw["d"] not in (CURSOR_AFTER, CURSOR_BEFORE) or not isinstance(raw["v"], list):
+            raise ValueError("malformed cursor")
+        if not all(isinstance(value, CURSOR_VALUE_TYPES) for value in raw["v"]):
+            raise ValueError("unsupported cursor value")
+        return {"values": raw["v"], "direction": raw["d"]}
+    except (ValueError, KeyError, TypeError):
+        raise ValidationException("Invalid pagination cursor")
+
+
+def _get_path(document: Dict[str, Any], path: str) -> Any:
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def build_keyset_filter(
+    sort_keys: List[Tuple[str, int]],
+    values: List[Any],
+    forward: bool = True
+) -> Dict[str, Any]:
+    """
+    Construir el filtro keyset que continúa después (o antes) de `values`.
+    
+    Para orden (a, b, id) genera:
+    a > va OR (a = va AND b > vb) OR (a = va AND b = vb AND id > vid)
+    
+    MongoDB ordena null (y los campos ausentes) antes que cualquier valor y
+    `$gt`/`$lt` nunca los comparan, así que null se trata aparte: después de
+    null en orden ascendente va todo lo no nulo (`$ne: null`), nada va
+    detrás en descendente, y detrás de un valor en descendente van también
+    los nulos (`field: null`).
+    """
+    if len(values) != len(sort_keys):
+        raise ValidationException("Pagination cursor does not match sort order")
+    
+    clauses = []
+    for i, (field, direction) in enumerate(sort_keys):
+        ascending = (direction == 1) == forward
+        prefix = {sort_keys[j][0]: values[j] for j in range(i)}
+        value = values[i]
+        if value is None:
+            if ascending:
+                clauses.append({**prefix, field: {"$ne": None}})
+        elif ascending:
+            clauses.append({**prefix, field: {"$gt": value}})
+        else:
+            clauses.append({**prefix, field: {"$lt": value}})
+            # El desempate `id` nunca es nulo
+            if field != "id":
+                clauses.append({**prefix, field: None})
+    if not clauses:
+        # Cursor en el último documento posible: no hay más páginas
+        return {"$expr": False}
+    return {"$or": clauses}
+
+
+# Límites de troceado para operaciones bulk: margen bajo el límite de
+# 16 MB por comando y lotes acotados para no monopolizar el servidor
+MAX_BULK_CHUNK_BYTES = 14 * 1024 * 1024
+MAX_BULK_CHUNK_OPS = 10000
+# Overhead aproximado por operación dentro del comando
+BULK_OP_OVERHEAD_BYTES = 64
+
+
+def _chunk_operations(items: List[Tuple[int, Any, Any, int]]):
+    """Agrupar (index, id, op, size) en lotes bajo los límites de bulk"""
+    chunk, chunk_bytes = [], 0
+    for item in items:
+        size = item[3] + BULK_OP_OVERHEAD_BYTES
+        if chunk and (chunk_bytes + size > MAX_BULK_CHUNK_BYTES or len(chunk) >= MAX_BULK_CHUNK_OPS):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+# Códigos de servidor que un reintento puede resolver (red, elecciones, conflictos)
+TRANSIENT_ERROR_CODES = frozenset({
+    6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436
+})
+
+
+def is_transient_error(exc: Exception) -> bool:
+    """True si reintentar la operación puede funcionar (red, timeouts, failover)"""
+    if isinstance(exc, (ConnectionFailure, ExecutionTimeout, WTimeoutError)):
+        return True
+    if isinstance(exc, PyMongoError) and exc.has_error_label("RetryableWriteError"):
+        return True
+    return getattr(exc, "code", None) in TRANSIENT_ERROR_CODES
+
+
+def _new_bulk_report(requested: int) -> Dict[str, Any]:
+    return {"requested": requested, "succeeded": 0, "failed": []}
+
+
+def _record_chunk_errors(report: Dict[str, Any], chunk: list, exc: Exception) -> int:
+    """
+    Registrar fallos por ítem; devuelve cuántos ítems del lote fallaron.
+    
+    Cada fallo indica si es `transient` (reintentable) o permanente
+    (validación, documento demasiado grande, clave duplicada...).
+    """
+    if isinstance(exc, BulkWriteError):
+        errors = exc.details.get("writeErrors", [])
+        for error in errors:
+            index, id, _, _ = chunk[error["index"]]
+            report["failed"].append({
+                "index": index,
+                "id": id,
+                "code": error.get("code"),
+                "message": error.get("errmsg"),
+                "transient": error.get("code") in TRANSIENT_ERROR_CODES
+            })
+        return len(errors)
+    
+    # Error a nivel de comando: todo el lote falla
+    transient = is_transient_error(exc)
+    for index, id, _, _ in chunk:
+        report["failed"].append({
+            "index": index,
+            "id": id,
+            "code": getattr(exc, "code", None),
+            "message": str(exc),
+            "transient": transient
+        })
+    return len(chunk)
 
 
 # Helper functions para operaciones comunes
 class BaseRepository:
     """Clase base para repositorios de datos"""
     
+    # Proyecciones con nombre que las subclases pueden declarar
+    projections: Dict[str, Dict[str, Any]] = {}
+    
+    # Consistencia de lectura declarada por método; los métodos no
+    # listados leen del primario
+    read_consistency: Dict[str, str] = {
+        "find_many": ReadConsistency.SECONDARY_PREFERRED,
+        "find_page": ReadConsistency.SECONDARY_PREFERRED,
+        "count_documents": ReadConsistency.SECONDARY_PREFERRED,
+    }
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Medir latencia de cada método público de los repositorios
+        instrument_class(cls)
+    
     def __init__(self, collection_name: str):
         self.collection_name = collection_name
         self.db_manager = get_database_manager()
     
     def get_collection(self):
-        """Obtener la colección"""
+        """Obtener la colección (escrituras y lecturas en el primario)"""
         return self.db_manager.get_collection(self.collection_name)
     
-    async def find_by_id(self, id: str) -> Optional[Dict[str, Any]]:
-        """Buscar documento por ID"""
-        collection = self.get_collection()
-        return await collection.find_one({"id": id})
+    def consistency_for(self, method: str) -> str:
+        """Consistencia de lectura declarada para un método"""
+        return self.read_consistency.get(method, ReadConsistency.PRIMARY)
+    
+    def get_read_collection(self, method: str, consistency: Optional[str] = None):
+        """Obtener la colección configurada para las lecturas de `method`"""
+        return self.db_manager.get_collection(
+            self.collection_name, consistency or self.consistency_for(method)
+        )
+    
+    def resolve_projection(self, projection: Optional[Any]) -> Optional[Dict[str, Any]]:
+        """Resolver una proyección con nombre o explícita"""
+        if projection is None or isinstance(projection, dict):
+            return projection
+        if projection not in self.projections:
+            raise ValueError(f"Unknown projection '{projection}' for {self.collection_name}")
+        return self.projections[projection]
+    
+    async def find_by_id(
+        self,
+        id: str,
+        projection: Optional[Any] = None,
+        as_type: Optional[type] = None,
+        consistency: Optional[str] = None
+    ) -> Optional[Any]:
+        """Buscar documento por ID (agrupado por tick vía BatchLoader)"""
+        loader = get_batch_loader(
+            self.collection_name,
+            self.resolve_projection(projection),
+            consistency or self.consistency_for("find_by_id")
+        )
+        return decode_document(await loader.load(id), as_type)
+    
+    async def find_one(
+        self,
+        filter_dict: Dict[str, Any],
+        projection: Optional[Any] = None,
+        as_type: Optional[type] = None,
+        consistency: Optional[str] = None
+    ) -> Optional[Any]:
+        """Buscar un documento con proyección y tipo opcionales"""
+        collection = self.get_read_collection("find_one", consistency)
+        document = await collection.find_one(filter_dict, self.resolve_projection(projection))
+        return decode_document(document, as_type)
     
     async def create(self, data: Dict[str, Any]) -> str:
         """Crear nuevo documento"""
         collection = self.get_collection()
         result = await collection.insert_one(data)
+        self._forget([data.get("id")])
         return data.get("id")
     
     async def update_by_id(self, id: str, data: Dict[str, Any]) -> bool:
@@ -163,46 +837,279 @@ class BaseRepository:
         # Agregar timestamp de actualización
         data["updated_at"] = datetime.utcnow()
         result = await collection.update_one({"id": id}, {"$set": data})
+        self._forget([id])
         return result.modified_count > 0
     
+    def update_by_id_deferred(self, id: str, data: Dict[str, Any]):
+        """
+        Actualizar documento por ID vía write-behind.
+        
+        Solo para campos informativos: la escritura se confirma en el
+        siguiente flush del buffer, no antes de responder.
+        """
+        get_write_behind_buffer().enqueue(self.collection_name, id, {**data, "updated_at": datetime.utcnow()})
+        self._forget([id])
+    
     async def delete_by_id(self, id: str) -> bool:
         """Eliminar documento por ID"""
         collection = self.get_collection()
         result = await collection.delete_one({"id": id})
+        self._forget([id])
         return result.deleted_count > 0
     
+    async def create_many(self, documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Crear múltiples documentos con `insert_many(ordered=False)`.
+        
+        Los lotes se trocean para respetar el límite de 16 MB; los fallos
+        se reportan por ítem (índice en la lista de entrada e `id`).
+        """
+        collection = self.get_collection()
+        report = _new_bulk_report(len(documents))
+        items = [
+            (i, doc.get("id"), doc, len(bson_encode(doc)))
+            for i, doc in enumerate(documents)
+        ]
+        
+        for chunk in _chunk_operations(items):
+            try:
+                result = await collection.insert_many([doc for _, _, doc, _ in chunk], ordered=False)
+                report["succeeded"] += len(result.inserted_ids)
+            except PyMongoError as e:
+                failed = _record_chunk_errors(report, chunk, e)
+                report["succeeded"] += len(chunk) - failed
+        
+        self._forget(id for _, id, _, _ in items)
+        return report
+    
+    async def update_many_by_ids(self, updates: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Actualizar múltiples documentos (`id -> campos`) con `bulk_write`"""
+        now = datetime.utcnow()
+        operations = [
+            (id, UpdateOne({"id": id}, {"$set": {**data, "updated_at": now}}), data)
+            for id, data in updates.items()
+        ]
+        return await self._bulk_write(operations)
+    
+    async def upsert_many(
+        self,
+        documents: List[Dict[str, Any]],
+        key: str = "id"
+    ) -> Dict[str, Any]:
+        """
+        Insertar o actualizar múltiples documentos por `key`.
+        
+        Los documentos sin `key` no se envían (un upsert sobre `{key: None}`
+        alcanzaría cualquier documento sin el campo) y se reportan como
+        fallidos junto al resto.
+        """
+        now = datetime.utcnow()
+        operations = []
+        rejected = {}
+        for index, doc in enumerate(documents):
+            if doc.get(key) is None:
+                rejected[index] = {
+                    "index": index,
+                    "id": doc.get("id"),
+                    "code": None,
+                    "message": f"Missing upsert key '{key}'",
+                    "transient": False
+                }
+                continue
+            fields = {k: v for k, v in doc.items() if k not in ("_id", "created_at")}
+            fields["updated_at"] = now
+            operations.append((
+                doc.get(key),
+                UpdateOne(
+                    {key: doc[key]},
+                    {"$set": fields, "$setOnInsert": {"created_at": doc.get("created_at", now)}},
+                    upsert=True
+                ),
+                doc
+            ))
+        report = await self._bulk_write(operations, rejected)
+        if key != "id":
+            self._forget(doc.get("id") for doc in documents)
+        return report
+    
+    async def delete_many_by_ids(self, ids: List[str]) -> Dict[str, Any]:
+        """Eliminar múltiples documentos por ID con `bulk_write`"""
+        operations = [(id, DeleteOne({"id": id}), {"id": id}) for id in ids]
+        return await self._bulk_write(operations)
+    
+    async def _bulk_write(
+        self,
+        operations: List[Tuple[Any, Any, Dict[str, Any]]],
+        rejected: Optional[Dict[int, Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """
+        Ejecutar operaciones `(id, op, payload)` en lotes no ordenados.
+        
+        `rejected` son los fallos detectados antes de enviar, por índice de
+        la entrada; las operaciones ocupan el resto de índices en orden.
+        """
+        collection = self.get_collection()
+        rejected = rejected or {}
+        report = _new_bulk_report(len(operations) + len(rejected))
+        report.update({"matched": 0, "modified": 0, "upserted": 0, "deleted": 0})
+        report["failed"].extend(rejected.values())
+        positions = [i for i in range(report["requested"]) if i not in rejected]
+        items = [
+            (positions[i], id, op, len(bson_encode(payload)))
+            for i, (id, op, payload) in enumerate(operations)
+        ]
+        
+        for chunk in _chunk_operations(items):
+            try:
+                result = await collection.bulk_write([op for _, _, op, _ in chunk], ordered=False)
+                details = result.bulk_api_result
+                failed = 0
+            except PyMongoError as e:
+                details = e.details if isinstance(e, BulkWriteError) else {}
+                failed = _record_chunk_errors(report, chunk, e)
+            
+            report["succeeded"] += len(chunk) - failed
+            report["matched"] += details.get("nMatched", 0)
+            report["modified"] += details.get("nModified", 0)
+            report["upserted"] += details.get("nUpserted", 0)
+            report["deleted"] += details.get("nRemoved", 0)
+        
+        self._forget(id for id, _, _ in operations)
+        return report
+    
+    def _forget(self, ids: Iterable[Any]):
+        """Invalidar los IDs escritos en el alcance de `loader_scope` actual"""
+        loader = get_batch_loader(self.collection_name)
+        for id in ids:
+            if id is not None:
+                loader.forget(id)
+    
     async def find_many(
         self, 
         filter_dict: Dict[str, Any] = None, 
         skip: int = 0, 
         limit: int = 100,
-        sort: Dict[str, int] = None
+        sort: Dict[str, int] = None,
+        projection: Optional[Any] = None,
+        as_type: Optional[type] = None,
+        consistency: Optional[str] = None
     ) -> list:
         """Buscar múltiples documentos con paginación"""
-        collection = self.get_collection()
-        cursor = collection.find(filter_dict or {})
+        collection = self.get_read_collection("find_many", consistency)
+        cursor = collection.find(filter_dict or {}, self.resolve_projection(projection))
         
         if sort:
             cursor = cursor.sort(list(sort.items()))
         
         cursor = cursor.skip(skip).limit(limit)
-        return await cursor.to_list(length=limit)
+        documents = await cursor.to_list(length=limit)
+        if as_type is None:
+            return documents
+        return [decode_document(doc, as_type) for doc in documents]
     
-    async def count_documents(self, filter_dict: Dict[str, Any] = None) -> int:
+    async def find_page(
+        self,
+        filter_dict: Dict[str, Any] = None,
+        sort: Dict[str, int] = None,
+        limit: int = 20,
+        cursor: Optional[str] = None,
+        projection: Optional[Any] = None,
+        consistency: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Buscar documentos con paginación keyset (cursor).
+        
+        El token de continuación codifica las claves de orden del último
+        (o primer) documento más `id` como desempate, por lo que el coste
+        por página es constante sin importar la profundidad. El orden debe
+        estar respaldado por un índice.
+        """
+        sort_keys = list((sort or {"created_at": -1}).items())
+        if not any(field == "id" for field, _ in sort_keys):
+            sort_keys.append(("id", sort_keys[-1][1]))
+        
+        forward = True
+        query = filter_dict or {}
+        if cursor:
+            decoded = decode_cursor(cursor)
+            forward = decoded["direction"] == CURSOR_AFTER
+            keyset = build_keyset_filter(sort_keys, decoded["values"], forward)
+            query = {"$and": [query, keyset]} if query else keyset
+        
+        projection = self.resolve_projection(projection)
+        if projection and any(v for v in projection.values() if v not in (0, False)):
+            projection = {**projection, **{field: 1 for field, _ in sort_keys}}
+        
+        query_sort = sort_keys if forward else [(f, -d) for f, d in sort_keys]
+        collection = self.get_read_collection("find_page", consistency)
+        db_cursor = collection.find(query, projection).sort(query_sort).limit(limit + 1)
+        items = await db_cursor.to_list(length=limit + 1)
+        
+        has_more = len(items) > limit
+        items = items[:limit]
+        if not forward:
+            items.reverse()
+        
+        if forward:
+            has_next, has_previous = has_more, cursor is not None
+        else:
+            has_next, has_previous = True, has_more
+        
+        def keys_of(document):
+            return [_get_path(document, field) for field, _ in sort_keys]
+        
+        return {
+            "items": items,
+            "next_cursor": encode_cursor(keys_of(items[-1]), CURSOR_AFTER) if has_next and items else None,
+            "previous_cursor": encode_cursor(keys_of(items[0]), CURSOR_BEFORE) if has_previous and items else None,
+            "has_next": has_next and bool(items),
+            "has_previous": has_previous and bool(items),
+            "page_size": limit
+        }
+    
+    async def count_documents(
+        self,
+        filter_dict: Dict[str, Any] = None,
+        consistency: Optional[str] = None
+    ) -> int:
         """Contar documentos que coinciden con el filtro"""
-        collection = self.get_collection()
+        collection = self.get_read_collection("count_documents", consistency)
         return await collection.count_documents(filter_dict or {})
 
 
+instrument_class(BaseRepository)
+
+
+def get_database_metrics() -> Dict[str, Any]:
+    """Métricas de repositorios, comandos y consultas lentas para /metrics"""
+    db_manager = get_database_manager()
+    command_listener = get_command_listener()
+    return {
+        "repositories": get_repository_metrics().snapshot(),
+        "commands": command_listener.snapshot(),
+        "slow_queries": command_listener.recent_slow_queries(),
+        "slow_query_plans": list(db_manager.explainer.recent_plans) if db_manager.explainer else [],
+        "slow_query_threshold_ms": db_manager.slow_query_ms
+    }
+
+
 # Inicialización de la base de datos para aplicaciones FastAPI
 async def init_database():
     """Inicializar conexión a base de datos"""
     db_manager = get_database_manager()
     await db_manager.connect()
-    await create_indexes(db_manager.db)
+    # En producción los índices se construyen con `python -m shared.indexes`
+    if get_settings().DB_AUTO_CREATE_INDEXES:
+        try:
+            await create_indexes(db_manager.db)
+        except PyMongoError as e:
+            logger.error(f"Failed to create indexes: {e}")
+    get_write_behind_buffer().start()
 
 
 async def close_database():
     """Cerrar conexión a base de datos"""
+    # Vaciar escrituras diferidas antes de cerrar el cliente
+    await get_write_behind_buffer().stop()
     db_manager = get_database_manager()
     await db_manager.disconnect()
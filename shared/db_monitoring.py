@@ -0,0 +1,467 @@
+"""
+Instrumentación del driver de MongoDB (pool de conexiones y comandos)
+"""
+
+from pymongo import monitoring
+from typing import Dict, Any, List, Optional, Tuple, Callable
+from collections import deque
+from functools import wraps
+import asyncio
+import bisect
+import inspect
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Campos de sesión/driver que no forman parte de la consulta
+_DRIVER_FIELDS = {"lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "signature"}
+# Comandos con filtro cuyo plan se puede obtener con `explain`
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct"}
+
+
+# Límites superiores de los buckets de latencia (milisegundos)
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class LatencyHistogram:
+    """Histograma de latencias con buckets fijos (thread-safe)"""
+    
+    def __init__(self, buckets: List[float] = None):
+        self.buckets = buckets or LATENCY_BUCKETS_MS
+        # Un bucket extra para valores por encima del último límite
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+    
+    def record(self, value_ms: float):
+        """Registrar una observación"""
+        index = bisect.bisect_left(self.buckets, value_ms)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total_ms += value_ms
+            if value_ms > self.max_ms:
+                self.max_ms = value_ms
+    
+    def percentile(self, q: float) -> float:
+        """Estimar el percentil `q` (0-100) como límite superior del bucket"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            target = self.count * q / 100
+            cumulative = 0
+            for index, bucket_count in enumerate(self.counts):
+                cumulative += bucket_count
+                if cumulative >= target:
+                    return self.buckets[index] if index < len(self.buckets) else self.max_ms
+            return self.max_ms
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Resumen serializable del histograma"""
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": {
+                (f"le_{bound}" if i < len(self.buckets) else "inf"): count
+                for i, (bound, count) in enumerate(zip(self.buckets + [None], self.counts))
+            }
+        }
+
+
+def redact_shape(value: Any) -> Any:
+    """Forma de un filtro/pipeline con los valores reemplazados por `?`"""
+    if isinstance(value, dict):
+        return {key: redact_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Un solo elemento basta para describir la forma de listas/$in
+        return [redact_shape(value[0])] if value else []
+    return "?"
+
+
+def command_shape(command: Dict[str, Any]) -> Dict[str, Any]:
+    """Extraer la forma redactada de las partes relevantes de un comando"""
+    shape = {}
+    for field in ("filter", "query", "pipeline", "sort", "updates", "deletes"):
+        if field in command:
+            shape[field] = redact_shape(command[field])
+    if "sort" in shape:
+        # Las direcciones de orden no son datos sensibles
+        shape["sort"] = command["sort"]
+    return shape
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Estado del pool: conexiones abiertas, en uso y tiempo de espera"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Los checkouts ocurren en el hilo que ejecuta la operación
+        self._local = threading.local()
+        self.open_connections = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkout_failures: Dict[str, int] = {}
+        self.pool_clear_count = 0
+        self.wait_time = LatencyHistogram()
+    
+    def pool_created(self, event):
+        logger.debug(f"Connection pool created for {event.address}")
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clear_count += 1
+        logger.warning(f"Connection pool cleared for {event.address}")
+    
+    def pool_closed(self, event):
+        pass
+    
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections = max(0, self.open_connections - 1)
+    
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+    
+    def connection_check_out_failed(self, event):
+        self._record_wait()
+        reason = str(event.reason)
+        with self._lock:
+            self.checkout_failures[reason] = self.checkout_failures.get(reason, 0) + 1
+    
+    def connection_checked_out(self, event):
+        self._record_wait()
+        with self._lock:
+            self.checked_out += 1
+            if self.checked_out > self.max_checked_out:
+                self.max_checked_out = self.checked_out
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+    
+    def _record_wait(self):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.wait_time.record((time.perf_counter() - started) * 1000)
+            self._local.started = None
+    
+    def snapshot(self, max_pool_size: Optional[int] = None) -> Dict[str, Any]:
+        """Resumen del estado del pool"""
+        with self._lock:
+            data = {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkout_failures": dict(self.checkout_failures),
+                "pool_clear_count": self.pool_clear_count,
+            }
+        data["wait_time"] = self.wait_time.snapshot()
+        if max_pool_size:
+            data["max_pool_size"] = max_pool_size
+            data["saturation"] = round(data["checked_out"] / max_pool_size, 3)
+        return data
+
+
+class CommandStatsListener(monitoring.CommandListener):
+    """
+    Histogramas de latencia por colección y comando, más slow-query log.
+    
+    Los comandos por encima de `slow_threshold_ms` se registran con la
+    forma del filtro (valores redactados) y, si hay `on_slow`, se le
+    entregan para capturar su `explain()`.
+    """
+    
+    # Comandos internos que no aportan a la latencia de la aplicación
+    IGNORED_COMMANDS = {
+        "hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue",
+        "explain", "endSessions", "killCursors"
+    }
+    
+    def __init__(
+        self,
+        slow_threshold_ms: Optional[float] = None,
+        on_slow: Optional[Callable[[Dict[str, Any]], None]] = None
+    ):
+        self._lock = threading.Lock()
+        self._inflight: Dict[Tuple[Any, int], Tuple[str, Any]] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.failures: Dict[str, int] = {}
+        self.slow_threshold_ms = slow_threshold_ms
+        self.on_slow = on_slow
+        self.slow_counts: Dict[str, int] = {}
+        self.recent_slow = deque(maxlen=50)
+    
+    def started(self, event):
+        if event.command_name in self.IGNORED_COMMANDS:
+            return
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        # Solo se retiene el comando si puede hacer falta para el slow log
+        command = event.command if self.slow_threshold_ms is not None else None
+        with self._lock:
+            self._inflight[(event.connection_id, event.request_id)] = (
+                f"{collection}.{event.command_name}", command
+            )
+    
+    def succeeded(self, event):
+        self._finish(event)
+    
+    def failed(self, event):
+        key = self._finish(event)
+        if key:
+            with self._lock:
+                self.failures[key] = self.failures.get(key, 0) + 1
+    
+    def _finish(self, event) -> Optional[str]:
+        with self._lock:
+            inflight = self._inflight.pop((event.connection_id, event.request_id), None)
+            if inflight is None:
+                return None
+            key, command = inflight
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+        
+        duration_ms = event.duration_micros / 1000
+        histogram.record(duration_ms)
+        if self.slow_threshold_ms is not None and duration_ms >= self.slow_threshold_ms:
+            self._record_slow(event, key, command, duration_ms)
+        return key
+    
+    def _record_slow(self, event, key: str, command: Optional[Dict[str, Any]], duration_ms: float):
+        command = {k: v for k, v in (command or {}).items() if k not in _DRIVER_FIELDS}
+        shape = command_shape(command)
+        entry = {
+            "command": key,
+            "duration_ms": round(duration_ms, 3),
+            "shape": shape,
+            "database": event.database_name,
+            "at": time.time()
+        }
+        with self._lock:
+            self.slow_counts[key] = self.slow_counts.get(key, 0) + 1
+            self.recent_slow.append(entry)
+        logger.warning(
+            f"Slow MongoDB command {key}: {duration_ms:.1f}ms "
+            f"shape={json.dumps(shape, default=str, sort_keys=True)}"
+        )
+        if self.on_slow and event.command_name in EXPLAINABLE_COMMANDS:
+            try:
+                self.on_slow({**entry, "raw_command": command})
+            except Exception as e:
+                logger.debug(f"Slow query hook failed: {e}")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Latencias por `coleccion.comando`"""
+        with self._lock:
+            histograms = dict(self.histograms)
+            failures = dict(self.failures)
+            slow_counts = dict(self.slow_counts)
+        return {
+            key: {
+                **histogram.snapshot(),
+                "failures": failures.get(key, 0),
+                "slow": slow_counts.get(key, 0)
+            }
+            for key, histogram in sorted(histograms.items())
+        }
+    
+    def recent_slow_queries(self) -> List[Dict[str, Any]]:
+        """Últimas consultas lentas (forma redactada, sin valores)"""
+        with self._lock:
+            return list(self.recent_slow)
+
+
+def summarize_plan(plan: Dict[str, Any]) -> str:
+    """Resumir un winningPlan como cadena de etapas, p.ej. `FETCH <- IXSCAN(email_1)`"""
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage = f"{stage}({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+class SlowQueryExplainer:
+    """
+    Captura `explain()` de consultas lentas en segundo plano.
+    
+    El listener del driver corre en hilos del executor de Motor; las
+    consultas se encolan al event loop y se explican con un cooldown por
+    forma para no amplificar la carga.
+    """
+    
+    def __init__(self, client_getter: Callable[[], Any], cooldown_seconds: float = 300.0):
+        self.client_getter = client_getter
+        self.cooldown_seconds = cooldown_seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_explained: Dict[str, float] = {}
+        self.recent_plans = deque(maxlen=20)
+    
+    def start(self):
+        """Iniciar el worker en el event loop actual"""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=100)
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Detener el worker"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def submit(self, entry: Dict[str, Any]):
+        """Encolar una consulta lenta (seguro desde cualquier hilo)"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._enqueue, entry)
+    
+    def _enqueue(self, entry: Dict[str, Any]):
+        signature = f"{entry['command']}:{json.dumps(entry['shape'], default=str, sort_keys=True)}"
+        now = time.monotonic()
+        if now - self._last_explained.get(signature, -self.cooldown_seconds) < self.cooldown_seconds:
+            return
+        self._last_explained[signature] = now
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            pass
+    
+    async def _run(self):
+        while True:
+            entry = await self._queue.get()
+            try:
+                client = self.client_getter()
+                result = await client[entry["database"]].command(
+                    {"explain": entry["raw_command"], "verbosity": "queryPlanner"}
+                )
+                winning_plan = result.get("queryPlanner", {}).get("winningPlan", {})
+                summary = summarize_plan(winning_plan)
+                self.recent_plans.append({
+                    "command": entry["command"],
+                    "shape": entry["shape"],
+                    "duration_ms": entry["duration_ms"],
+                    "plan": summary
+                })
+                logger.warning(f"Slow MongoDB command {entry['command']} plan: {summary}")
+            except Exception as e:
+                logger.debug(f"Explain for slow command {entry['command']} failed: {e}")
+
+
+class RepositoryMetrics:
+    """Latencia y errores por método de repositorio"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.errors: Dict[str, int] = {}
+    
+    def record(self, key: str, duration_ms: float, failed: bool = False):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        histogram.record(duration_ms)
+        if failed:
+            with self._lock:
+                self.errors[key] = self.errors.get(key, 0) + 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """p50/p95/p99 por `Repositorio.metodo`"""
+        with self._lock:
+            histograms = dict(self.histograms)
+            errors = dict(self.errors)
+        return {
+            key: {**histogram.snapshot(), "errors": errors.get(key, 0)}
+            for key, histogram in sorted(histograms.items())
+        }
+
+
+def instrument_method(name: str, method: Callable) -> Callable:
+    """Envolver un método async de repositorio para medir su latencia"""
+    
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await method(self, *args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            get_repository_metrics().record(
+                f"{type(self).__name__}.{name}",
+                (time.perf_counter() - started) * 1000,
+                failed
+            )
+    
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+def instrument_class(cls: type):
+    """Instrumentar los métodos async públicos definidos en `cls`"""
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.iscoroutinefunction(attribute):
+            continue
+        if getattr(attribute, "__instrumented__", False):
+            continue
+        setattr(cls, name, instrument_method(name, attribute))
+
+
+# Listeners globales (uno por proceso)
+_pool_listener = None
+_command_listener = None
+_repository_metrics = None
+
+
+def get_pool_listener() -> PoolStatsListener:
+    """Obtener listener singleton del pool"""
+    global _pool_listener
+    if _pool_listener is None:
+        _pool_listener = PoolStatsListener()
+    return _pool_listener
+
+
+def get_command_listener() -> CommandStatsListener:
+    """Obtener listener singleton de comandos"""
+    global _command_listener
+    if _command_listener is None:
+        _command_listener = CommandStatsListener()
+    return _command_listener
+
+
+def get_repository_metrics() -> RepositoryMetrics:
+    """Obtener métricas singleton de repositorios"""
+    global _repository_metrics
+    if _repository_metrics is None:
+        _repository_metrics = RepositoryMetrics()
+    return _repository_metrics
@@ -43,6 +43,11 @@ class UserNotFoundException(NotFoundException):
     pass
 
 
+class ConversationNotFoundException(NotFoundException):
+    """Conversación no encontrada"""
+    pass
+
+
 class UserAlreadyExistsException(BaseServiceException):
     """Usuario ya existe"""
     pass
@@ -96,6 +101,7 @@ def handle_service_exception(exc: BaseServiceException) -> HTTPException:
         "ValidationException": status.HTTP_400_BAD_REQUEST,
         "NotFoundException": status.HTTP_404_NOT_FOUND,
         "UserNotFoundException": status.HTTP_404_NOT_FOUND,
+        "ConversationNotFoundException": status.HTTP_404_NOT_FOUND,
         "PermissionDeniedException": status.HTTP_403_FORBIDDEN,
         "InsufficientPermissionsException": status.HTTP_403_FORBIDDEN,
         "InvalidTokenException": status.HTTP_401_UNAUTHORIZED,
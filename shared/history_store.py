@@ -0,0 +1,783 @@
+"""
+Persistencia de conversaciones y mensajes
+
+Repositorios sobre `BaseRepository` para las colecciones `conversations` y
+`messages`, y un buffer asíncrono en proceso para que chat-service persista
+mensajes sin añadir latencia a la respuesta. El contenido se comprime al
+persistir (ver `content_codec`) y se descomprime solo donde se lee; los
+system prompts y los mensajes muy grandes se guardan una vez en `blobs`
+(ver `blob_store`).
+"""
+
+from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, WriteConcern
+import asyncio
+import logging
+
+from .config import get_settings, SubscriptionPlans
+from .content_codec import get_content_codec, STORAGE_FIELDS
+from .blob_store import get_blob_store, blob_refs_of, BLOB_REFS_FIELD
+from .database import BaseRepository, ReadConsistency
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Longitud máxima del título generado a partir del primer mensaje
+AUTO_TITLE_MAX_LENGTH = 80
+# Código de error de MongoDB para clave duplicada
+DUPLICATE_KEY_ERROR = 11000
+# Las purgas esperan a la mayoría: el ritmo de borrado sigue a la replicación
+PURGE_WRITE_CONCERN = WriteConcern(w="majority")
+
+
+def retention_days_for_plan(plan: str) -> Optional[int]:
+    """Días de retención del plan (None = sin límite)"""
+    config = getattr(SubscriptionPlans, (plan or "").upper(), None)
+    return config.get("retention_days") if config else None
+
+
+class ConversationRepository(BaseRepository):
+    """Repositorio para conversaciones"""
+
+    read_consistency = {
+        **BaseRepository.read_consistency,
+        "get_user_statistics": ReadConsistency.ANALYTICS,
+        "iter_for_user": ReadConsistency.SECONDARY_PREFERRED,
+    }
+
+    projections = {
+        # Listados: sin metadata
+        "summary": {
+            "_id": 0, "id": 1, "title": 1, "tags": 1, "category": 1,
+            "is_favorite": 1, "is_archived": 1, "message_count": 1,
+            "total_tokens": 1, "models_used": 1, "last_message_at": 1,
+            "created_at": 1, "updated_at": 1, "archived_at": 1
+        }
+    }
+
+    def __init__(self):
+        super().__init__("conversations")
+
+    async def get_for_user(
+        self,
+        conversation_id: str,
+        user_id: str,
+        projection: Optional[Any] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Obtener una conversación verificando el propietario"""
+        return await self.find_one(
+            {"id": conversation_id, "user_id": user_id},
+            projection or {"_id": 0}
+        )
+
+    async def list_for_user(
+        self,
+        user_id: str,
+        cursor: Optional[str] = None,
+        limit: int = 20,
+        is_favorite: Optional[bool] = None,
+        tag: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Listar conversaciones del usuario (paginación keyset)"""
+        filter_dict = {"user_id": user_id}
+        if is_favorite is not None:
+            filter_dict["is_favorite"] = is_favorite
+        if tag:
+            filter_dict["tags"] = tag
+
+        return await self.find_page(
+            filter_dict,
+            sort={"created_at": -1},
+            limit=limit,
+            cursor=cursor,
+            projection="summary"
+        )
+
+    def iter_for_user(
+        self,
+        user_id: str,
+        conversation_ids: Optional[List[str]] = None,
+        batch_size: int = 100
+    ):
+        """Cursor sobre las conversaciones del usuario (para exportación)"""
+        filter_dict = {"user_id": user_id}
+        if conversation_ids:
+            filter_dict["id"] = {"$in": conversation_ids}
+        collection = self.get_read_collection("iter_for_user")
+        return collection.find(
+            filter_dict, self.resolve_projection("summary")
+        ).sort([("user_id", 1), ("created_at", -1)]).batch_size(batch_size)
+
+    def iter_updated_since(self, since: datetime, batch_size: int = 500):
+        """Cursor sobre conversaciones modificadas desde `since`"""
+        return self.get_collection().find(
+            {"updated_at": {"$gt": since}},
+            {"_id": 0, "id": 1, "user_id": 1, "tags": 1, "updated_at": 1}
+        ).sort("updated_at", 1).batch_size(batch_size)
+
+    async def update_for_user(
+        self,
+        conversation_id: str,
+        user_id: str,
+        update_data: Dict[str, Any]
+    ) -> bool:
+        """Actualizar campos editables de una conversación"""
+        update_data["updated_at"] = datetime.utcnow()
+        result = await self.get_collection().update_one(
+            {"id": conversation_id, "user_id": user_id},
+            {"$set": update_data}
+        )
+        return result.matched_count > 0
+
+    async def delete_for_user(self, conversation_id: str, user_id: str) -> bool:
+        """Eliminar una conversación del usuario"""
+        result = await self.get_collection().delete_one(
+            {"id": conversation_id, "user_id": user_id}
+        )
+        return result.deleted_count > 0
+
+    async def apply_deltas(self, deltas: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Aplicar contadores acumulados por conversación en un `bulk_write`.
+
+        Cada delta se traduce en un upsert con `$inc` de mensajes/tokens,
+        `$max` de `last_message_at` y `$addToSet` de modelos; la
+        conversación se crea en el primer mensaje.
+        """
+        now = datetime.utcnow()
+        operations = []
+        for conversation_id, delta in deltas.items():
+            update = {
+                "$inc": {
+                    "message_count": delta["message_count"],
+                    "total_tokens": delta["total_tokens"]
+                },
+                "$max": {
+                    "last_message_at": delta["last_message_at"],
+                    "updated_at": now
+                },
+                "$setOnInsert": {
+                    "id": conversation_id,
+                    "user_id": delta["user_id"],
+                    "title": delta.get("title") or "New conversation",
+                    "tags": [],
+                    "category": None,
+                    "is_favorite": False,
+                    "is_archived": False,
+                    "metadata": {},
+                    "created_at": delta["first_message_at"]
+                }
+            }
+            # La conversación expira cuando expira su último mensaje
+            if delta.get("retention_until"):
+                update["$max"]["retention_until"] = delta["retention_until"]
+            elif delta.get("plan"):
+                # Plan sin límite (p.ej. tras pasar a enterprise): se anula la fecha anterior
+                update["$set"] = {"retention_until": None}
+            else:
+                update["$setOnInsert"]["retention_until"] = None
+            if delta.get("plan"):
+                update.setdefault("$set", {})["plan"] = delta["plan"]
+            if delta["models_used"]:
+                update["$addToSet"] = {"models_used": {"$each": sorted(delta["models_used"])}}
+            operations.append((
+                conversation_id,
+                UpdateOne({"id": conversation_id, "user_id": delta["user_id"]}, update, upsert=True),
+                {"id": conversation_id}
+            ))
+        return await self._bulk_write(operations)
+
+    async def find_archivable(
+        self,
+        plans: List[Optional[str]],
+        before: datetime,
+        limit: int
+    ) -> List[Dict[str, Any]]:
+        """
+        Conversaciones inactivas desde `before` con mensajes sin archivar.
+
+        Una recuperación del archivo (`restored_at`) cuenta como actividad:
+        sin ello cada lectura de una conversación fría la restauraría y el
+        siguiente ciclo la archivaría de nuevo.
+        """
+        cursor = self.get_collection().find(
+            {
+                "plan": {"$in": plans},
+                "last_message_at": {"$lt": before},
+                "$and": [
+                    {"$or": [
+                        {"archived_until": None},
+                        {"$expr": {"$gt": ["$last_message_at", "$archived_until"]}}
+                    ]},
+                    {"$or": [{"restored_at": None}, {"restored_at": {"$lt": before}}]}
+                ]
+            },
+            {"_id": 0, "id": 1, "user_id": 1, "last_message_at": 1, "archived_until": 1}
+        ).sort("last_message_at", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def mark_archived(self, conversation_id: str, last_message_at: datetime, archive_bytes: int) -> bool:
+        """Marcar el stub como archivado si no llegaron mensajes desde la lectura"""
+        result = await self.get_collection().update_one(
+            {"id": conversation_id, "last_message_at": last_message_at},
+            {"$set": {
+                "archived_at": datetime.utcnow(),
+                "archived_until": last_message_at,
+                "archive_bytes": archive_bytes
+            }}
+        )
+        return result.modified_count > 0
+
+    async def mark_restored(self, conversation_id: str, restored_at: Optional[datetime] = None) -> bool:
+        """Quitar la marca de archivado del stub (y anotar `restored_at` si se indica)"""
+        fields = {"archived_at": None, "archived_until": None, "archive_bytes": 0}
+        if restored_at is not None:
+            fields["restored_at"] = restored_at
+        result = await self.get_collection().update_one({"id": conversation_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    async def set_summary(
+        self,
+        conversation_id: str,
+        user_id: str,
+        summary: str,
+        summary_until: datetime,
+        summarized_tokens: int
+    ) -> bool:
+        """Guardar el resumen de los mensajes hasta `summary_until` (sin pisar uno más reciente)"""
+        result = await self.get_collection().update_one(
+            {
+                "id": conversation_id,
+                "user_id": user_id,
+                "$or": [{"summary_until": None}, {"summary_until": {"$lt": summary_until}}]
+            },
+            {"$set": {
+                "summary": summary,
+                "summary_until": summary_until,
+                "summarized_tokens": summarized_tokens
+            }}
+        )
+        return result.matched_count > 0
+
+    async def find_expired(self, before: datetime, limit: int) -> List[Dict[str, Any]]:
+        """Conversaciones con `retention_until` vencido (más antiguas primero)"""
+        cursor = self.get_collection().find(
+            {"retention_until": {"$lt": before}},
+            {"_id": 0, "id": 1, "user_id": 1, "retention_until": 1}
+        ).sort("retention_until", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def purge(self, conversation_id: str) -> Dict[str, int]:
+        """Eliminar una conversación ya vaciada; devuelve documentos y bytes"""
+        collection = self.get_collection()
+        document = await collection.find_one(
+            {"id": conversation_id}, {"_id": 1, "size": {"$bsonSize": "$$ROOT"}}
+        )
+        if document is None:
+            return {"deleted": 0, "bytes": 0}
+        result = await collection.with_options(write_concern=PURGE_WRITE_CONCERN).delete_one(
+            {"_id": document["_id"]}
+        )
+        return {"deleted": result.deleted_count, "bytes": document["size"] if result.deleted_count else 0}
+
+    async def get_user_statistics(self, user_id: str) -> Dict[str, Any]:
+        """Estadísticas agregadas de uso del usuario"""
+        collection = self.get_read_collection("get_user_statistics")
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {
+                "$group": {
+                    "_id": None,
+                    "total_conversations": {"$sum": 1},
+                    "total_messages": {"$sum": "$message_count"},
+                    "total_tokens": {"$sum": "$total_tokens"},
+                    "favorite_conversations": {"$sum": {"$cond": ["$is_favorite", 1, 0]}},
+                    "first_conversation": {"$min": "$created_at"},
+                    "last_message_at": {"$max": "$last_message_at"}
+                }
+            },
+            {"$project": {"_id": 0}}
+        ]
+        stats = await collection.aggregate(pipeline).to_list(length=1)
+        if not stats:
+            return {
+                "total_conversations": 0,
+                "total_messages": 0,
+                "total_tokens": 0,
+                "favorite_conversations": 0,
+                "first_conversation": None,
+                "last_message_at": None
+            }
+
+        result = stats[0]
+        result["avg_tokens_per_message"] = result["total_tokens"] / max(result["total_messages"], 1)
+        return result
+
+
+class MessageRepository(BaseRepository):
+    """Repositorio para mensajes"""
+
+    projections = {
+        "export": {
+            "_id": 0, "id": 1, "role": 1, "content": 1, "model_used": 1,
+            "tokens_used": 1, "parent_message_id": 1, "created_at": 1,
+            f"{BLOB_REFS_FIELD}.content": 1,
+            **{field: 1 for field in STORAGE_FIELDS}
+        },
+        "without_content": {
+            "_id": 0, "content": 0, f"{BLOB_REFS_FIELD}.content": 0,
+            **{field: 0 for field in STORAGE_FIELDS}
+        }
+    }
+
+    def __init__(self):
+        super().__init__("messages")
+
+    async def list_for_conversation(
+        self,
+        conversation_id: str,
+        cursor: Optional[str] = None,
+        limit: int = 50,
+        include_content: bool = True,
+        user_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Listar mensajes de una conversación en orden cronológico (solo los de `user_id` si se indica)"""
+        filter_dict = {"conversation_id": conversation_id}
+        if user_id is not None:
+            filter_dict["user_id"] = user_id
+        page = await self.find_page(
+            filter_dict,
+            sort={"created_at": 1},
+            limit=limit,
+            cursor=cursor,
+            projection={"_id": 0} if include_content else self.resolve_projection("without_content")
+        )
+        if include_content:
+            codec = get_content_codec()
+            page["items"] = [codec.decode_document(item) for item in page["items"]]
+        await get_blob_store().resolve(page["items"])
+        return page
+
+    async def list_recent_for_user(
+        self,
+        conversation_id: str,
+        user_id: str,
+        limit: int,
+        after: Optional[datetime] = None
+    ) -> List[Dict[str, Any]]:
+        """Últimos `limit` mensajes de una conversación del usuario (posteriores a `after`), en orden cronológico"""
+        filter_dict = {"conversation_id": conversation_id, "user_id": user_id}
+        if after is not None:
+            filter_dict["created_at"] = {"$gt": after}
+        cursor = self.get_collection().find(
+            filter_dict,
+            {
+                "_id": 0, "role": 1, "content": 1, "created_at": 1,
+                f"{BLOB_REFS_FIELD}.content": 1,
+                **{field: 1 for field in STORAGE_FIELDS}
+            }
+        ).sort([("conversation_id", 1), ("created_at", -1)]).limit(limit)
+        codec = get_content_codec()
+        documents = [codec.decode_document(document) async for document in cursor]
+        await get_blob_store().resolve(documents)
+        documents.reverse()
+        return documents
+
+    async def iter_for_conversation(
+        self,
+        conversation_id: str,
+        batch_size: int = 500,
+        user_id: Optional[str] = None
+    ):
+        """
+        Mensajes de una conversación en orden cronológico, ya descomprimidos.
+
+        Recorre el índice `(conversation_id, created_at)`; `batch_size`
+        acota cuántos documentos hay en memoria a la vez. Con `user_id`
+        solo se devuelven los mensajes de ese usuario.
+        """
+        codec = get_content_codec()
+        blob_store = get_blob_store()
+        filter_dict = {"conversation_id": conversation_id}
+        if user_id is not None:
+            filter_dict["user_id"] = user_id
+        cursor = self.get_collection().find(
+            filter_dict, self.resolve_projection("export")
+        ).sort([("conversation_id", 1), ("created_at", 1)]).batch_size(batch_size)
+        async for document in cursor:
+            (document,) = await blob_store.resolve([codec.decode_document(document)])
+            yield document
+
+    async def iter_created_between(
+        self,
+        start: datetime,
+        end: Optional[datetime] = None,
+        batch_size: int = 1000
+    ):
+        """Mensajes con `start < created_at < end`, descomprimidos (indexación incremental)"""
+        created_at = {"$gt": start}
+        if end is not None:
+            created_at["$lt"] = end
+        codec = get_content_codec()
+        blob_store = get_blob_store()
+        cursor = self.get_collection().find(
+            {"created_at": created_at},
+            {
+                "_id": 0, "id": 1, "conversation_id": 1, "user_id": 1, "role": 1,
+                "content": 1, "model_used": 1, "created_at": 1,
+                f"{BLOB_REFS_FIELD}.content": 1,
+                **{field: 1 for field in STORAGE_FIELDS}
+            }
+        ).sort("created_at", 1).batch_size(batch_size)
+        async for document in cursor:
+            (document,) = await blob_store.resolve([codec.decode_document(document)])
+            yield document
+
+    async def list_for_archive(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """Mensajes de una conversación tal como están almacenados (sin descomprimir)"""
+        cursor = self.get_collection().find(
+            {"conversation_id": conversation_id}, {"_id": 0}
+        ).sort([("conversation_id", 1), ("created_at", 1)])
+        return await cursor.to_list(length=None)
+
+    async def delete_by_ids(self, message_ids: List[str], chunk_size: int = 1000) -> int:
+        """Eliminar mensajes por `id` en lotes"""
+        deleted = 0
+        for start in range(0, len(message_ids), chunk_size):
+            result = await self.get_collection().delete_many(
+                {"id": {"$in": message_ids[start:start + chunk_size]}}
+            )
+            deleted += result.deleted_count
+        return deleted
+
+    async def discard(self, message_ids: List[str]) -> int:
+        """Eliminar mensajes recién insertados que no deben quedarse (y liberar sus blobs)"""
+        collection = self.get_collection()
+        documents = await collection.find(
+            {"id": {"$in": message_ids}}, {"_id": 1, BLOB_REFS_FIELD: 1}
+        ).to_list(length=None)
+        if not documents:
+            return 0
+        result = await collection.delete_many({"_id": {"$in": [document["_id"] for document in documents]}})
+        await self._release_if_all_deleted(documents, result.deleted_count)
+        return result.deleted_count
+
+    async def purge_batch(self, conversation_id: str, limit: int) -> Dict[str, int]:
+        """
+        Eliminar hasta `limit` mensajes de una conversación.
+
+        Los tamaños se leen con `$bsonSize` en la misma consulta que los
+        `_id`, y el borrado usa write concern `majority`. Las referencias a
+        blobs se liberan después, solo si se borró el lote completo.
+        """
+        collection = self.get_collection()
+        documents = await collection.find(
+            {"conversation_id": conversation_id},
+            {"_id": 1, BLOB_REFS_FIELD: 1, "size": {"$bsonSize": "$$ROOT"}}
+        ).limit(limit).to_list(length=limit)
+        if not documents:
+            return {"deleted": 0, "bytes": 0}
+
+        result = await collection.with_options(write_concern=PURGE_WRITE_CONCERN).delete_many(
+            {"_id": {"$in": [document["_id"] for document in documents]}}
+        )
+        reclaimed = sum(document["size"] for document in documents)
+        if result.deleted_count < len(documents):
+            # Borrados concurrentes: estimar en proporción
+            reclaimed = reclaimed * result.deleted_count // len(documents)
+        await self._release_if_all_deleted(documents, result.deleted_count)
+        return {"deleted": result.deleted_count, "bytes": reclaimed}
+
+    async def delete_for_conversation(self, conversation_id: str) -> int:
+        """Eliminar todos los mensajes de una conversación y liberar sus blobs"""
+        collection = self.get_collection()
+        deleted = 0
+        referencing = await collection.find(
+            {"conversation_id": conversation_id, BLOB_REFS_FIELD: {"$exists": True}},
+            {"_id": 1, BLOB_REFS_FIELD: 1}
+        ).to_list(length=None)
+        if referencing:
+            result = await collection.delete_many(
+                {"_id": {"$in": [document["_id"] for document in referencing]}}
+            )
+            deleted += result.deleted_count
+            await self._release_if_all_deleted(referencing, result.deleted_count)
+        result = await collection.delete_many({"conversation_id": conversation_id})
+        return deleted + result.deleted_count
+
+    async def _release_if_all_deleted(self, documents: List[Dict[str, Any]], deleted_count: int):
+        """
+        Liberar los blobs de `documents` si este borrado los eliminó todos.
+
+        Con un borrado parcial otro proceso eliminó parte de los documentos
+        y no se sabe cuáles: liberarlos dos veces podría borrar un blob aún
+        referenciado, mientras que no liberarlos solo deja referencias de más.
+        """
+        if deleted_count == len(documents):
+            await get_blob_store().release_documents(documents)
+        elif blob_refs_of(documents):
+            logger.warning(
+                f"Skipped blob release for {len(documents)} messages: "
+                f"only {deleted_count} deleted by this process"
+            )
+
+
+class MessagePersistenceBuffer:
+    """
+    Buffer asíncrono de mensajes de chat.
+
+    `add_message` no bloquea: los mensajes se insertan con `insert_many` y
+    los contadores de cada conversación se combinan en un único upsert por
+    flush. Los fallos transitorios se reencolan, los permanentes se
+    descartan y registran, y `stop()` vacía el buffer antes de cerrar.
+
+    El upsert filtra por `{id, user_id}`: si la conversación es de otro
+    usuario falla con clave duplicada y los mensajes del lote para esa
+    conversación se eliminan.
+    """
+
+    def __init__(
+        self,
+        message_repo: MessageRepository = None,
+        conversation_repo: ConversationRepository = None,
+        flush_interval: float = 1.0,
+        max_batch_size: int = 500
+    ):
+        self.message_repo = message_repo or MessageRepository()
+        self.conversation_repo = conversation_repo or ConversationRepository()
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._messages: List[Dict[str, Any]] = []
+        self._deltas: Dict[str, Dict[str, Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._size_triggered: Optional[asyncio.Task] = None
+        self.stats = {
+            "messages_enqueued": 0,
+            "messages_persisted": 0,
+            "conversation_updates": 0,
+            "messages_dropped": 0,
+            "conversation_updates_dropped": 0,
+            "flushes": 0,
+            "errors": 0
+        }
+
+    def add_message(
+        self,
+        user_id: str,
+        message: Message,
+        retention_days: Optional[int] = None,
+        plan: Optional[str] = None
+    ):
+        """Encolar un mensaje para persistir (no bloquea al llamador)"""
+        pending = self._deltas.get(message.conversation_id)
+        if pending is not None and pending["user_id"] != user_id:
+            # Mismo id de conversación pendiente para otro usuario: solo uno puede quedársela
+            self.stats["messages_dropped"] += 1
+            logger.error(f"Dropped message {message.id}: conversation {message.conversation_id} is pending for another user")
+            return
+        message.user_id = user_id
+        document = message.model_dump()
+        expire_at = None
+        if retention_days:
+            expire_at = message.created_at + timedelta(days=retention_days)
+            document["expire_at"] = expire_at
+        self._messages.append(document)
+        self._merge_delta(message.conversation_id, {
+            "user_id": user_id,
+            "message_count": 1,
+            "total_tokens": message.tokens_used,
+            "first_message_at": message.created_at,
+            "last_message_at": message.created_at,
+            "models_used": {message.model_used} if message.model_used else set(),
+            "title": message.content[:AUTO_TITLE_MAX_LENGTH] if message.role == "user" else None,
+            "retention_until": expire_at,
+            "plan": plan
+        })
+        self.stats["messages_enqueued"] += 1
+
+        if len(self._messages) >= self.max_batch_size and self._size_triggered is None:
+            self._size_triggered = asyncio.create_task(self._flush_on_size())
+
+    def _merge_delta(self, conversation_id: str, delta: Dict[str, Any]):
+        current = self._deltas.get(conversation_id)
+        if current is None:
+            self._deltas[conversation_id] = delta
+            return
+        current["message_count"] += delta["message_count"]
+        current["total_tokens"] += delta["total_tokens"]
+        current["first_message_at"] = min(current["first_message_at"], delta["first_message_at"])
+        current["last_message_at"] = max(current["last_message_at"], delta["last_message_at"])
+        current["models_used"] |= delta["models_used"]
+        current["title"] = current["title"] or delta["title"]
+        current["plan"] = delta.get("plan") or current.get("plan")
+        if delta["retention_until"]:
+            current["retention_until"] = max(current["retention_until"] or delta["retention_until"], delta["retention_until"])
+
+    async def _flush_on_size(self):
+        try:
+            await self.flush()
+        finally:
+            self._size_triggered = None
+
+    async def flush(self) -> int:
+        """Persistir los mensajes y contadores pendientes"""
+        async with self._flush_lock:
+            if not self._messages and not self._deltas:
+                return 0
+
+            messages, self._messages = self._messages, []
+            deltas, self._deltas = self._deltas, {}
+            persisted = 0
+            dropped_ids = set()
+
+            if messages:
+                try:
+                    # Blobs y compresión son idempotentes en reintentos
+                    await get_blob_store().externalize(messages)
+                    for message in messages:
+                        # El índice TTL no libera blobs: los purga el worker de retención
+                        if BLOB_REFS_FIELD in message:
+                            message.pop("expire_at", None)
+                    await asyncio.to_thread(get_content_codec().encode_documents, messages)
+                    report = await self.message_repo.create_many(messages)
+                    persisted = report["succeeded"]
+                    # Duplicados = ya persistidos en un intento anterior
+                    failures = [
+                        failure for failure in report["failed"]
+                        if failure["code"] != DUPLICATE_KEY_ERROR
+                    ]
+                    retry = [messages[failure["index"]] for failure in failures if failure["transient"]]
+                    if retry:
+                        self.stats["errors"] += 1
+                        logger.error(f"Failed to persist {len(retry)} messages, requeued")
+                        self._messages = retry + self._messages
+                    dropped = [failure for failure in failures if not failure["transient"]]
+                    self._drop_permanent("messages_dropped", "message", dropped)
+                    # Los contadores solo cuentan mensajes que se van a guardar
+                    for failure in dropped:
+                        dropped_ids.add(failure["id"])
+                        self._subtract(deltas, messages[failure["index"]])
+                except Exception as e:
+                    # Blobs, compresión o MongoDB: nada del lote se pierde
+                    self.stats["errors"] += 1
+                    logger.error(f"Message flush failed, requeued {len(messages)} messages: {e}")
+                    self._messages = messages + self._messages
+
+            if deltas:
+                try:
+                    report = await self.conversation_repo.apply_deltas(deltas)
+                    # Una clave duplicada aquí es una conversación de otro usuario: no se reintenta
+                    retry_ids = {failure["id"] for failure in report["failed"] if failure["transient"]}
+                    if retry_ids:
+                        self.stats["errors"] += 1
+                        logger.error(f"Failed to update {len(retry_ids)} conversations, requeued")
+                    for conversation_id in retry_ids:
+                        self._merge_delta(conversation_id, deltas[conversation_id])
+                    rejected = [failure for failure in report["failed"] if not failure["transient"]]
+                    self._drop_permanent("conversation_updates_dropped", "conversation update", rejected)
+                    await self._discard_orphans(
+                        [message for message in messages if message["id"] not in dropped_ids],
+                        {failure["id"] for failure in rejected}
+                    )
+                    self.stats["conversation_updates"] += len(deltas) - len(report["failed"])
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"Conversation counters flush failed, requeued: {e}")
+                    for conversation_id, delta in deltas.items():
+                        self._merge_delta(conversation_id, delta)
+
+            self.stats["messages_persisted"] += persisted
+            self.stats["flushes"] += 1
+            return persisted
+
+    @staticmethod
+    def _subtract(deltas: Dict[str, Dict[str, Any]], message: Dict[str, Any]):
+        delta = deltas.get(message["conversation_id"])
+        if delta is None:
+            return
+        delta["message_count"] -= 1
+        delta["total_tokens"] -= message.get("tokens_used") or 0
+        if delta["message_count"] <= 0:
+            # Sin mensajes que guardar no se crea ni se toca la conversación
+            del deltas[message["conversation_id"]]
+
+    async def _discard_orphans(self, messages: List[Dict[str, Any]], conversation_ids: set):
+        # Mensajes del lote para conversaciones rechazadas (de otro usuario)
+        if not conversation_ids:
+            return
+        orphans = [message for message in messages if message["conversation_id"] in conversation_ids]
+        orphan_ids = {message["id"] for message in orphans}
+        # Los reencolados por un fallo transitorio tampoco se reintentan
+        self._messages = [message for message in self._messages if message["id"] not in orphan_ids]
+        self.stats["messages_dropped"] += len(orphans)
+        try:
+            await self.message_repo.discard(list(orphan_ids))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Failed to discard {len(orphan_ids)} messages of rejected conversations: {e}")
+        logger.error(f"Dropped {len(orphans)} messages of conversations owned by another user")
+
+    def _drop_permanent(self, stat: str, label: str, failures: List[Dict[str, Any]]):
+        # Reintentar un error permanente (validación, tamaño, clave ajena) no lo resuelve
+        if not failures:
+            return
+        self.stats["errors"] += 1
+        self.stats[stat] += len(failures)
+        for failure in failures:
+            logger.error(
+                f"Dropped {label} {failure['id']} after permanent write error "
+                f"(code {failure['code']}): {failure['message']}"
+            )
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Message buffer periodic flush failed: {e}")
+
+    def start(self):
+        """Iniciar el flush periódico"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener el flush periódico y vaciar el buffer"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._size_triggered is not None:
+            await self._size_triggered
+        await self.flush()
+        if self._messages or self._deltas:
+            logger.error(
+                f"Message buffer stopped with {len(self._messages)} messages and "
+                f"{len(self._deltas)} conversation updates not persisted"
+            )
+
+    def pending_count(self) -> int:
+        """Número de mensajes pendientes de persistir"""
+        return len(self._messages)
+
+
+# Instancia global del buffer de mensajes
+_message_buffer = None
+
+
+def get_message_buffer() -> MessagePersistenceBuffer:
+    """Obtener instancia singleton del buffer de mensajes"""
+    global _message_buffer
+    if _message_buffer is None:
+        settings = get_settings()
+        _message_buffer = MessagePersistenceBuffer(
+            flush_interval=settings.MESSAGE_BUFFER_FLUSH_INTERVAL_SECONDS,
+            max_batch_size=settings.MESSAGE_BUFFER_MAX_BATCH_SIZE
+        )
+    return _message_buffer
@@ -0,0 +1,214 @@
+"""
+Declaración y bootstrap idempotente de índices MongoDB
+
+Los índices se declaran por colección; cada colección se construye con un
+único comando `createIndexes` y las colecciones en paralelo. Un fingerprint
+por colección guardado en `_schema_meta` permite omitir el trabajo cuando
+la declaración no cambió.
+
+Uso como migración (fuera del arranque de los pods):
+    python -m shared.indexes [--force]
+"""
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from typing import Dict, Any, List
+from datetime import datetime
+import asyncio
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_META_COLLECTION = "_schema_meta"
+INDEX_META_ID = "indexes"
+
+
+# Índices declarados por colección
+INDEX_DECLARATIONS: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("created_at", ASCENDING)]),
+        IndexModel([("email", ASCENDING), ("is_active", ASCENDING)]),
+        # Búsqueda admin anclada por prefijo + paginación keyset
+        IndexModel([("search_prefixes", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        IndexModel([("subscription_status", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+    ],
+    "conversations": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("is_favorite", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING), ("tags", ASCENDING)]),
+        IndexModel([("retention_until", ASCENDING)]),
+        IndexModel([("updated_at", ASCENDING)]),
+        # Candidatas a archivado en frío por plan
+        IndexModel([("plan", ASCENDING), ("last_message_at", ASCENDING)]),
+        # Índice de texto completo para búsqueda
+        IndexModel([("title", TEXT), ("tags", TEXT)]),
+    ],
+    "messages": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("conversation_id", ASCENDING), ("created_at", ASCENDING)]),
+        IndexModel([("conversation_id", ASCENDING), ("role", ASCENDING)]),
+        # Indexación incremental de búsqueda
+        IndexModel([("created_at", ASCENDING)]),
+    ],
+    "blobs": [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ],
+    "subscriptions": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("current_period_end", ASCENDING)]),
+    ],
+    "transactions": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        IndexModel([("provider_transaction_id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+}
+
+
+# Índice TTL opcional: cada mensaje expira según la retención de su plan.
+# Los mensajes con `blob_refs` no llevan `expire_at`: el TTL los borraría sin
+# liberar sus blobs, así que los purga el worker junto con su conversación.
+MESSAGE_TTL_INDEX = IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0)
+
+
+def get_index_declarations(use_ttl: bool = False) -> Dict[str, List[IndexModel]]:
+    """
+    Declaraciones efectivas según la configuración.
+    
+    Desactivar el TTL no elimina el índice ya creado: hay que borrarlo a mano
+    (`expire_at_1`).
+    """
+    if not use_ttl:
+        return INDEX_DECLARATIONS
+    declarations = dict(INDEX_DECLARATIONS)
+    declarations["messages"] = INDEX_DECLARATIONS["messages"] + [MESSAGE_TTL_INDEX]
+    return declarations
+
+
+async def detach_blob_messages_from_ttl(db: AsyncIOMotorDatabase) -> int:
+    """Quitar `expire_at` de los mensajes con blobs guardados antes de activar el TTL"""
+    result = await db["messages"].update_many(
+        {"blob_refs": {"$exists": True}, "expire_at": {"$exists": True}},
+        {"$unset": {"expire_at": ""}}
+    )
+    if result.modified_count:
+        logger.info(f"Detached {result.modified_count} blob-referencing messages from the TTL index")
+    return result.modified_count
+
+
+def _canonical_index(model: IndexModel) -> Dict[str, Any]:
+    document = dict(model.document)
+    key = [[field, direction] for field, direction in document.pop("key").items()]
+    # El nombre por defecto se deriva de la clave; no aporta al fingerprint
+    document.pop("name", None)
+    return {"key": key, "options": {k: document[k] for k in sorted(document)}}
+
+
+def fingerprint_indexes(models: List[IndexModel]) -> str:
+    """Fingerprint estable del conjunto de índices de una colección"""
+    canonical = [_canonical_index(model) for model in models]
+    raw = json.dumps(canonical, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def _build_collection_indexes(
+    db: AsyncIOMotorDatabase,
+    collection_name: str,
+    models: List[IndexModel]
+) -> List[str]:
+    # Un solo comando createIndexes por colección
+    return await db[collection_name].create_indexes(models)
+
+
+async def ensure_indexes(
+    db: AsyncIOMotorDatabase,
+    declarations: Dict[str, List[IndexModel]] = None,
+    force: bool = False
+) -> Dict[str, Any]:
+    """
+    Crear los índices declarados cuyo fingerprint cambió.
+    
+    Devuelve un resumen con las colecciones construidas, omitidas y
+    fallidas. Solo se guarda el fingerprint de las que se construyeron.
+    """
+    declarations = declarations or get_index_declarations()
+    fingerprints = {
+        name: fingerprint_indexes(models)
+        for name, models in declarations.items()
+    }
+    
+    meta = db[SCHEMA_META_COLLECTION]
+    stored = {}
+    if not force:
+        document = await meta.find_one({"_id": INDEX_META_ID}) or {}
+        stored = document.get("collections", {})
+    
+    pending = [
+        name for name, fingerprint in fingerprints.items()
+        if force or stored.get(name) != fingerprint
+    ]
+    summary = {
+        "built": [],
+        "skipped": [name for name in fingerprints if name not in pending],
+        "failed": {}
+    }
+    if not pending:
+        logger.info("Database indexes up to date (fingerprint unchanged)")
+        return summary
+    
+    if "messages" in pending and any(model is MESSAGE_TTL_INDEX for model in declarations["messages"]):
+        # Antes de crear el índice, para que el TTL no llegue a verlos
+        await detach_blob_messages_from_ttl(db)
+    
+    results = await asyncio.gather(
+        *[_build_collection_indexes(db, name, declarations[name]) for name in pending],
+        return_exceptions=True
+    )
+    
+    update = {}
+    for name, result in zip(pending, results):
+        if isinstance(result, Exception):
+            summary["failed"][name] = str(result)
+            logger.error(f"Failed to create indexes for {name}: {result}")
+        else:
+            summary["built"].append(name)
+            update[f"collections.{name}"] = fingerprints[name]
+    
+    if update:
+        update["updated_at"] = datetime.utcnow()
+        await meta.update_one({"_id": INDEX_META_ID}, {"$set": update}, upsert=True)
+    
+    logger.info(
+        f"Database indexes: built={summary['built']} "
+        f"skipped={len(summary['skipped'])} failed={list(summary['failed'])}"
+    )
+    return summary
+
+
+async def _run_migration(force: bool):
+    from .database import get_database_manager
+    from .config import get_settings
+    
+    db_manager = get_database_manager()
+    await db_manager.connect()
+    try:
+        declarations = get_index_declarations(get_settings().RETENTION_USE_TTL_INDEXES)
+        summary = await ensure_indexes(db_manager.db, declarations, force=force)
+    finally:
+        await db_manager.disconnect()
+    
+    print(json.dumps(summary, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    import sys
+    
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_run_migration(force="--force" in sys.argv[1:])))
@@ -65,6 +65,17 @@ class PaginatedResponse(BaseResponse):
     has_previous: bool
 
 
+class CursorPaginatedResponse(BaseResponse):
+    """Respuesta paginada por cursor (keyset)"""
+    data: List[Any]
+    page_size: int
+    next_cursor: Optional[str] = None
+    previous_cursor: Optional[str] = None
+    has_next: bool
+    has_previous: bool
+    total_items: Optional[int] = None
+
+
 # User Models
 class UserBase(BaseModel):
     """Modelo base de usuario"""
@@ -130,6 +141,11 @@ class LoginRequest(BaseModel):
     remember_me: bool = False
 
 
+class LogoutRequest(BaseModel):
+    """Solicitud de logout (el token de refresh se revoca si se envía)"""
+    refresh_token: Optional[str] = None
+
+
 class RegisterRequest(BaseModel):
     """Solicitud de registro"""
     name: str
@@ -171,12 +187,17 @@ class Conversation(ConversationBase, BaseDBModel):
     total_tokens: int = 0
     models_used: List[str] = []
     retention_until: Optional[datetime] = None
+    # Resumen acumulado de los mensajes hasta `summary_until` (compactación de contexto)
+    summary: Optional[str] = None
+    summary_until: Optional[datetime] = None
+    summarized_tokens: int = 0
     metadata: Dict[str, Any] = {}
 
 
 class Message(BaseDBModel):
     """Modelo de mensaje"""
     conversation_id: str
+    user_id: Optional[str] = None
     role: str  # user, assistant, system
     content: str
     model_used: Optional[str] = None
@@ -0,0 +1,453 @@
+"""
+Renderizado de PDF en un pool de procesos
+
+El renderizado con reportlab es CPU-bound: se ejecuta en un
+`ProcessPoolExecutor` para no bloquear el event loop. Cada worker cachea
+fuentes y plantillas de página; los mensajes se vuelcan a un archivo NDJSON
+temporal en lugar de serializarse por el pipe, y el PDF se escribe a disco
+para servirlo en streaming o como resultado de un job.
+
+reportlab es una dependencia opcional: solo se importa dentro de los workers.
+
+Los jobs y sus PDFs viven en el proceso que los creó: con varias réplicas o
+workers de uvicorn, `/exports/jobs/{id}` solo responde en la instancia que
+recibió la petición original.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, AsyncIterable
+from datetime import datetime, timedelta
+import multiprocessing
+import tempfile
+import asyncio
+import logging
+import json
+import uuid
+import re
+import os
+
+from .config import get_settings
+from .models import Message, Invoice
+
+logger = logging.getLogger(__name__)
+
+# Rutas donde buscar una fuente TTF con soporte Unicode
+DEFAULT_FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+]
+# Campos de Message que se incluyen en el PDF
+MESSAGE_PDF_FIELDS = {"role", "content", "model_used", "tokens_used", "created_at"}
+# Nombres de los archivos temporales y de salida (`_new_path`), para limpiar restos
+OUTPUT_FILE_RE = re.compile(r"^(messages|conversation_.+|invoice_.+)_[0-9a-f]{32}\.(ndjson|pdf)$")
+
+
+class PdfJobStatus:
+    """Estados de un job de renderizado"""
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+# ---------------------------------------------------------------------------
+# Lado worker (se ejecuta en los procesos del pool)
+# ---------------------------------------------------------------------------
+
+# Caché por proceso: fuentes registradas y plantillas de página
+_worker_fonts: Dict[str, str] = {}
+_worker_templates: Dict[str, Dict[str, Any]] = {}
+
+
+def _worker_init(font_path: Optional[str]):
+    """Registrar fuentes una sola vez por worker"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    _worker_fonts["regular"] = "Helvetica"
+    _worker_fonts["bold"] = "Helvetica-Bold"
+    for path in [font_path] + DEFAULT_FONT_PATHS:
+        if path and os.path.exists(path):
+            pdfmetrics.registerFont(TTFont("PdfSans", path))
+            _worker_fonts["regular"] = _worker_fonts["bold"] = "PdfSans"
+            bold_path = path.replace(".ttf", "-Bold.ttf")
+            if os.path.exists(bold_path):
+                pdfmetrics.registerFont(TTFont("PdfSans-Bold", bold_path))
+                _worker_fonts["bold"] = "PdfSans-Bold"
+            break
+
+
+def _get_template(name: str) -> Dict[str, Any]:
+    # Métricas de página calculadas una vez por worker y plantilla
+    template = _worker_templates.get(name)
+    if template is None:
+        from reportlab.lib.pagesizes import A4
+        from reportlab.lib.units import mm
+
+        width, height = A4
+        template = {
+            "pagesize": A4,
+            "width": width,
+            "height": height,
+            "margin": 18 * mm,
+            "text_width": width - 36 * mm,
+            "font": _worker_fonts.get("regular", "Helvetica"),
+            "font_bold": _worker_fonts.get("bold", "Helvetica-Bold"),
+            "font_size": 10 if name == "conversation" else 11,
+            "leading": 13 if name == "conversation" else 15,
+            "title_size": 16,
+        }
+        _worker_templates[name] = template
+    return template
+
+
+def _format_date(value: Any) -> str:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M")
+    return "-"
+
+
+class _PageWriter:
+    """Escritura línea a línea con salto de página automático"""
+
+    def __init__(self, output_path: str, template: Dict[str, Any], footer: str):
+        from reportlab.pdfgen import canvas
+
+        self.template = template
+        self.footer = footer
+        self.canvas = canvas.Canvas(output_path, pagesize=template["pagesize"], pageCompression=1)
+        self.page = 1
+        self.y = template["height"] - template["margin"]
+
+    def _footer(self):
+        t = self.template
+        self.canvas.setFont(t["font"], 8)
+        self.canvas.drawRightString(
+            t["width"] - t["margin"], t["margin"] / 2, f"{self.footer} · {self.page}"
+        )
+
+    def _ensure_space(self, height: float):
+        t = self.template
+        if self.y - height < t["margin"]:
+            self._footer()
+            self.canvas.showPage()
+            self.page += 1
+            self.y = t["height"] - t["margin"]
+
+    def line(self, text: str, font: str = None, size: float = None, leading: float = None):
+        t = self.template
+        leading = leading or t["leading"]
+        self._ensure_space(leading)
+        self.canvas.setFont(font or t["font"], size or t["font_size"])
+        self.canvas.drawString(t["margin"], self.y - leading, text)
+        self.y -= leading
+
+    def paragraph(self, text: str, font: str = None, size: float = None):
+        from reportlab.lib.utils import simpleSplit
+
+        t = self.template
+        font, size = font or t["font"], size or t["font_size"]
+        for raw_line in (text or "").splitlines() or [""]:
+            for wrapped in simpleSplit(raw_line, font, size, t["text_width"]) or [""]:
+                self.line(wrapped, font, size)
+
+    def space(self, height: float):
+        self.y -= height
+
+    def save(self) -> int:
+        self._footer()
+        self.canvas.save()
+        return self.page
+
+
+def render_conversation_pdf(
+    conversation: Dict[str, Any],
+    messages_path: str,
+    output_path: str
+) -> Dict[str, Any]:
+    """Renderizar una conversación leyendo sus mensajes del NDJSON temporal"""
+    template = _get_template("conversation")
+    writer = _PageWriter(output_path, template, conversation.get("title") or conversation["id"])
+
+    writer.line(conversation.get("title") or "Conversation", template["font_bold"],
+                template["title_size"], leading=template["title_size"] * 1.4)
+    writer.line(
+        f"{conversation['id']} · {_format_date(conversation.get('created_at'))} · "
+        f"{conversation.get('message_count', 0)} messages"
+    )
+    writer.space(template["leading"])
+
+    messages = 0
+    with open(messages_path, "r", encoding="utf-8") as f:
+        for raw in f:
+            message = json.loads(raw)
+            model = f" · {message['model_used']}" if message.get("model_used") else ""
+            writer.line(
+                f"{message.get('role', '').upper()} · {_format_date(message.get('created_at'))}{model}",
+                template["font_bold"]
+            )
+            writer.paragraph(message.get("content", ""))
+            writer.space(template["leading"] / 2)
+            messages += 1
+
+    pages = writer.save()
+    return {"path": output_path, "pages": pages, "messages": messages}
+
+
+def render_invoice_pdf(invoice: Dict[str, Any], output_path: str) -> Dict[str, Any]:
+    """Renderizar una factura"""
+    template = _get_template("invoice")
+    writer = _PageWriter(output_path, template, f"Invoice {invoice['id']}")
+
+    writer.line("INVOICE", template["font_bold"], template["title_size"],
+                leading=template["title_size"] * 1.4)
+    writer.line(f"Invoice: {invoice['id']}")
+    writer.line(f"Issued: {_format_date(invoice.get('created_at'))}")
+    writer.line(f"Customer: {invoice['user_id']}")
+    writer.line(f"Subscription: {invoice['subscription_id']}")
+    writer.space(template["leading"])
+
+    currency = invoice["currency"].upper()
+    writer.line(f"Amount due: {invoice['amount_due']:.2f} {currency}", template["font_bold"])
+    writer.line(f"Amount paid: {invoice['amount_paid']:.2f} {currency}")
+    writer.line(f"Status: {invoice['status']}")
+    writer.line(f"Due date: {_format_date(invoice.get('due_date'))}")
+    if invoice.get("paid_at"):
+        writer.line(f"Paid at: {_format_date(invoice['paid_at'])}")
+
+    pages = writer.save()
+    return {"path": output_path, "pages": pages}
+
+
+# ---------------------------------------------------------------------------
+# Lado servicio (event loop)
+# ---------------------------------------------------------------------------
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class PdfRenderer:
+    """
+    Renderizador de PDF sobre un pool de procesos.
+
+    El semáforo limita los exports en curso, del volcado de mensajes al
+    render, para que una ráfaga de exports no abra cursores ni acumule
+    archivos temporales sin límite. Los jobs expirados y sus archivos se
+    eliminan periódicamente (`start()`).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_concurrency: int = 4,
+        output_dir: Optional[str] = None,
+        font_path: Optional[str] = None,
+        job_ttl_seconds: int = 3600
+    ):
+        self.max_workers = max_workers
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.font_path = font_path
+        self.job_ttl = timedelta(seconds=job_ttl_seconds)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.stats = {"rendered": 0, "failed": 0, "pages": 0, "pool_restarts": 0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: no heredar hilos ni sockets del cliente Mongo
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_worker_init,
+                initargs=(self.font_path,)
+            )
+        return self._executor
+
+    def _new_path(self, prefix: str, suffix: str) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{prefix}_{uuid.uuid4().hex}{suffix}")
+
+    async def _execute(self, function, *args) -> Dict[str, Any]:
+        # Llamar con el semáforo tomado
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            result = await loop.run_in_executor(executor, function, *args)
+        except BrokenProcessPool:
+            # Un worker murió (OOM, reportlab ausente): el pool no se recupera solo
+            self.stats["failed"] += 1
+            self._discard_executor(executor)
+            raise
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        self.stats["rendered"] += 1
+        self.stats["pages"] += result["pages"]
+        return result
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        if self._executor is executor:
+            self._executor = None
+            self.stats["pool_restarts"] += 1
+            logger.error("PDF worker pool broken, a new one will be started")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def render_conversation(
+        self,
+        conversation: Dict[str, Any],
+        messages: AsyncIterable[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """Volcar los mensajes a disco y renderizar la conversación"""
+        async with self._semaphore:
+            spool_path = self._new_path("messages", ".ndjson")
+            output_path = self._new_path(f"conversation_{conversation['id']}", ".pdf")
+            try:
+                with open(spool_path, "w", encoding="utf-8") as spool:
+                    async for document in messages:
+                        message = Message.model_construct(**document)
+                        spool.write(json.dumps(
+                            message.model_dump(include=MESSAGE_PDF_FIELDS),
+                            default=_json_default, ensure_ascii=False
+                        ) + "\n")
+                return await self._execute(render_conversation_pdf, conversation, spool_path, output_path)
+            except Exception:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise
+            finally:
+                if os.path.exists(spool_path):
+                    os.remove(spool_path)
+
+    async def render_invoice(self, invoice: Invoice) -> Dict[str, Any]:
+        """Renderizar una factura"""
+        async with self._semaphore:
+            output_path = self._new_path(f"invoice_{invoice.id}", ".pdf")
+            return await self._execute(render_invoice_pdf, invoice.model_dump(), output_path)
+
+    def submit_job(self, kind: str, render, owner: Optional[str] = None) -> str:
+        """Ejecutar un render en segundo plano y devolver el ID del job"""
+        self._cleanup_expired_jobs()
+        job_id = str(uuid.uuid4())
+        self._jobs[job_id] = {
+            "id": job_id,
+            "kind": kind,
+            "owner": owner,
+            "status": PdfJobStatus.PENDING,
+            "created_at": datetime.utcnow(),
+            "completed_at": None,
+            "path": None,
+            "pages": None,
+            "error": None
+        }
+        self._tasks[job_id] = asyncio.create_task(self._run_job(job_id, render))
+        return job_id
+
+    async def _run_job(self, job_id: str, render):
+        job = self._jobs[job_id]
+        job["status"] = PdfJobStatus.RUNNING
+        try:
+            result = await render
+            job.update(status=PdfJobStatus.COMPLETED, path=result["path"], pages=result["pages"])
+        except Exception as e:
+            logger.error(f"PDF job {job_id} failed: {e}")
+            job.update(status=PdfJobStatus.FAILED, error=str(e))
+        finally:
+            job["completed_at"] = datetime.utcnow()
+            self._tasks.pop(job_id, None)
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Obtener el estado de un job"""
+        return self._jobs.get(job_id)
+
+    def _cleanup_expired_jobs(self):
+        now = datetime.utcnow()
+        for job_id, job in list(self._jobs.items()):
+            if job["completed_at"] and now - job["completed_at"] > self.job_ttl:
+                if job["path"] and os.path.exists(job["path"]):
+                    os.remove(job["path"])
+                del self._jobs[job_id]
+
+    def _cleanup_stale_files(self):
+        # Restos de procesos anteriores (reinicios, caídas) con más de `job_ttl`
+        if not os.path.isdir(self.output_dir):
+            return
+        cutoff = datetime.utcnow().timestamp() - self.job_ttl.total_seconds()
+        active = {job["path"] for job in self._jobs.values() if job["path"]}
+        for entry in os.scandir(self.output_dir):
+            if not OUTPUT_FILE_RE.match(entry.name) or entry.path in active:
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    async def _cleanup_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self._cleanup_expired_jobs()
+                await asyncio.to_thread(self._cleanup_stale_files)
+            except Exception as e:
+                logger.warning(f"PDF export cleanup failed: {e}")
+
+    def start(self):
+        """Iniciar la limpieza periódica de jobs expirados y sus archivos"""
+        if self._cleanup_task is None:
+            interval = min(self.job_ttl.total_seconds(), 300.0)
+            self._cleanup_task = asyncio.create_task(self._cleanup_periodically(interval))
+
+    async def shutdown(self):
+        """Esperar los jobs en curso y cerrar el pool"""
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+async def stream_file(path: str, chunk_size: int = 64 * 1024, delete: bool = False):
+    """Leer un archivo en chunks sin bloquear el event loop"""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if delete and os.path.exists(path):
+            os.remove(path)
+
+
+# Instancia global del renderizador
+_pdf_renderer = None
+
+
+def get_pdf_renderer() -> PdfRenderer:
+    """Obtener instancia singleton del renderizador de PDF"""
+    global _pdf_renderer
+    if _pdf_renderer is None:
+        settings = get_settings()
+        _pdf_renderer = PdfRenderer(
+            max_workers=settings.PDF_RENDER_WORKERS,
+            max_concurrency=settings.PDF_RENDER_MAX_CONCURRENCY,
+            output_dir=settings.PDF_OUTPUT_DIR,
+            font_path=settings.PDF_FONT_PATH,
+            job_ttl_seconds=settings.PDF_JOB_TTL_SECONDS
+        )
+    return _pdf_renderer
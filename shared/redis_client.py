@@ -0,0 +1,418 @@
+"""
+Cliente Redis compartido (caché, sesiones, límites, datos temporales)
+
+Sigue el diseño de cache-service: un namespace por caso de uso, cada uno
+con su base de datos (DB 0-4), prefijo de clave y TTL por defecto.
+
+- Un pool de conexiones bloqueante por base de datos: `REDIS_MAX_CONNECTIONS`
+  es el total y se reparte entre las bases en uso; si se agota, los
+  comandos esperan una conexión en vez de fallar.
+- Los comandos emitidos en el mismo tick del event loop se envían juntos en
+  un pipeline (un solo round-trip), igual que `BatchLoader` con MongoDB.
+- Los valores se serializan con msgpack (u orjson / json si no está) y se
+  comprimen con zstd por encima de `COMPRESSION_THRESHOLD`. El primer byte
+  indica el formato, así que cambiar de serializador no invalida la caché.
+"""
+
+from typing import Optional, Dict, Any, List, Type, TypeVar, Iterable
+from datetime import datetime, date
+from pydantic import BaseModel
+import asyncio
+import json
+import logging
+import time
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - dependencia opcional
+    aioredis = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - dependencia opcional
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    import zstandard as zstd
+except ImportError:  # pragma: no cover - dependencia opcional
+    zstd = None
+
+from .config import get_settings
+from .exceptions import RedisConnectionException
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Namespaces: base de datos, prefijo de clave, setting con el TTL por defecto
+# y consistencia del L1 en proceso (ver `shared/tiered_cache.py`)
+CACHE_NAMESPACES = {
+    "session": {"db": 0, "prefix": "session", "ttl_setting": "SESSION_TTL", "l1": "invalidate", "l1_ttl": 60},
+    "user": {"db": 0, "prefix": "user", "ttl_setting": "USER_CACHE_TTL", "l1": "invalidate", "l1_ttl": 300},
+    "llm": {"db": 1, "prefix": "llm_cache", "ttl_setting": "LLM_CACHE_TTL", "l1": "ttl", "l1_ttl": 300},
+    "rate_limit": {"db": 2, "prefix": "rate_limit", "ttl_setting": "RATE_LIMIT_TTL", "l1": "none"},
+    "analytics": {"db": 3, "prefix": "metrics", "ttl_setting": "ANALYTICS_TTL", "l1": "ttl", "l1_ttl": 30},
+    "temp": {"db": 4, "prefix": "temp", "ttl_setting": "TEMP_DATA_TTL", "l1": "none"},
+    "context": {"db": 4, "prefix": "context", "ttl_setting": "CONTEXT_REDIS_TTL_SECONDS", "l1": "none"},
+    # Sin TTL por defecto: cada jti expira con su token (ver `shared/token_revocation.py`)
+    "revoked": {"db": 0, "prefix": "blacklist", "l1": "none"},
+}
+
+# Primer byte del valor: formato de serialización y bit de compresión
+FORMAT_MSGPACK = 1
+FORMAT_ORJSON = 2
+FORMAT_JSON = 3
+FLAG_ZSTD = 0x80
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+class ValueCodec:
+    """Serialización compacta con compresión zstd por encima de un umbral"""
+
+    def __init__(self, compression_threshold: int = 1024, level: int = 3):
+        self.compression_threshold = compression_threshold
+        if msgpack is not None:
+            self.format = FORMAT_MSGPACK
+        elif orjson is not None:
+            self.format = FORMAT_ORJSON
+        else:
+            self.format = FORMAT_JSON
+        self._compressor = zstd.ZstdCompressor(level=level) if zstd is not None else None
+        self._decompressor = zstd.ZstdDecompressor() if zstd is not None else None
+        self.stats = {"compressed": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def _dumps(self, value: Any) -> bytes:
+        if self.format == FORMAT_MSGPACK:
+            return msgpack.packb(value, default=_default, use_bin_type=True)
+        if self.format == FORMAT_ORJSON:
+            return orjson.dumps(value, default=_default)
+        return json.dumps(value, default=_default, separators=(",", ":")).encode("utf-8")
+
+    def encode(self, value: Any) -> bytes:
+        """Serializar un valor (y comprimirlo si supera el umbral)"""
+        data = self._dumps(value)
+        header = self.format
+        if self._compressor is not None and len(data) >= self.compression_threshold:
+            compressed = self._compressor.compress(data)
+            if len(compressed) < len(data):
+                self.stats["compressed"] += 1
+                self.stats["bytes_in"] += len(data)
+                self.stats["bytes_out"] += len(compressed)
+                data = compressed
+                header |= FLAG_ZSTD
+        return bytes([header]) + data
+
+    def decode(self, raw: Optional[bytes]) -> Any:
+        """Deserializar un valor escrito por `encode`"""
+        if raw is None:
+            return None
+        header, data = raw[0], raw[1:]
+        if header & FLAG_ZSTD:
+            if self._decompressor is None:
+                raise RedisConnectionException("zstandard is required to read compressed cache values")
+            data = self._decompressor.decompress(data)
+        value_format = header & ~FLAG_ZSTD
+        if value_format == FORMAT_MSGPACK:
+            if msgpack is None:
+                raise RedisConnectionException("msgpack is required to read this cache value")
+            return msgpack.unpackb(data, raw=False)
+        if value_format == FORMAT_ORJSON and orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class RedisCache:
+    """Cliente Redis con pools por base de datos y pipelining automático por tick"""
+
+    def __init__(
+        self,
+        url: Optional[str],
+        namespaces: Dict[str, Dict[str, Any]],
+        max_connections: int = 20,
+        pool_timeout: float = 5.0,
+        socket_timeout: float = 2.0,
+        retry_on_timeout: bool = True,
+        use_databases: bool = True,
+        pipelining: bool = True,
+        pipeline_size: int = 100,
+        compression_threshold: int = 1024,
+        client_factory=None
+    ):
+        self.url = url
+        self.namespaces = namespaces
+        self.use_databases = use_databases
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.retry_on_timeout = retry_on_timeout
+        self.pipelining = pipelining
+        self.pipeline_size = pipeline_size
+        self.codec = ValueCodec(compression_threshold)
+        # `client_factory(db)` permite inyectar clientes (p.ej. fakeredis en tests)
+        self.client_factory = client_factory
+        self.enabled = bool(url or client_factory) and (aioredis is not None or client_factory is not None)
+
+        databases = {self._db(name) for name in namespaces}
+        self.pool_size = max(2, max_connections // max(len(databases), 1))
+        self._clients: Dict[int, Any] = {}
+        self._pending: Dict[int, List[tuple]] = {}
+        self._handles: Dict[int, asyncio.Handle] = {}
+        self.stats = {"commands": 0, "pipelines": 0, "pipelined_commands": 0, "errors": 0}
+
+    def _db(self, namespace: str) -> int:
+        return self.namespaces[namespace]["db"] if self.use_databases else 0
+
+    def key(self, namespace: str, key: str) -> str:
+        """Clave completa con el prefijo del namespace"""
+        return f"{self.namespaces[namespace]['prefix']}:{key}"
+
+    def default_ttl(self, namespace: str) -> Optional[int]:
+        """TTL por defecto del namespace (segundos)"""
+        return self.namespaces[namespace].get("ttl")
+
+    def _client_for_db(self, db: int):
+        client = self._clients.get(db)
+        if client is None:
+            if not self.enabled:
+                raise RedisConnectionException("Redis is not configured", "REDIS_NOT_CONFIGURED")
+            if self.client_factory is not None:
+                client = self.client_factory(db)
+            else:
+                pool = aioredis.BlockingConnectionPool.from_url(
+                    self.url,
+                    db=db,
+                    max_connections=self.pool_size,
+                    timeout=self.pool_timeout,
+                    socket_timeout=self.socket_timeout,
+                    socket_connect_timeout=self.socket_timeout,
+                    retry_on_timeout=self.retry_on_timeout,
+                    health_check_interval=30
+                )
+                # El cliente es dueño del pool y lo cierra en `aclose()`
+                client = aioredis.Redis.from_pool(pool)
+            self._clients[db] = client
+        return client
+
+    def client(self, namespace: str):
+        """Cliente Redis del namespace (listas, transacciones, pub/sub)"""
+        return self._client_for_db(self._db(namespace))
+
+    # Pipelining automático: los comandos del mismo tick comparten round-trip
+    def _enqueue(self, db: int, args: tuple) -> asyncio.Future:
+        self.stats["commands"] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(db, [])
+        batch.append((args, future))
+        if not self.pipelining or len(batch) >= self.pipeline_size:
+            self._dispatch(db)
+        elif db not in self._handles:
+            self._handles[db] = loop.call_soon(self._dispatch, db)
+        return future
+
+    def _dispatch(self, db: int):
+        handle = self._handles.pop(db, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self._pending.pop(db, None)
+        if batch:
+            asyncio.ensure_future(self._execute_batch(db, batch))
+
+    async def _execute_batch(self, db: int, batch: List[tuple]):
+        try:
+            client = self._client_for_db(db)
+            if len(batch) == 1:
+                results = [await client.execute_command(*batch[0][0])]
+            else:
+                self.stats["pipelines"] += 1
+                self.stats["pipelined_commands"] += len(batch)
+                async with client.pipeline(transaction=False) as pipe:
+                    for args, _ in batch:
+                        pipe.execute_command(*args)
+                    results = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            self.stats["errors"] += 1
+            error = e if isinstance(e, RedisConnectionException) else RedisConnectionException(
+                f"Redis command failed: {e}", "REDIS_ERROR"
+            )
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (args, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                self.stats["errors"] += 1
+                future.set_exception(RedisConnectionException(
+                    f"Redis {args[0]} failed: {result}", "REDIS_ERROR"
+                ))
+            else:
+                future.set_result(result)
+
+    async def execute(self, namespace: str, *args) -> Any:
+        """Ejecutar un comando en la base del namespace (agrupado con el resto del tick)"""
+        return await self._enqueue(self._db(namespace), args)
+
+    def as_model(self, value: Any, model: Optional[Type[T]]) -> Any:
+        """Validar un valor leído con `model` (si se indica)"""
+        if value is None or model is None:
+            return value
+        return model.model_validate(value)
+
+    async def get(self, namespace: str, key: str, model: Optional[Type[T]] = None) -> Optional[T]:
+        """Leer un valor (validado con `model` si se indica)"""
+        raw = await self.execute(namespace, "GET", self.key(namespace, key))
+        return self.as_model(self.codec.decode(raw), model)
+
+    async def set(
+        self,
+        namespace: str,
+        key: str,
+        value: Any,
+        ttl: Optional[int] = None,
+        only_if_missing: bool = False
+    ) -> bool:
+        """Guardar un valor con el TTL indicado o el del namespace"""
+        args = ["SET", self.key(namespace, key), self.codec.encode(value)]
+        ttl = ttl if ttl is not None else self.default_ttl(namespace)
+        if ttl:
+            args += ["EX", int(ttl)]
+        if only_if_missing:
+            args.append("NX")
+        return bool(await self.execute(namespace, *args))
+
+    async def mget(
+        self,
+        namespace: str,
+        keys: Iterable[str],
+        model: Optional[Type[T]] = None
+    ) -> Dict[str, T]:
+        """Leer varias claves; las que no existen no aparecen en el resultado"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        raws = await self.execute(namespace, "MGET", *(self.key(namespace, key) for key in keys))
+        return {
+            key: self.as_model(self.codec.decode(raw), model)
+            for key, raw in zip(keys, raws) if raw is not None
+        }
+
+    async def mset(self, namespace: str, items: Dict[str, Any], ttl: Optional[int] = None) -> int:
+        """Guardar varias claves (un SET por clave, en el mismo pipeline)"""
+        results = await asyncio.gather(*(
+            self.set(namespace, key, value, ttl) for key, value in items.items()
+        ))
+        return sum(results)
+
+    async def delete(self, namespace: str, *keys: str) -> int:
+        """Borrar claves del namespace"""
+        if not keys:
+            return 0
+        return await self.execute(namespace, "DEL", *(self.key(namespace, key) for key in keys))
+
+    async def incr(self, namespace: str, key: str, amount: int = 1, ttl: Optional[int] = None) -> int:
+        """Incrementar un contador; el TTL se fija al crearlo"""
+        full_key = self.key(namespace, key)
+        value = await self.execute(namespace, "INCRBY", full_key, amount)
+        ttl = ttl if ttl is not None else self.default_ttl(namespace)
+        if ttl and value == amount:
+            await self.execute(namespace, "EXPIRE", full_key, int(ttl))
+        return value
+
+    async def health_check(self) -> Dict[str, Any]:
+        """Ping a Redis y estadísticas del cliente"""
+        if not self.enabled:
+            return {"status": "disabled"}
+        try:
+            start_time = time.time()
+            await self.client(next(iter(self.namespaces))).ping()
+            return {
+                "status": "healthy",
+                "ping_time_ms": round((time.time() - start_time) * 1000, 2),
+                **self.get_stats()
+            }
+        except Exception as e:
+            return {"status": "unhealthy", "error": str(e)}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Comandos, pipelines y compresión"""
+        pipelines = self.stats["pipelines"]
+        return {
+            **self.stats,
+            "avg_pipeline_size": round(self.stats["pipelined_commands"] / pipelines, 1) if pipelines else None,
+            "pool_size_per_db": self.pool_size,
+            "databases": sorted(self._clients),
+            "serializer": {FORMAT_MSGPACK: "msgpack", FORMAT_ORJSON: "orjson", FORMAT_JSON: "json"}[self.codec.format],
+            "compression": self.codec.stats
+        }
+
+    async def close(self):
+        """Enviar lo pendiente y cerrar los pools"""
+        for db in list(self._pending):
+            self._dispatch(db)
+        await asyncio.sleep(0)
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+# Instancia global del cliente Redis
+_redis_cache = None
+
+
+def get_redis_cache() -> RedisCache:
+    """Obtener instancia singleton del cliente Redis"""
+    global _redis_cache
+    if _redis_cache is None:
+        settings = get_settings()
+        namespaces = {
+            name: {**namespace, "ttl": getattr(settings, namespace["ttl_setting"], None) if "ttl_setting" in namespace else None}
+            for name, namespace in CACHE_NAMESPACES.items()
+        }
+        _redis_cache = RedisCache(
+            settings.REDIS_URL,
+            namespaces,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            pool_timeout=settings.REDIS_POOL_TIMEOUT_SECONDS,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT_SECONDS,
+            retry_on_timeout=settings.REDIS_RETRY_ON_TIMEOUT,
+            use_databases=settings.REDIS_USE_DATABASES,
+            pipelining=settings.ENABLE_PIPELINE,
+            pipeline_size=settings.PIPELINE_SIZE,
+            compression_threshold=settings.COMPRESSION_THRESHOLD
+        )
+    return _redis_cache
+
+
+async def init_redis_cache():
+    """Comprobar la conexión a Redis al arrancar (no bloquea el arranque si falla)"""
+    cache = get_redis_cache()
+    if not cache.enabled:
+        logger.info("Redis not configured, shared cache disabled")
+        return
+    health = await cache.health_check()
+    if health["status"] == "healthy":
+        logger.info(f"Connected to Redis ({health['ping_time_ms']} ms, serializer {health['serializer']})")
+    else:
+        logger.warning(f"Redis unavailable at startup: {health.get('error')}")
+
+
+async def close_redis_cache():
+    """Cerrar el cliente Redis"""
+    if _redis_cache is not None:
+        await _redis_cache.close()
@@ -0,0 +1,533 @@
+"""
+Caché en dos niveles: LRU en proceso (L1) delante de Redis (L2)
+
+Cada namespace de `CACHE_NAMESPACES` declara su consistencia en L1:
+
+- "none": sin L1, siempre Redis (contadores, datos que cambian en cada request);
+- "ttl": L1 con TTL corto y sin invalidación (valores inmutables por clave o
+  que toleran `l1_ttl` segundos de retraso);
+- "invalidate": L1 invalidado por pub/sub. Cada escritura o invalidación
+  publica las claves en `CACHE_INVALIDATION_CHANNEL` y todas las réplicas
+  las descartan de su L1. `l1_ttl` queda como red de seguridad.
+
+Si la suscripción se cae, los namespaces "invalidate" dejan de usar L1 hasta
+reconectar y, al reconectar, su L1 se vacía (pudo perderse algún mensaje).
+L1 guarda los bytes serializados: cada lectura devuelve una copia y el
+tamaño se acota en bytes.
+
+`get_or_load` protege contra estampidas al expirar una clave popular:
+
+- cada valor se guarda con su expiración lógica y el tiempo que costó
+  calcularlo, y se refresca en segundo plano antes de expirar con
+  probabilidad creciente (XFetch, Vattani et al.);
+- tras la expiración lógica el valor sigue en Redis `stale_ttl` segundos más
+  y se sirve mientras se recalcula (stale-while-revalidate);
+- solo recalcula quien obtiene un lock corto en Redis (`SET NX PX`); en frío,
+  los demás esperan a que aparezca el valor. Dentro de la réplica, las
+  peticiones concurrentes de la misma clave comparten una sola carga.
+"""
+
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Type, TypeVar
+from collections import OrderedDict
+import asyncio
+import logging
+import math
+import random
+import time
+import uuid
+
+from .config import get_settings
+from .redis_client import RedisCache, get_redis_cache
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CONSISTENCY_NONE = "none"
+CONSISTENCY_TTL = "ttl"
+CONSISTENCY_INVALIDATE = "invalidate"
+
+# Escribir solo si la clave sigue como se leyó (ARGV[1] vacío = no existía)
+_COMPARE_AND_SET = """
+local current = redis.call('GET', KEYS[1])
+if (ARGV[1] == '' and current) or (ARGV[1] ~= '' and current ~= ARGV[1]) then
+  return 0
+end
+if tonumber(ARGV[3]) > 0 then
+  redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+else
+  redis.call('SET', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+# Liberar el lock solo si sigue siendo nuestro
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class L1Tier:
+    """LRU en proceso acotado por bytes, con expiración por entrada"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        raw, expires_at = item
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return None
+        self._items.move_to_end(key)
+        return raw
+
+    def put(self, key: tuple, raw: bytes, ttl: float):
+        if len(raw) > self.max_bytes:
+            return
+        self.pop(key)
+        self._items[key] = (raw, time.monotonic() + ttl)
+        self.size += len(raw)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._items.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def pop(self, key: tuple):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.size -= len(item[0])
+
+    def clear_namespace(self, namespace: str):
+        for key in [key for key in self._items if key[0] == namespace]:
+            self.pop(key)
+
+
+class TieredCache:
+    """L1 en proceso + L2 Redis con invalidación entre réplicas por pub/sub"""
+
+    def __init__(
+        self,
+        redis_cache: RedisCache,
+        l1_max_bytes: int = 64 * 1024 * 1024,
+        channel: str = "cache:invalidate",
+        consistency_overrides: Optional[Dict[str, str]] = None,
+        xfetch_beta: float = 1.0,
+        stale_ttl: int = 60,
+        lock_ttl: float = 10.0,
+        lock_poll_interval: float = 0.05
+    ):
+        self.redis_cache = redis_cache
+        self.codec = redis_cache.codec
+        self.channel = channel
+        self.l1 = L1Tier(l1_max_bytes)
+        self.xfetch_beta = xfetch_beta
+        self.stale_ttl = stale_ttl
+        self.lock_ttl = lock_ttl
+        self.lock_poll_interval = lock_poll_interval
+        self.policies = {
+            name: {
+                "consistency": (consistency_overrides or {}).get(name, namespace.get("l1", CONSISTENCY_NONE)),
+                "l1_ttl": namespace.get("l1_ttl", 60)
+            }
+            for name, namespace in redis_cache.namespaces.items()
+        }
+        self.instance_id = uuid.uuid4().hex
+        # Contador de invalidaciones por namespace: una lectura de L2 que se
+        # cruzó con una invalidación no se guarda en L1
+        self._epochs: Dict[str, int] = {name: 0 for name in self.policies}
+        self._subscribed = False
+        self._task: Optional[asyncio.Task] = None
+        # Cargas en curso (se esperan) y refrescos en segundo plano, por clave
+        self._loads: Dict[tuple, asyncio.Task] = {}
+        self._refreshes: Dict[tuple, asyncio.Task] = {}
+        self.stats = {
+            name: {
+                "l1_hits": 0, "l1_misses": 0, "l2_hits": 0, "l2_misses": 0,
+                "loads": 0, "coalesced": 0, "lock_waits": 0, "early_refreshes": 0, "stale_served": 0
+            }
+            for name in self.policies
+        }
+        self.invalidation_stats = {"sent": 0, "received": 0, "resubscribes": 0, "errors": 0}
+
+    def _use_l1(self, namespace: str) -> bool:
+        consistency = self.policies[namespace]["consistency"]
+        if consistency == CONSISTENCY_INVALIDATE:
+            # Sin suscripción (o sin Redis) no se puede garantizar la invalidación
+            return self._subscribed
+        return consistency == CONSISTENCY_TTL
+
+    async def get(self, namespace: str, key: str, model: Optional[Type[T]] = None) -> Optional[T]:
+        """Leer de L1 y, si no está, de Redis (rellenando L1)"""
+        raw = await self._read(namespace, key)
+        return self.redis_cache.as_model(self.codec.decode(raw), model)
+
+    async def _read(self, namespace: str, key: str) -> Optional[bytes]:
+        stats = self.stats[namespace]
+        use_l1 = self._use_l1(namespace)
+        if use_l1:
+            raw = self.l1.get((namespace, key))
+            if raw is not None:
+                stats["l1_hits"] += 1
+                return raw
+            stats["l1_misses"] += 1
+
+        if not self.redis_cache.enabled:
+            stats["l2_misses"] += 1
+            return None
+        epoch = self._epochs[namespace]
+        raw = await self.redis_cache.execute(namespace, "GET", self.redis_cache.key(namespace, key))
+        if raw is None:
+            stats["l2_misses"] += 1
+            return None
+        stats["l2_hits"] += 1
+        if use_l1 and self._epochs[namespace] == epoch:
+            self.l1.put((namespace, key), raw, self.policies[namespace]["l1_ttl"])
+        return raw
+
+    async def set(self, namespace: str, key: str, value: Any, ttl: Optional[int] = None):
+        """Guardar en Redis y en L1, e invalidar el L1 de las demás réplicas"""
+        raw = self.codec.encode(value)
+        if self.redis_cache.enabled:
+            args = ["SET", self.redis_cache.key(namespace, key), raw]
+            ttl = ttl if ttl is not None else self.redis_cache.default_ttl(namespace)
+            if ttl:
+                args += ["EX", int(ttl)]
+            await self.redis_cache.execute(namespace, *args)
+        self._epochs[namespace] += 1
+        if self._use_l1(namespace):
+            self.l1.put((namespace, key), raw, self.policies[namespace]["l1_ttl"])
+        await self._publish(namespace, [key])
+
+    async def get_or_load(
+        self,
+        namespace: str,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        model: Optional[Type[T]] = None,
+        ttl: Optional[int] = None,
+        stale_ttl: Optional[int] = None
+    ) -> Optional[T]:
+        """
+        Cache-aside protegido contra estampidas (None no se guarda).
+
+        Las claves de `get_or_load` guardan un sobre con la expiración lógica:
+        se leen siempre con `get_or_load`, no con `get`. Si llega una
+        invalidación mientras se carga, el valor se devuelve pero no se
+        guarda: podría ser anterior a la escritura invalidada.
+        """
+        ttl = ttl if ttl is not None else self.redis_cache.default_ttl(namespace)
+        stale_ttl = stale_ttl if stale_ttl is not None else self.stale_ttl
+        raw = await self._read(namespace, key)
+        envelope = self.codec.decode(raw)
+        if envelope is not None:
+            now = time.time()
+            if not self._should_refresh(envelope, now):
+                return self.redis_cache.as_model(envelope["v"], model)
+            if now < envelope["x"] + stale_ttl:
+                # Se sirve el valor actual mientras otra tarea lo recalcula
+                expired = now >= envelope["x"]
+                if expired:
+                    self.stats[namespace]["stale_served"] += 1
+                if self._schedule_refresh(namespace, key, loader, ttl, stale_ttl, raw) and not expired:
+                    self.stats[namespace]["early_refreshes"] += 1
+                return self.redis_cache.as_model(envelope["v"], model)
+
+        flight = (namespace, key)
+        task = self._loads.get(flight)
+        if task is None:
+            task = asyncio.ensure_future(self._recompute(namespace, key, loader, ttl, stale_ttl, raw))
+            self._loads[flight] = task
+            task.add_done_callback(lambda _: self._loads.pop(flight, None))
+        else:
+            self.stats[namespace]["coalesced"] += 1
+        # `shield`: si se cancela quien espera, la carga sigue para los demás
+        value = await asyncio.shield(task)
+        return self.redis_cache.as_model(value, model)
+
+    def _should_refresh(self, envelope: Dict[str, Any], now: float) -> bool:
+        # XFetch: adelantar el refresco en proporción a lo que cuesta recalcular
+        if envelope["x"] is None:
+            return False
+        jitter = -envelope["d"] * self.xfetch_beta * math.log(1.0 - random.random())
+        return now + jitter >= envelope["x"]
+
+    def _schedule_refresh(self, namespace: str, key: str, loader, ttl, stale_ttl, expected: bytes) -> bool:
+        flight = (namespace, key)
+        if flight in self._refreshes or flight in self._loads:
+            return False
+        task = asyncio.create_task(self._refresh(namespace, key, loader, ttl, stale_ttl, expected))
+        self._refreshes[flight] = task
+        task.add_done_callback(lambda _: self._refreshes.pop(flight, None))
+        return True
+
+    async def _refresh(self, namespace: str, key: str, loader, ttl, stale_ttl, expected: bytes):
+        try:
+            await self._recompute(namespace, key, loader, ttl, stale_ttl, expected, background=True)
+        except Exception as e:
+            # Se sigue sirviendo el valor anterior hasta que expire del todo
+            logger.warning(f"Background refresh of {namespace}:{key} failed: {e}")
+
+    async def _recompute(
+        self,
+        namespace: str,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: Optional[int],
+        stale_ttl: int,
+        expected: Optional[bytes],
+        background: bool = False
+    ) -> Any:
+        lock_key = self.redis_cache.key(namespace, f"lock:{key}")
+        token = None
+        if self.redis_cache.enabled:
+            deadline = time.monotonic() + self.lock_ttl
+            token = await self._acquire(namespace, lock_key)
+            while token is None:
+                if background:
+                    # Otra réplica lo está recalculando (o ya lo hizo): adoptar su valor si está
+                    raw = await self._fresher(namespace, key, expected)
+                    return self._adopt(namespace, key, raw) if raw is not None else None
+                self.stats[namespace]["lock_waits"] += 1
+                raw = await self._wait_for_fill(namespace, key, lock_key, expected, deadline)
+                if raw is not None:
+                    return self._adopt(namespace, key, raw)
+                if time.monotonic() >= deadline:
+                    # El dueño del lock no terminó a tiempo: cargar sin lock
+                    break
+                token = await self._acquire(namespace, lock_key)
+
+            if token is not None:
+                # Otro pudo rellenar la clave entre nuestra lectura y el lock
+                raw = await self.redis_cache.execute(namespace, "GET", self.redis_cache.key(namespace, key))
+                if raw is not None and raw != expected and self._is_fresh(raw):
+                    await self._release(namespace, lock_key, token)
+                    return self._adopt(namespace, key, raw)
+                expected = raw
+
+        try:
+            self.stats[namespace]["loads"] += 1
+            epoch = self._epochs[namespace]
+            started = time.monotonic()
+            value = await loader()
+            if value is None:
+                return None
+            raw = self.codec.encode({
+                "v": value,
+                "d": round(time.monotonic() - started, 4),
+                "x": time.time() + ttl if ttl else None
+            })
+            if self._epochs[namespace] == epoch:
+                await self._fill(namespace, key, raw, ttl + stale_ttl if ttl else 0, expected)
+            # Misma forma que una lectura de caché (p.ej. fechas como ISO 8601)
+            return self.codec.decode(raw)["v"]
+        finally:
+            if token is not None:
+                await self._release(namespace, lock_key, token)
+
+    async def _acquire(self, namespace: str, lock_key: str) -> Optional[str]:
+        token = uuid.uuid4().hex
+        locked = await self.redis_cache.execute(
+            namespace, "SET", lock_key, token, "PX", int(self.lock_ttl * 1000), "NX"
+        )
+        return token if locked else None
+
+    async def _release(self, namespace: str, lock_key: str, token: str):
+        try:
+            await self.redis_cache.execute(namespace, "EVAL", _RELEASE_LOCK, 1, lock_key, token)
+        except Exception as e:
+            # Expira solo a los `lock_ttl` segundos
+            logger.warning(f"Cache lock release failed for {lock_key}: {e}")
+
+    async def _wait_for_fill(
+        self,
+        namespace: str,
+        key: str,
+        lock_key: str,
+        expected: Optional[bytes],
+        deadline: float
+    ) -> Optional[bytes]:
+        # Esperar un valor nuevo mientras el lock siga tomado
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.lock_poll_interval)
+            raw, locked = await asyncio.gather(
+                self.redis_cache.execute(namespace, "GET", self.redis_cache.key(namespace, key)),
+                self.redis_cache.execute(namespace, "EXISTS", lock_key)
+            )
+            if raw is not None and raw != expected:
+                return raw
+            if not locked:
+                return None
+        return None
+
+    def _is_fresh(self, raw: bytes) -> bool:
+        expires_at = self.codec.decode(raw)["x"]
+        return expires_at is None or time.time() < expires_at
+
+    async def _fresher(self, namespace: str, key: str, expected: Optional[bytes]) -> Optional[bytes]:
+        raw = await self.redis_cache.execute(namespace, "GET", self.redis_cache.key(namespace, key))
+        if raw is not None and raw != expected and self._is_fresh(raw):
+            return raw
+        return None
+
+    def _adopt(self, namespace: str, key: str, raw: bytes) -> Any:
+        if self._use_l1(namespace):
+            self.l1.put((namespace, key), raw, self.policies[namespace]["l1_ttl"])
+        return self.codec.decode(raw)["v"]
+
+    async def _fill(self, namespace: str, key: str, raw: bytes, ttl: int, expected: Optional[bytes]):
+        # Relleno tras un fallo o refresco: no pisa un valor más nuevo ni avisa a las réplicas
+        if self.redis_cache.enabled:
+            stored = await self.redis_cache.execute(
+                namespace, "EVAL", _COMPARE_AND_SET, 1, self.redis_cache.key(namespace, key),
+                expected or b"", raw, int(ttl)
+            )
+            if not stored:
+                return
+        if self._use_l1(namespace):
+            self.l1.put((namespace, key), raw, self.policies[namespace]["l1_ttl"])
+
+    async def invalidate(self, namespace: str, *keys: str):
+        """Borrar claves de Redis y del L1 de todas las réplicas"""
+        if not keys:
+            return
+        self._epochs[namespace] += 1
+        for key in keys:
+            self.l1.pop((namespace, key))
+        if self.redis_cache.enabled:
+            await self.redis_cache.delete(namespace, *keys)
+        await self._publish(namespace, list(keys))
+
+    async def _publish(self, namespace: str, keys: List[str]):
+        if self.policies[namespace]["consistency"] != CONSISTENCY_INVALIDATE or not self.redis_cache.enabled:
+            return
+        message = self.codec.encode({"origin": self.instance_id, "namespace": namespace, "keys": keys})
+        try:
+            await self.redis_cache.execute(namespace, "PUBLISH", self.channel, message)
+            self.invalidation_stats["sent"] += 1
+        except Exception as e:
+            # Las demás réplicas conservan su L1 como mucho `l1_ttl` segundos
+            self.invalidation_stats["errors"] += 1
+            logger.warning(f"Cache invalidation publish failed for {namespace}: {e}")
+
+    def _on_invalidation(self, data: bytes):
+        message = self.codec.decode(data)
+        if message.get("origin") == self.instance_id:
+            return
+        namespace = message.get("namespace")
+        if namespace not in self.policies:
+            return
+        self.invalidation_stats["received"] += 1
+        self._epochs[namespace] += 1
+        for key in message.get("keys", []):
+            self.l1.pop((namespace, key))
+
+    def _drop_invalidated_namespaces(self):
+        for namespace, policy in self.policies.items():
+            if policy["consistency"] == CONSISTENCY_INVALIDATE:
+                self._epochs[namespace] += 1
+                self.l1.clear_namespace(namespace)
+
+    async def _listen(self):
+        backoff = 1.0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis_cache.client(next(iter(self.policies))).pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(self.channel)
+                # Mensajes perdidos mientras no había suscripción
+                self._drop_invalidated_namespaces()
+                self._subscribed = True
+                backoff = 1.0
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._on_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.invalidation_stats["errors"] += 1
+                logger.warning(f"Cache invalidation subscription lost: {e}")
+            finally:
+                self._subscribed = False
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+            self.invalidation_stats["resubscribes"] += 1
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def start(self):
+        """Iniciar la escucha de invalidaciones"""
+        if self._task is None and self.redis_cache.enabled:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """Detener la escucha de invalidaciones y los refrescos en curso"""
+        refreshes = list(self._refreshes.values())
+        for task in refreshes:
+            task.cancel()
+        await asyncio.gather(*refreshes, return_exceptions=True)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Ratios de acierto por namespace y nivel, tamaño de L1 e invalidaciones"""
+        namespaces = {}
+        for namespace, stats in self.stats.items():
+            l1_total = stats["l1_hits"] + stats["l1_misses"]
+            l2_total = stats["l2_hits"] + stats["l2_misses"]
+            if not l1_total and not l2_total:
+                continue
+            requests = stats["l1_hits"] + l2_total
+            namespaces[namespace] = {
+                **stats,
+                "consistency": self.policies[namespace]["consistency"],
+                "l1_hit_ratio": round(stats["l1_hits"] / l1_total, 3) if l1_total else None,
+                "l2_hit_ratio": round(stats["l2_hits"] / l2_total, 3) if l2_total else None,
+                "hit_ratio": round((stats["l1_hits"] + stats["l2_hits"]) / requests, 3) if requests else None
+            }
+        return {
+            "namespaces": namespaces,
+            "l1": {"entries": len(self.l1), "bytes": self.l1.size, "evictions": self.l1.evictions},
+            "invalidation": {**self.invalidation_stats, "subscribed": self._subscribed}
+        }
+
+
+# Instancia global de la caché en dos niveles
+_tiered_cache = None
+
+
+def get_tiered_cache() -> TieredCache:
+    """Obtener instancia singleton de la caché en dos niveles"""
+    global _tiered_cache
+    if _tiered_cache is None:
+        settings = get_settings()
+        _tiered_cache = TieredCache(
+            get_redis_cache(),
+            l1_max_bytes=settings.CACHE_L1_MAX_BYTES,
+            channel=settings.CACHE_INVALIDATION_CHANNEL,
+            consistency_overrides=settings.CACHE_L1_CONSISTENCY,
+            xfetch_beta=settings.CACHE_XFETCH_BETA,
+            stale_ttl=settings.CACHE_STALE_TTL_SECONDS,
+            lock_ttl=settings.CACHE_LOCK_TTL_SECONDS,
+            lock_poll_interval=settings.CACHE_LOCK_POLL_INTERVAL_SECONDS
+        )
+    return _tiered_cache
@@ -0,0 +1,151 @@
+"""
+Claims compactos para los JWT
+
+Los permisos viajan como un entero (bitmask) contra un registro versionado y
+el plan como un entero pequeño:
+
+    {"sub": "...", "pv": 1, "pm": 164, "pl": 1, "exp": ..., "jti": "..."}
+
+`email` y `name` solo se incluyen si `JWT_INCLUDE_PII` está activo (el
+perfil se obtiene con `/me`). Los tokens con el formato anterior (`role` y
+lista de `permissions`) se siguen aceptando: `user_from_claims` normaliza
+ambos formatos.
+
+Reglas del registro: una versión nueva solo añade permisos al final de la
+anterior y un bit nunca se reutiliza. Así un servicio con un registro más
+antiguo interpreta los bits que conoce de un token más nuevo. El bitmask se
+decodifica con el registro de la versión del token (`pv`), acotada a la más
+reciente que conoce el servicio.
+"""
+
+from typing import Optional, Dict, Any, List, Iterable
+
+from .config import UserRoles
+
+WILDCARD = "*"
+
+# Versión -> permisos en orden de bit (el bit 0 es el comodín)
+PERMISSION_REGISTRY = {
+    1: (
+        WILDCARD,
+        "chat:basic",
+        "chat:advanced",
+        "chat:unlimited",
+        "history:read",
+        "history:full",
+        "history:unlimited",
+        "export:pdf",
+        "analytics:full",
+    ),
+}
+REGISTRY_VERSION = max(PERMISSION_REGISTRY)
+WILDCARD_BIT = 1
+
+for _version in sorted(PERMISSION_REGISTRY)[1:]:
+    _previous = PERMISSION_REGISTRY[_version - 1]
+    assert PERMISSION_REGISTRY[_version][:len(_previous)] == _previous, "registry versions must only append"
+
+_BITS = {permission: 1 << bit for bit, permission in enumerate(PERMISSION_REGISTRY[REGISTRY_VERSION])}
+# Bits válidos de cada versión del registro
+_VERSION_MASKS = {version: (1 << len(permissions)) - 1 for version, permissions in PERMISSION_REGISTRY.items()}
+
+# Código de plan = nivel en la jerarquía de `require_subscription`
+PLAN_CODES = {
+    UserRoles.FREE: 0,
+    UserRoles.PREMIUM: 1,
+    UserRoles.ENTERPRISE: 2,
+    UserRoles.ADMIN: 3,
+}
+PLAN_NAMES = {code: plan for plan, code in PLAN_CODES.items()}
+
+PLAN_PERMISSIONS = {
+    UserRoles.FREE: ["chat:basic", "history:read"],
+    UserRoles.PREMIUM: ["chat:advanced", "history:full", "export:pdf"],
+    UserRoles.ENTERPRISE: ["chat:unlimited", "history:unlimited", "analytics:full"],
+    UserRoles.ADMIN: [WILDCARD],
+}
+
+
+def plan_permissions(plan: str) -> List[str]:
+    """Permisos de un plan (los del plan gratuito si no se conoce)"""
+    return PLAN_PERMISSIONS.get(plan, PLAN_PERMISSIONS[UserRoles.FREE])
+
+
+def encode_permissions(permissions: Iterable[str]) -> int:
+    """Bitmask de una lista de permisos (los que no están en el registro se ignoran)"""
+    mask = 0
+    for permission in permissions:
+        mask |= _BITS.get(permission, 0)
+    return mask
+
+
+def registry_version(version: Optional[int]) -> int:
+    """Versión del registro con la que decodificar un token (sin `pv`, la más reciente)"""
+    if version is None:
+        return REGISTRY_VERSION
+    return max(min(PERMISSION_REGISTRY), min(version, REGISTRY_VERSION))
+
+
+def decode_permissions(mask: int, version: int = REGISTRY_VERSION) -> List[str]:
+    """Lista de permisos de un bitmask según el registro `version` (bits desconocidos ignorados)"""
+    return [permission for bit, permission in enumerate(PERMISSION_REGISTRY[version]) if mask >> bit & 1]
+
+
+def has_permissions(mask: int, required: int) -> bool:
+    """True si `mask` incluye todos los bits de `required` (o el comodín)"""
+    return bool(mask & WILDCARD_BIT) or mask & required == required
+
+
+def build_claims(
+    user_id: str,
+    plan: str,
+    email: Optional[str] = None,
+    name: Optional[str] = None,
+    compact: bool = True,
+    include_pii: bool = False
+) -> Dict[str, Any]:
+    """Claims de un token para el usuario y su plan"""
+    if not compact:
+        # Formato anterior, para servicios que aún no entienden el compacto
+        return {
+            "sub": user_id,
+            "email": email,
+            "name": name,
+            "role": plan,
+            "permissions": plan_permissions(plan)
+        }
+    claims = {
+        "sub": user_id,
+        "pv": REGISTRY_VERSION,
+        "pm": encode_permissions(plan_permissions(plan)),
+        "pl": PLAN_CODES.get(plan, PLAN_CODES[UserRoles.FREE])
+    }
+    if include_pii:
+        claims["email"] = email
+        claims["name"] = name
+    return claims
+
+
+def user_from_claims(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Usuario actual a partir de los claims, en formato compacto o anterior"""
+    if "pm" in payload:
+        plan_code = payload.get("pl", PLAN_CODES[UserRoles.FREE])
+        version = registry_version(payload.get("pv"))
+        # Bits fuera del registro de esa versión se descartan
+        mask = payload["pm"] & _VERSION_MASKS[version]
+        role = PLAN_NAMES.get(plan_code, UserRoles.FREE)
+    else:
+        role = payload.get("role", UserRoles.FREE)
+        plan_code = PLAN_CODES.get(role, PLAN_CODES[UserRoles.FREE])
+        mask = encode_permissions(payload.get("permissions", []))
+        version = REGISTRY_VERSION
+    return {
+        "user_id": payload.get("sub"),
+        "email": payload.get("email"),
+        "name": payload.get("name"),
+        "role": role,
+        "plan_code": plan_code,
+        "permission_mask": mask,
+        "permissions": decode_permissions(mask, version),
+        "subscription_status": payload.get("subscription_status", UserRoles.FREE),
+    }
@@ -0,0 +1,300 @@
+"""
+Lista de revocación de tokens JWT
+
+Los `jti` revocados se guardan en Redis con TTL igual a la vida restante del
+token. Cada servicio mantiene un filtro de Bloom en proceso con esos `jti`,
+alimentado por pub/sub (`TOKEN_REVOCATION_CHANNEL`) y reconstruido desde
+Redis al suscribirse y cada `TOKEN_REVOCATION_RESYNC_SECONDS` (así salen los
+tokens ya expirados). `verify_token` solo consulta Redis si el filtro da
+positivo, es decir, para los tokens revocados y los falsos positivos.
+
+Mientras no hay suscripción (arranque, Redis caído) el filtro puede estar
+incompleto y se consulta Redis en cada verificación. Sin Redis configurado
+la revocación es local a la réplica. Si Redis falla al revocar, el `jti` se
+guarda en la réplica (`REVOKED_LOCALLY`) y se reintenta escribirlo en Redis
+en cada resincronización.
+"""
+
+from typing import Optional, Dict, Any, List
+import asyncio
+import hashlib
+import logging
+import math
+import time
+
+from .config import get_settings
+from .exceptions import RedisConnectionException
+from .redis_client import RedisCache, get_redis_cache
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "revoked"
+
+# Resultado de `revoke`
+REVOKED = "revoked"
+REVOKED_LOCALLY = "revoked_locally"
+
+
+class BloomFilter:
+    """Filtro de Bloom dimensionado para `capacity` elementos con `error_rate` de falsos positivos"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Doble hashing (Kirsch-Mitzenmacher) sobre un único digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class TokenRevocationList:
+    """jti revocados en Redis con filtro de Bloom local sincronizado por pub/sub"""
+
+    def __init__(
+        self,
+        redis_cache: RedisCache,
+        channel: str = "auth:revoked",
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        resync_interval: float = 300.0,
+        scan_count: int = 1000
+    ):
+        self.redis_cache = redis_cache
+        self.channel = channel
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.resync_interval = resync_interval
+        self.scan_count = scan_count
+        self.bloom = BloomFilter(capacity, error_rate)
+        # jti publicados durante una reconstrucción (entran también en el filtro nuevo)
+        self._published_during_resync: Optional[List[str]] = None
+        # jti -> expiración revocados solo en esta réplica (sin Redis o con Redis caído)
+        self._local: Dict[str, float] = {}
+        self._synced = False
+        self._tasks = []
+        self.stats = {
+            "revoked": 0,
+            "local_only": 0,
+            "checks": 0,
+            "bloom_negatives": 0,
+            "redis_lookups": 0,
+            "false_positives": 0,
+            "resyncs": 0,
+            "errors": 0
+        }
+
+    def _key(self, jti: str) -> str:
+        return self.redis_cache.key(NAMESPACE, jti)
+
+    def _remember(self, jti: str):
+        self.bloom.add(jti)
+        if self._published_during_resync is not None:
+            self._published_during_resync.append(jti)
+
+    async def _store(self, jti: str, ttl: int):
+        await self.redis_cache.execute(NAMESPACE, "SET", self._key(jti), b"1", "EX", ttl)
+        try:
+            await self.redis_cache.execute(NAMESPACE, "PUBLISH", self.channel, jti)
+        except Exception as e:
+            # Las demás réplicas lo verán en Redis tras su próxima resincronización
+            self.stats["errors"] += 1
+            logger.warning(f"Token revocation publish failed: {e}")
+
+    async def revoke(self, jti: str, expires_at: float) -> Optional[str]:
+        """
+        Revocar un token hasta su expiración (`exp`, timestamp UNIX).
+
+        Devuelve `REVOKED`, `REVOKED_LOCALLY` si no se pudo escribir en Redis
+        (las demás réplicas aún no lo ven) o None si el token ya expiró.
+        """
+        ttl = math.ceil(expires_at - time.time())
+        if ttl <= 0:
+            return None
+        self._remember(jti)
+        self.stats["revoked"] += 1
+        if self.redis_cache.enabled:
+            try:
+                await self._store(jti, ttl)
+                return REVOKED
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Token revocation write failed, revoked on this replica only: {e}")
+        self._local[jti] = expires_at
+        self.stats["local_only"] += 1
+        return REVOKED_LOCALLY if self.redis_cache.enabled else REVOKED
+
+    async def revoke_payload(self, payload: Dict[str, Any]) -> Optional[str]:
+        """Revocar un token a partir de sus claims (sin `jti` no se puede revocar)"""
+        if not payload.get("jti") or not payload.get("exp"):
+            return None
+        return await self.revoke(payload["jti"], payload["exp"])
+
+    async def is_revoked(self, jti: str) -> bool:
+        """True si el token está revocado (Redis solo ante un positivo del filtro)"""
+        self.stats["checks"] += 1
+        expires_at = self._local.get(jti)
+        if expires_at is not None:
+            if expires_at > time.time():
+                return True
+            self._local.pop(jti, None)
+        if not self.redis_cache.enabled:
+            return False
+
+        if self._synced and jti not in self.bloom:
+            self.stats["bloom_negatives"] += 1
+            return False
+        self.stats["redis_lookups"] += 1
+        try:
+            revoked = bool(await self.redis_cache.execute(NAMESPACE, "EXISTS", self._key(jti)))
+        except RedisConnectionException as e:
+            # Sin Redis decide el filtro: un positivo se trata como revocado
+            self.stats["errors"] += 1
+            logger.warning(f"Token revocation lookup failed, using local filter: {e}")
+            return jti in self.bloom
+        if not revoked and self._synced:
+            self.stats["false_positives"] += 1
+        return revoked
+
+    async def _scan(self) -> List[str]:
+        prefix = self._key("")
+        cursor = 0
+        jtis = []
+        while True:
+            cursor, keys = await self.redis_cache.execute(
+                NAMESPACE, "SCAN", cursor, "MATCH", f"{prefix}*", "COUNT", self.scan_count
+            )
+            jtis.extend(key.decode()[len(prefix):] for key in keys)
+            if not int(cursor):
+                return jtis
+
+    async def _flush_local(self):
+        # Revocaciones que no llegaron a Redis: se escriben ahora (o se descartan si expiraron)
+        for jti, expires_at in list(self._local.items()):
+            ttl = math.ceil(expires_at - time.time())
+            if ttl > 0:
+                await self._store(jti, ttl)
+            self._local.pop(jti, None)
+
+    async def resync(self):
+        """Reconstruir el filtro desde Redis (descarta los jti ya expirados)"""
+        await self._flush_local()
+        self._published_during_resync = []
+        try:
+            jtis = await self._scan()
+            jtis.extend(self._published_during_resync)
+        finally:
+            self._published_during_resync = None
+        if len(jtis) > self.capacity:
+            # Más revocaciones de las previstas: se agranda para mantener el error
+            self.capacity = len(jtis) * 2
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        for jti in jtis:
+            bloom.add(jti)
+        self.bloom = bloom
+        self.stats["resyncs"] += 1
+
+    async def _listen(self):
+        backoff = 1.0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis_cache.client(NAMESPACE).pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(self.channel)
+                # Revocaciones anteriores o perdidas mientras no había suscripción
+                await self.resync()
+                self._synced = True
+                backoff = 1.0
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._remember(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Token revocation subscription lost: {e}")
+            finally:
+                self._synced = False
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    async def _resync_periodically(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            if not self._synced:
+                continue
+            try:
+                await self.resync()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Token revocation resync failed: {e}")
+
+    def start(self):
+        """Iniciar la suscripción y la resincronización periódica"""
+        if not self._tasks and self.redis_cache.enabled:
+            self._tasks = [
+                asyncio.create_task(self._listen()),
+                asyncio.create_task(self._resync_periodically())
+            ]
+
+    async def stop(self):
+        """Detener la suscripción"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Verificaciones resueltas en memoria, consultas a Redis y estado del filtro"""
+        checks = self.stats["checks"]
+        return {
+            **self.stats,
+            "synced": self._synced,
+            "pending_local": len(self._local),
+            "in_memory_ratio": round(self.stats["bloom_negatives"] / checks, 3) if checks else None,
+            "bloom": {
+                "entries": self.bloom.count,
+                "capacity": self.capacity,
+                "bits": self.bloom.size,
+                "hashes": self.bloom.hashes
+            }
+        }
+
+
+# Instancia global de la lista de revocación
+_revocation_list = None
+
+
+def get_revocation_list() -> TokenRevocationList:
+    """Obtener instancia singleton de la lista de revocación"""
+    global _revocation_list
+    if _revocation_list is None:
+        settings = get_settings()
+        _revocation_list = TokenRevocationList(
+            get_redis_cache(),
+            channel=settings.TOKEN_REVOCATION_CHANNEL,
+            capacity=settings.TOKEN_REVOCATION_BLOOM_CAPACITY,
+            error_rate=settings.TOKEN_REVOCATION_BLOOM_ERROR_RATE,
+            resync_interval=settings.TOKEN_REVOCATION_RESYNC_SECONDS
+        )
+    return _revocation_list